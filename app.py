@@ -1,33 +1,84 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, abort
 from flask_socketio import SocketIO
 from models import db, User, Message, Post, FileShare
 from events import init_socket_events
+from message_history import load_conversation_page
+from file_listing import load_file_page, file_to_dict
+from post_feed import render_post, load_feed_page
+from database import init_database, INSTANCE_DIR
+from ipc_manager import IPCManager
+from file_transfer import init_file_routes, start_upload_sweeper
+from group_chat import init_group_routes
+from user_cache import user_cache
+from media_pipeline import init_media_pipeline
+from search import init_search
+from metrics import init_metrics
+from logging_config import setup_logging
 import os
 from werkzeug.security import generate_password_hash, check_password_hash
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'your-secret-key')
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///chat.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+# 日志统一在这里配置：经队列异步输出，可选JSON格式、采样和内容脱敏
+setup_logging(app)
 
 # 文件上传配置
-app.config['UPLOAD_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'uploads')
+# 上传的文件只能经过登录校验的下载、媒体接口访问，不能放在Flask公开的static目录下
+app.config['UPLOAD_FOLDER'] = os.getenv('UPLOAD_FOLDER') or os.path.join(INSTANCE_DIR, 'uploads')
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB
-ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'doc', 'docx', 'xls', 'xlsx'}
+app.config['UPLOAD_CHUNK_SIZE'] = int(os.getenv('UPLOAD_CHUNK_SIZE', 4 * 1024 * 1024))  # 分块上传每块的最大字节数
+app.config['UPLOAD_MAX_FILE_SIZE'] = int(os.getenv('UPLOAD_MAX_FILE_SIZE', 500 * 1024 * 1024))  # 分块上传的文件大小上限
+app.config['UPLOAD_SESSION_TTL'] = int(os.getenv('UPLOAD_SESSION_TTL', 24 * 3600))  # 超过该秒数没有新数据的上传视为放弃
+app.config['UPLOAD_SWEEP_INTERVAL'] = int(os.getenv('UPLOAD_SWEEP_INTERVAL', 3600))  # 清理放弃的上传的间隔
+
+# 文件下载配置
+app.config['DOWNLOAD_MAX_AGE'] = int(os.getenv('DOWNLOAD_MAX_AGE', 7 * 24 * 3600))  # 浏览器缓存时间，文件按内容寻址不会变化
+app.config['X_ACCEL_REDIRECT_PREFIX'] = os.getenv('X_ACCEL_REDIRECT_PREFIX')  # nginx内部location，如 /protected-uploads/
+app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE', '0') == '1'  # Apache/lighttpd的X-Sendfile
+
+# 媒体处理配置（缩略图需要Pillow，语音转码需要ffmpeg）
+app.config['MEDIA_WORKERS'] = int(os.getenv('MEDIA_WORKERS', 2))  # 处理进程数
+app.config['MEDIA_MAX_RETRIES'] = int(os.getenv('MEDIA_MAX_RETRIES', 3))
+app.config['MEDIA_THUMB_SIZE'] = int(os.getenv('MEDIA_THUMB_SIZE', 320))  # 缩略图最长边像素
+app.config['MEDIA_VOICE_BITRATE'] = os.getenv('MEDIA_VOICE_BITRATE', '24k')
+ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'webp', 'doc', 'docx', 'xls', 'xlsx',
+                      'mp3', 'wav', 'm4a', 'aac', 'ogg', 'webm', 'amr'}
 
 # 确保上传目录存在
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'images'), exist_ok=True)
 os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'voices'), exist_ok=True)
 
+# AI回复后台调度配置
+app.config['AI_DISPATCH_WORKERS'] = int(os.getenv('AI_DISPATCH_WORKERS', 4))  # 并发AI请求数
+app.config['AI_DISPATCH_QUEUE_SIZE'] = int(os.getenv('AI_DISPATCH_QUEUE_SIZE', 64))  # 最大排队任务数
+app.config['AI_DISPATCH_PER_USER'] = int(os.getenv('AI_DISPATCH_PER_USER', 2))  # 单用户同时进行的请求数
+app.config['AI_STREAMING'] = os.getenv('AI_STREAMING', '1') == '1'  # 逐段推送AI回复
+
+# 消息批量写入配置
+app.config['MESSAGE_BATCH_SIZE'] = int(os.getenv('MESSAGE_BATCH_SIZE', 100))  # 每个事务最多写入的消息数
+app.config['MESSAGE_BATCH_DELAY_MS'] = int(os.getenv('MESSAGE_BATCH_DELAY_MS', 5))  # 攒批的最长等待时间
+
+# 在线状态配置
+app.config['PRESENCE_TTL'] = int(os.getenv('PRESENCE_TTL', 90))  # 超过该秒数没有心跳视为离线
+app.config['PRESENCE_FLUSH_INTERVAL'] = float(os.getenv('PRESENCE_FLUSH_INTERVAL', 1.0))  # 批量广播状态变化的间隔
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-# 初始化数据库
-db.init_app(app)
+# 初始化数据库，地址和连接池参数来自环境变量（DATABASE_URL、DB_POOL_*、SQLITE_*）
+init_database(app, db)
 
 # 初始化SocketIO
-socketio = SocketIO(app, cors_allowed_origins="*")
+# 多进程/多节点部署时通过消息队列广播emit，例如 redis://localhost:6379/0，
+# 单机多进程也可以使用内置的 ipc://127.0.0.1:6010（需先运行 python ipc_manager.py）
+app.config['SOCKETIO_MESSAGE_QUEUE'] = os.getenv('SOCKETIO_MESSAGE_QUEUE')
+message_queue = app.config['SOCKETIO_MESSAGE_QUEUE']
+if message_queue and message_queue.startswith('ipc://'):
+    socketio = SocketIO(app, cors_allowed_origins="*", client_manager=IPCManager(message_queue))
+else:
+    socketio = SocketIO(app, cors_allowed_origins="*", message_queue=message_queue)
 
 # 确保数据库表存在
 with app.app_context():
@@ -36,6 +87,21 @@ with app.app_context():
 # 初始化Socket.IO事件
 init_socket_events(app, socketio)
 
+# 初始化群聊接口
+init_group_routes(app, socketio)
+
+# 初始化文件上传、下载路由
+init_file_routes(app, allowed_file)
+
+# 初始化媒体处理队列，上传完成后生成缩略图和压缩语音
+init_media_pipeline(app)
+
+# 初始化全文检索（SQLite FTS5），首次启动时为已有数据建立索引
+init_search(app)
+
+# 注册 /metrics 接口（Prometheus文本格式）
+init_metrics(app)
+
 # 错误处理
 @app.errorhandler(404)
 def page_not_found(e):
@@ -131,22 +197,72 @@ def chat():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
-    # 获取AI助手用户
-    ai_assistant = User.query.filter_by(username='AI助手').first()
+    # 获取AI助手用户（进程内缓存）
+    ai_assistant = user_cache.get_bot()
     if not ai_assistant:
         flash('系统错误：AI助手未配置', 'error')
         return redirect(url_for('index'))
     
     return render_template('chat.html', bot=ai_assistant)
 
+@app.route('/api/messages/<int:peer_id>')
+def message_history(peer_id):
+    if 'user_id' not in session:
+        return jsonify({'error': '请先登录'}), 401
+
+    try:
+        messages, next_cursor = load_conversation_page(
+            session['user_id'], peer_id,
+            before=request.args.get('before'),
+            limit=request.args.get('limit')
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify({
+        'messages': [message.to_dict() for message in messages],
+        'next_cursor': next_cursor
+    })
+
 @app.route('/files')
 def files():
     if 'user_id' not in session:
         flash('请先登录', 'error')
         return redirect(url_for('login'))
     
-    files = FileShare.query.order_by(FileShare.upload_time.desc()).all()
-    return render_template('files.html', files=files)
+    try:
+        files, next_cursor = load_file_page(**file_filters())
+    except ValueError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('files'))
+    return render_template('files.html', files=files, next_cursor=next_cursor,
+                           filters=request.args)
+
+@app.route('/api/files')
+def file_list():
+    """文件列表的JSON版本，用于滚动加载"""
+    if 'user_id' not in session:
+        return jsonify({'error': '请先登录'}), 401
+
+    try:
+        files, next_cursor = load_file_page(**file_filters())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify({
+        'files': [file_to_dict(file) for file in files],
+        'next_cursor': next_cursor
+    })
+
+def file_filters():
+    """从查询参数读取文件列表的过滤和分页条件"""
+    return {
+        'file_type': request.args.get('type'),
+        'owner_id': request.args.get('owner_id', type=int),
+        'name_prefix': request.args.get('q'),
+        'before': request.args.get('before'),
+        'limit': request.args.get('limit')
+    }
 
 @app.route('/create-post', methods=['GET', 'POST'])
 def create_post():
@@ -182,8 +298,92 @@ def create_post():
 
 @app.route('/post/<int:post_id>')
 def view_post(post_id):
+    # 正文按 (帖子ID, 更新时间) 缓存渲染结果，命中时不再加载正文、作者，也不渲染正文模板
+    post, post_html = render_post(post_id)
+    if post is None:
+        abort(404)
+    return render_template('view_post.html', post=post, post_html=post_html)
+
+@app.route('/post/<int:post_id>/edit', methods=['GET', 'POST'])
+def edit_post(post_id):
+    if 'user_id' not in session:
+        flash('请先登录', 'error')
+        return redirect(url_for('login'))
+
     post = Post.query.get_or_404(post_id)
-    return render_template('view_post.html', post=post)
+    if post.user_id != session['user_id']:
+        abort(403)
+
+    if request.method == 'POST':
+        title = request.form.get('title')
+        content = request.form.get('content')
+
+        if not title or not content:
+            flash('标题和内容不能为空', 'error')
+            return render_template('edit_post.html', post=post)
+
+        post.title = title
+        post.content = content
+        try:
+            db.session.commit()
+            flash('帖子已更新', 'success')
+            return redirect(url_for('view_post', post_id=post.id))
+        except Exception as e:
+            db.session.rollback()
+            flash('保存失败，请稍后重试', 'error')
+            app.logger.error(f'修改帖子失败: {str(e)}')
+
+    return render_template('edit_post.html', post=post)
+
+@app.route('/post/<int:post_id>/delete', methods=['POST'])
+def delete_post(post_id):
+    if 'user_id' not in session:
+        flash('请先登录', 'error')
+        return redirect(url_for('login'))
+
+    post = Post.query.get_or_404(post_id)
+    if post.user_id != session['user_id']:
+        abort(403)
+
+    try:
+        db.session.delete(post)
+        db.session.commit()
+        flash('帖子已删除', 'success')
+    except Exception as e:
+        db.session.rollback()
+        flash('删除失败，请稍后重试', 'error')
+        app.logger.error(f'删除帖子失败: {str(e)}')
+    return redirect(url_for('posts'))
+
+@app.route('/posts')
+def posts():
+    if 'user_id' not in session:
+        flash('请先登录', 'error')
+        return redirect(url_for('login'))
+
+    try:
+        items, next_cursor = load_feed_page(request.args.get('before'), request.args.get('limit'))
+    except ValueError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('posts'))
+    return render_template('posts.html', items=items, next_cursor=next_cursor)
+
+@app.route('/api/posts')
+def post_feed():
+    """信息流的JSON版本，返回渲染好的片段，用于滚动加载"""
+    if 'user_id' not in session:
+        return jsonify({'error': '请先登录'}), 401
+
+    try:
+        items, next_cursor = load_feed_page(request.args.get('before'), request.args.get('limit'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify({
+        'posts': [{'id': post_id, 'html': str(html)} for post_id, html in items],
+        'next_cursor': next_cursor
+    })
 
 if __name__ == '__main__':
-    socketio.run(app, debug=True)
\ No newline at end of file
+    start_upload_sweeper(app)
+    socketio.run(app, debug=True, port=int(os.getenv('PORT', 5000)))
\ No newline at end of file
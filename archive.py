@@ -0,0 +1,236 @@
+"""消息归档：把超过保留期的消息移出消息表，写入按会话、月份分区的压缩文件
+
+用法：python archive.py --days 180 [--vacuum]
+
+每个 (会话, 月份) 写一个gzip压缩的JSONL文件，并在ArchiveSegment中登记一条清单记录；
+文件落盘之后才在同一事务中删除消息、写入清单。历史翻页越过热数据时由
+load_archived_page从归档文件读取，接口返回的数据格式不变。
+"""
+import os
+import gzip
+import json
+import logging
+import argparse
+import threading
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, case
+
+from database import INSTANCE_DIR
+from models import db, Message, ArchiveSegment, UnreadCounter
+from user_cache import user_cache
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_COLUMNS = ('id', 'content', 'message_type', 'media_url', 'timestamp', 'sender_id', 'recipient_id',
+                   'status', 'read_at', 'conversation')
+DATETIME_COLUMNS = ('timestamp', 'read_at')
+
+
+def archive_folder():
+    return os.getenv('ARCHIVE_FOLDER') or os.path.join(INSTANCE_DIR, 'archive')
+
+
+def _serialize(message):
+    record = {}
+    for column in ARCHIVE_COLUMNS:
+        value = getattr(message, column)
+        record[column] = value.isoformat() if column in DATETIME_COLUMNS and value else value
+    return record
+
+
+def _deserialize(record):
+    """归档记录还原为未加入会话的Message对象，调用方按普通消息使用（to_dict等）"""
+    fields = dict(record)
+    for column in DATETIME_COLUMNS:
+        if fields.get(column):
+            fields[column] = datetime.fromisoformat(fields[column])
+    return Message(**fields)
+
+
+def _write_segment(folder, relpath, messages):
+    """先写临时文件并落盘，再原子替换为正式文件"""
+    path = os.path.join(folder, relpath)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb', mtime=0) as f:
+            for message in messages:
+                f.write(json.dumps(_serialize(message), ensure_ascii=False).encode('utf-8') + b'\n')
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp_path, path)
+    return path
+
+
+def _release_unread(messages):
+    """归档的未读消息视为已读：从接收方的未读数中扣除"""
+    bot = user_cache.get_bot()
+    pending = defaultdict(int)
+    for message in messages:
+        if message.status == 'sent' and (bot is None or message.recipient_id != bot.id):
+            pending[(message.recipient_id, message.sender_id)] += 1
+    for (user_id, peer_id), count in pending.items():
+        db.session.execute(
+            update(UnreadCounter)
+            .where(UnreadCounter.user_id == user_id, UnreadCounter.peer_id == peer_id)
+            .values(count=case((UnreadCounter.count > count, UnreadCounter.count - count), else_=0),
+                    updated_at=datetime.utcnow())
+        )
+
+
+def _archive_chunk(folder, conversation, messages):
+    """把同一会话的一批消息按月份写入归档文件，并在一个事务内删除原消息、登记清单
+
+    Returns:
+        int: 写出的文件数
+    """
+    periods = OrderedDict()
+    for message in messages:
+        periods.setdefault(message.timestamp.strftime('%Y-%m'), []).append(message)
+
+    # search依赖message_history，message_history又依赖本模块，在用到时再导入
+    from search import remove_messages
+
+    written = []
+    try:
+        for period, rows in periods.items():
+            relpath = os.path.join(period, f"{conversation.replace(':', '_')}-{rows[0].id}-{rows[-1].id}.jsonl.gz")
+            written.append(_write_segment(folder, relpath, rows))
+            db.session.add(ArchiveSegment(
+                conversation=conversation, period=period, path=relpath,
+                first_id=rows[0].id, last_id=rows[-1].id,
+                first_timestamp=rows[0].timestamp, last_timestamp=rows[-1].timestamp,
+                message_count=len(rows)
+            ))
+
+        ids = [message.id for message in messages]
+        _release_unread(messages)
+        remove_messages(db.session.connection(), ids)
+        # 批量删除，不加载关系、不逐条触发ORM事件
+        db.session.execute(Message.__table__.delete().where(Message.__table__.c.id.in_(ids)))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        # 事务没有提交，消息仍在热表中，删除本次写出的文件
+        for path in written:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        raise
+    db.session.expunge_all()
+    return len(written)
+
+
+def archive_messages(older_than_days=180, batch_size=5000):
+    """把早于保留期的消息归档
+
+    Args:
+        older_than_days: 热表保留的天数
+        batch_size: 每个事务归档的消息数
+
+    Returns:
+        tuple: (归档的消息数, 写出的文件数)
+    """
+    folder = archive_folder()
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    conversations = list(db.session.execute(
+        select(Message.conversation).where(Message.timestamp < cutoff, Message.conversation.isnot(None))
+        .group_by(Message.conversation)
+    ).scalars())
+
+    archived = segments = 0
+    for conversation in conversations:
+        while True:
+            # 走 (conversation, timestamp, id) 索引，按时间顺序分批取出
+            messages = Message.query.filter(Message.conversation == conversation, Message.timestamp < cutoff) \
+                .order_by(Message.timestamp, Message.id).limit(batch_size).all()
+            if not messages:
+                break
+            segments += _archive_chunk(folder, conversation, messages)
+            archived += len(messages)
+            logger.info('会话 %s 归档 %d 条消息', conversation, len(messages))
+    return archived, segments
+
+
+class _SegmentCache:
+    """解压后的归档文件缓存，归档文件写入后不会再修改"""
+
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def records(self, path):
+        with self._lock:
+            if path in self._entries:
+                self._entries.move_to_end(path)
+                return self._entries[path]
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        with self._lock:
+            self._entries[path] = records
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return records
+
+
+_segment_cache = _SegmentCache(max_entries=int(os.getenv('ARCHIVE_CACHE_SEGMENTS', 32)))
+
+
+def load_archived_page(conversation, before=None, limit=30):
+    """从归档中按 (timestamp, id) 倒序读取一段历史
+
+    归档的消息都早于热表中同一会话的消息，历史翻页在热表取不满一页时才会调用。
+
+    Args:
+        conversation: 会话键
+        before: (timestamp, id)，只返回比它更早的消息；为空时从最新的归档开始
+        limit: 最多返回的条数
+
+    Returns:
+        list: 按时间倒序排列的Message对象（未加入数据库会话）
+    """
+    query = ArchiveSegment.query.filter(ArchiveSegment.conversation == conversation)
+    if before:
+        query = query.filter(ArchiveSegment.first_timestamp <= before[0])
+    folder = archive_folder()
+
+    rows = []
+    for segment in query.order_by(ArchiveSegment.last_timestamp.desc(), ArchiveSegment.last_id.desc()):
+        try:
+            records = _segment_cache.records(os.path.join(folder, segment.path))
+        except OSError as e:
+            logger.error('读取归档文件失败 %s: %s', segment.path, e)
+            continue
+        messages = [_deserialize(record) for record in records]
+        if before:
+            messages = [m for m in messages if (m.timestamp, m.id) < tuple(before)]
+        messages.sort(key=lambda m: (m.timestamp, m.id), reverse=True)
+        rows.extend(messages)
+        if len(rows) >= limit:
+            break
+    return rows[:limit]
+
+
+if __name__ == '__main__':
+    from app import app
+
+    parser = argparse.ArgumentParser(description='把超过保留期的消息归档到压缩文件')
+    parser.add_argument('--days', type=int, default=int(os.getenv('ARCHIVE_AFTER_DAYS', 180)),
+                        help='热表保留的天数')
+    parser.add_argument('--batch-size', type=int, default=5000, help='每个事务归档的消息数')
+    parser.add_argument('--vacuum', action='store_true', help='归档后执行VACUUM回收SQLite文件空间')
+    args = parser.parse_args()
+
+    with app.app_context():
+        archived, segments = archive_messages(args.days, args.batch_size)
+        print(f'Archived {archived} messages into {segments} segments under {archive_folder()}')
+        if archived and db.engine.dialect.name == 'sqlite':
+            # VACUUM不能在事务中执行
+            with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                conn.exec_driver_sql('PRAGMA optimize')
+                if args.vacuum:
+                    conn.exec_driver_sql('VACUUM')
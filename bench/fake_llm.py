@@ -0,0 +1,194 @@
+"""本地模拟的OpenAI兼容大模型服务，压测时代替DeepSeek
+
+用法：python bench/fake_llm.py --port 8100 --latency-ms 300 --tokens-per-second 40
+然后设置 DEEPSEEK_BASE_URL=http://127.0.0.1:8100 启动应用。
+
+支持 POST /chat/completions（也接受 /v1 前缀），包括 stream=True 的SSE输出和
+stream_options.include_usage；可配置首字延迟、生成速度、回复长度和错误注入。
+"""
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPLY_TEXT = '这是模拟服务生成的回复内容，用于压力测试，不会消耗真实的接口额度。'
+
+
+class FakeLLMConfig:
+    def __init__(self, latency_ms=300, jitter_ms=100, tokens_per_second=40, reply_tokens=40,
+                 error_rate=0.0, error_status=500):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.tokens_per_second = tokens_per_second
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+
+    def first_token_delay(self):
+        return max(0.0, (self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000)
+
+    def token_interval(self):
+        return 1 / self.tokens_per_second if self.tokens_per_second > 0 else 0
+
+    def reply(self):
+        # 每个字算一个token
+        return (REPLY_TEXT * (self.reply_tokens // len(REPLY_TEXT) + 1))[:self.reply_tokens]
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.inflight = 0
+        self.max_inflight = 0
+
+    def snapshot(self):
+        with self.lock:
+            return {'requests': self.requests, 'errors': self.errors,
+                    'inflight': self.inflight, 'max_inflight': self.max_inflight}
+
+
+def make_handler(config, stats):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _write_chunk(self, data):
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.flush()
+
+        def do_GET(self):
+            if self.path.rstrip('/') == '/stats':
+                self._send_json(200, stats.snapshot())
+            else:
+                self._send_json(404, {'error': {'message': 'not found'}})
+
+        def do_POST(self):
+            if self.path.rstrip('/') not in ('/chat/completions', '/v1/chat/completions'):
+                self._send_json(404, {'error': {'message': 'not found'}})
+                return
+            length = int(self.headers.get('Content-Length') or 0)
+            request = json.loads(self.rfile.read(length) or b'{}')
+
+            with stats.lock:
+                stats.requests += 1
+                stats.inflight += 1
+                stats.max_inflight = max(stats.max_inflight, stats.inflight)
+            try:
+                time.sleep(config.first_token_delay())
+                if random.random() < config.error_rate:
+                    with stats.lock:
+                        stats.errors += 1
+                    self._send_json(config.error_status, {'error': {
+                        'message': 'injected error', 'type': 'rate_limit' if config.error_status == 429 else 'server_error'
+                    }})
+                    return
+                if request.get('stream'):
+                    self._stream(request)
+                else:
+                    self._complete(request)
+            finally:
+                with stats.lock:
+                    stats.inflight -= 1
+
+        def _usage(self, request, completion_tokens):
+            prompt_tokens = sum(len(m.get('content') or '') for m in request.get('messages', []))
+            return {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                    'total_tokens': prompt_tokens + completion_tokens}
+
+        def _complete(self, request):
+            text = config.reply()
+            time.sleep(config.token_interval() * len(text))
+            self._send_json(200, {
+                'id': f'chatcmpl-{uuid.uuid4().hex}',
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': request.get('model', 'fake'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text},
+                             'finish_reason': 'stop'}],
+                'usage': self._usage(request, len(text))
+            })
+
+        def _stream(self, request):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+
+            completion_id = f'chatcmpl-{uuid.uuid4().hex}'
+            base = {'id': completion_id, 'object': 'chat.completion.chunk',
+                    'created': int(time.time()), 'model': request.get('model', 'fake')}
+            text = config.reply()
+            try:
+                for index, token in enumerate(text):
+                    if index:
+                        time.sleep(config.token_interval())
+                    chunk = dict(base, choices=[{'index': 0, 'delta': {'content': token}, 'finish_reason': None}])
+                    self._write_chunk(b'data: ' + json.dumps(chunk, ensure_ascii=False).encode('utf-8') + b'\n\n')
+                final = dict(base, choices=[{'index': 0, 'delta': {}, 'finish_reason': 'stop'}])
+                self._write_chunk(b'data: ' + json.dumps(final).encode('utf-8') + b'\n\n')
+                if (request.get('stream_options') or {}).get('include_usage'):
+                    usage = dict(base, choices=[], usage=self._usage(request, len(text)))
+                    self._write_chunk(b'data: ' + json.dumps(usage).encode('utf-8') + b'\n\n')
+                self._write_chunk(b'data: [DONE]\n\n')
+                self._write_chunk(b'')
+            except (BrokenPipeError, ConnectionResetError):
+                # 客户端取消了流式回复
+                self.close_connection = True
+
+    return Handler
+
+
+def start_fake_llm(config=None, host='127.0.0.1', port=0):
+    """在后台线程中启动模拟服务
+
+    Returns:
+        tuple: (server, base_url, stats)
+    """
+    stats = Stats()
+    server = ThreadingHTTPServer((host, port), make_handler(config or FakeLLMConfig(), stats))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fake-llm', daemon=True).start()
+    return server, f'http://{host}:{server.server_address[1]}', stats
+
+
+def add_arguments(parser):
+    parser.add_argument('--latency-ms', type=float, default=300, help='首字延迟（毫秒）')
+    parser.add_argument('--jitter-ms', type=float, default=100, help='首字延迟的随机抖动（毫秒）')
+    parser.add_argument('--tokens-per-second', type=float, default=40, help='生成速度')
+    parser.add_argument('--reply-tokens', type=int, default=40, help='每条回复的token数')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='注入错误的比例，0~1')
+    parser.add_argument('--error-status', type=int, default=500, help='注入错误的HTTP状态码，如429、500')
+
+
+def config_from_args(args):
+    return FakeLLMConfig(args.latency_ms, args.jitter_ms, args.tokens_per_second, args.reply_tokens,
+                         args.error_rate, args.error_status)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='OpenAI兼容的模拟大模型服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8100)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server, base_url, _ = start_fake_llm(config_from_args(args), args.host, args.port)
+    print(f'fake LLM listening on {base_url}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,114 @@
+"""群消息写入代价随群人数的变化
+
+用法：python bench/group_fanout.py --sizes 5 50 500 --messages 200
+
+对不同人数的群各发送若干条消息，统计每条消息的写入耗时、执行的写语句数和写入行数；
+同时给出"每个成员复制一份Message"的朴素做法作为对照。群消息只写一行，
+耗时和写入量应当不随人数增长；未读数按水位统计，也一并给出单次查询耗时。
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'group_fanout.db')}")
+
+from sqlalchemy import event  # noqa: E402
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+from app import app  # noqa: E402
+from models import db, User, Message, GroupMessage  # noqa: E402
+from group_chat import create_group, group_unread_counts, mark_group_read  # noqa: E402
+
+
+class WriteCounter:
+    """统计执行的INSERT/UPDATE/DELETE语句数和影响的行数"""
+
+    def __init__(self, engine):
+        self.statements = 0
+        self.rows = 0
+        event.listen(engine, 'after_cursor_execute', self._after)
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().split(None, 1)[0].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+            self.statements += 1
+            self.rows += max(cursor.rowcount, 0)
+
+    def snapshot(self):
+        return self.statements, self.rows
+
+
+def create_users(prefix, count):
+    password = generate_password_hash('bench', method='pbkdf2:sha256:1')
+    users = [User(username=f'{prefix}_{i}', email=f'{prefix}_{i}@bench.local', password=password)
+             for i in range(count)]
+    db.session.add_all(users)
+    db.session.commit()
+    return [user.id for user in users]
+
+
+def measure(counter, messages, send):
+    statements, rows = counter.snapshot()
+    start = time.perf_counter()
+    for index in range(messages):
+        send(index)
+    elapsed = time.perf_counter() - start
+    new_statements, new_rows = counter.snapshot()
+    return {
+        'ms_per_message': elapsed * 1000 / messages,
+        'statements_per_message': (new_statements - statements) / messages,
+        'rows_per_message': (new_rows - rows) / messages,
+    }
+
+
+def bench_size(counter, size, messages):
+    member_ids = create_users(f'g{size}', size)
+    sender_id, reader_id = member_ids[0], member_ids[-1]
+    group = create_group(sender_id, f'bench {size}', member_ids)
+    db.session.commit()
+
+    def send_group(index):
+        # 与Socket.IO事件相同：写一行群消息，提交后对群房间emit一次
+        db.session.add(GroupMessage(group_id=group.id, sender_id=sender_id, content=f'group #{index}'))
+        db.session.commit()
+
+    def send_copies(index):
+        # 对照：给每个成员各写一条单聊消息
+        db.session.add_all([Message(sender_id=sender_id, recipient_id=member_id, content=f'copy #{index}',
+                                    message_type='text', status='sent')
+                            for member_id in member_ids if member_id != sender_id])
+        db.session.commit()
+
+    grouped = measure(counter, messages, send_group)
+    copies = measure(counter, max(1, messages // 10), send_copies)
+
+    start = time.perf_counter()
+    unread = group_unread_counts(reader_id).get(group.id, 0)
+    unread_ms = (time.perf_counter() - start) * 1000
+    mark_group_read(group.id, reader_id)
+    db.session.commit()
+    return grouped, copies, unread, unread_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description='群消息写入代价随群人数的变化')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5, 50, 500], help='群人数')
+    parser.add_argument('--messages', type=int, default=200, help='每个群发送的消息数')
+    args = parser.parse_args()
+
+    with app.app_context():
+        counter = WriteCounter(db.engine)
+        print(f"{'members':>8}{'ms/msg':>10}{'stmts/msg':>11}{'rows/msg':>10}"
+              f"{'copies ms/msg':>15}{'copies rows/msg':>17}{'unread':>8}{'unread ms':>11}")
+        for size in args.sizes:
+            grouped, copies, unread, unread_ms = bench_size(counter, size, args.messages)
+            print(f"{size:>8}{grouped['ms_per_message']:>10.3f}{grouped['statements_per_message']:>11.1f}"
+                  f"{grouped['rows_per_message']:>10.1f}{copies['ms_per_message']:>15.3f}"
+                  f"{copies['rows_per_message']:>17.1f}{unread:>8}{unread_ms:>11.3f}")
+
+
+if __name__ == '__main__':
+    main()
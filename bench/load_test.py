@@ -0,0 +1,284 @@
+"""聊天链路压测：模拟N个并发Socket.IO客户端
+
+用法：
+    python bench/load_test.py --clients 20 --messages 5
+    python bench/load_test.py --clients 50 --streaming --compare bench/results/上一次的结果.json
+
+默认在本地启动模拟大模型服务（bench/fake_llm.py）和一个应用进程，不消耗DeepSeek额度；
+也可以用 --target 压测已经启动的服务（该服务需自行配置 DEEPSEEK_BASE_URL）。
+
+每个客户端依次执行：注册登录 → 建立连接 → 循环 [send_message → 等待AI回复 → mark_read]，
+统计各事件的延迟分位数和整体吞吐量，结果保存为JSON，便于不同提交之间对比。
+"""
+import os
+import sys
+import json
+import time
+import queue
+import uuid
+import argparse
+import tempfile
+import platform
+import threading
+import subprocess
+
+import requests
+import socketio
+
+from fake_llm import start_fake_llm, add_arguments, config_from_args
+from two_workers import free_port, start_worker, ROOT
+
+RESULTS_DIR = os.path.join(ROOT, 'bench', 'results')
+
+
+class Recorder:
+    """收集各事件的延迟样本和错误数"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+
+    def record(self, event, seconds):
+        with self.lock:
+            self.samples.setdefault(event, []).append(seconds)
+
+    def error(self, event, reason):
+        with self.lock:
+            counts = self.errors.setdefault(event, {})
+            counts[reason] = counts.get(reason, 0) + 1
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(recorder, duration):
+    events = {}
+    for event in sorted(set(recorder.samples) | set(recorder.errors)):
+        values = sorted(recorder.samples.get(event, []))
+        errors = recorder.errors.get(event, {})
+        to_ms = lambda v: round(v * 1000, 2) if v is not None else None
+        events[event] = {
+            'count': len(values),
+            'errors': sum(errors.values()),
+            'error_reasons': errors,
+            'throughput_per_s': round(len(values) / duration, 2) if duration else None,
+            'mean_ms': to_ms(sum(values) / len(values)) if values else None,
+            'p50_ms': to_ms(percentile(values, 0.50)),
+            'p95_ms': to_ms(percentile(values, 0.95)),
+            'p99_ms': to_ms(percentile(values, 0.99)),
+            'max_ms': to_ms(values[-1]) if values else None,
+        }
+    return events
+
+
+class LoadClient:
+    """一个模拟用户：独立的HTTP会话和Socket.IO连接"""
+
+    def __init__(self, base_url, name, recorder, timeout):
+        self.base_url = base_url
+        self.name = name
+        self.recorder = recorder
+        self.timeout = timeout
+        self.events = queue.Queue()
+        self.sio = socketio.Client(reconnection=False)
+        for event in ('connected', 'message_sent', 'message_chunk', 'new_message', 'unread_update', 'error'):
+            self.sio.on(event, self._handler(event))
+
+    def _handler(self, event):
+        return lambda data=None: self.events.put((event, data, time.perf_counter()))
+
+    def wait_for(self, event, deadline, on_other=None):
+        """等待指定事件，期间收到的其他事件交给on_other；服务端返回error时抛出RuntimeError"""
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise TimeoutError(event)
+            name, data, at = self.events.get(timeout=remaining)
+            if name == event:
+                return data, at
+            if name == 'error':
+                raise RuntimeError((data or {}).get('message', 'error'))
+            if on_other:
+                on_other(name, data, at)
+
+    def login(self):
+        http = requests.Session()
+        start = time.perf_counter()
+        http.post(f'{self.base_url}/register', data={
+            'username': self.name, 'email': f'{self.name}@bench.local',
+            'password': 'bench-secret', 'confirm_password': 'bench-secret'
+        }, timeout=self.timeout)
+        response = http.post(f'{self.base_url}/login', data={'username': self.name, 'password': 'bench-secret'},
+                             timeout=self.timeout)
+        if 'session' not in http.cookies:
+            raise RuntimeError(f'login failed: HTTP {response.status_code}')
+        self.recorder.record('login', time.perf_counter() - start)
+        return '; '.join(f'{k}={v}' for k, v in http.cookies.items())
+
+    def run(self, messages, think_time, ready, start_event):
+        try:
+            cookie = self.login()
+            start = time.perf_counter()
+            self.sio.connect(self.base_url, headers={'Cookie': cookie}, transports=['websocket'],
+                             wait_timeout=self.timeout)
+            self.wait_for('connected', start + self.timeout)
+            self.recorder.record('connect', time.perf_counter() - start)
+        except Exception as e:
+            self.recorder.error('connect', type(e).__name__)
+            return
+        finally:
+            ready.release()
+        start_event.wait()
+
+        bot_id = 1
+        try:
+            for index in range(messages):
+                self._round_trip(index, bot_id)
+                if think_time:
+                    time.sleep(think_time)
+        finally:
+            self.sio.disconnect()
+
+    def _round_trip(self, index, bot_id):
+        first_chunk = []
+
+        def on_other(name, data, at):
+            if name == 'message_chunk' and not first_chunk:
+                first_chunk.append(at)
+
+        sent_at = time.perf_counter()
+        deadline = sent_at + self.timeout
+        stage = 'send_message'
+        try:
+            self.sio.emit('send_message', {'content': f'压测消息 {self.name} #{index}', 'recipient_id': bot_id,
+                                           'client_msg_id': f'{self.name}-{index}'})
+            _, at = self.wait_for('message_sent', deadline, on_other)
+            self.recorder.record('send_message', at - sent_at)
+
+            stage = 'ai_reply'
+            reply, at = self.wait_for('new_message', deadline, on_other)
+            self.recorder.record('ai_reply', at - sent_at)
+            if first_chunk:
+                self.recorder.record('first_chunk', first_chunk[0] - sent_at)
+
+            stage = 'mark_read'
+            read_at = time.perf_counter()
+            self.sio.emit('mark_read', {'sender_id': reply['sender_id'], 'up_to_id': reply['id']})
+            self.wait_for('unread_update', read_at + self.timeout, on_other)
+            self.recorder.record('mark_read', time.perf_counter() - read_at)
+        except (TimeoutError, queue.Empty):
+            self.recorder.error(stage, 'timeout')
+        except Exception as e:
+            self.recorder.error(stage, str(e)[:80])
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+def compare(report, baseline_path):
+    """与之前的结果对比各事件的p50/p95"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    print(f"\ncompared with {baseline_path} (commit {baseline.get('commit')}):")
+    for event, current in report['events'].items():
+        previous = baseline.get('events', {}).get(event)
+        if not previous:
+            continue
+        for key in ('p50_ms', 'p95_ms', 'throughput_per_s'):
+            old, new = previous.get(key), current.get(key)
+            if old and new:
+                print(f'  {event:<14} {key:<17} {old:>10} -> {new:<10} ({(new - old) / old * 100:+.1f}%)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='聊天链路压测')
+    parser.add_argument('--clients', type=int, default=10, help='并发客户端数')
+    parser.add_argument('--messages', type=int, default=5, help='每个客户端发送的消息数')
+    parser.add_argument('--think-time', type=float, default=0.0, help='两条消息之间的间隔（秒）')
+    parser.add_argument('--timeout', type=float, default=60.0, help='单次请求的超时（秒）')
+    parser.add_argument('--streaming', action='store_true', help='启用流式回复（AI_STREAMING=1）')
+    parser.add_argument('--target', help='压测已启动的服务，例如 http://127.0.0.1:5000')
+    parser.add_argument('--output', help='结果文件路径，默认保存到 bench/results/')
+    parser.add_argument('--compare', help='与之前保存的结果对比')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    llm_stats = worker = None
+    if args.target:
+        base_url = args.target.rstrip('/')
+    else:
+        _, llm_url, llm_stats = start_fake_llm(config_from_args(args))
+        port = free_port()
+        env = dict(os.environ,
+                   DATABASE_URL=f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'load_test.db')}",
+                   DEEPSEEK_BASE_URL=llm_url,
+                   DEEPSEEK_API_KEY='bench',
+                   AI_STREAMING='1' if args.streaming else '0',
+                   SECRET_KEY='load-test')
+        worker = start_worker(port, env)
+        base_url = f'http://127.0.0.1:{port}'
+
+    recorder = Recorder()
+    ready = threading.Semaphore(0)
+    start_event = threading.Event()
+    run_id = uuid.uuid4().hex[:6]
+    clients = [LoadClient(base_url, f'load_{run_id}_{i}', recorder, args.timeout) for i in range(args.clients)]
+    threads = [threading.Thread(target=client.run, args=(args.messages, args.think_time, ready, start_event))
+               for client in clients]
+    try:
+        for thread in threads:
+            thread.start()
+        # 等所有客户端登录、连接完成后同时开始发送
+        for _ in clients:
+            ready.acquire()
+        started = time.perf_counter()
+        start_event.set()
+        for thread in threads:
+            thread.join()
+        duration = time.perf_counter() - started
+    finally:
+        if worker is not None:
+            worker.terminate()
+            worker.wait()
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'config': vars(args),
+        'duration_s': round(duration, 3),
+        'events': summarize(recorder, duration),
+        'fake_llm': llm_stats.snapshot() if llm_stats else None,
+    }
+
+    print(f"{args.clients} clients x {args.messages} messages in {report['duration_s']}s")
+    print(f"{'event':<14}{'count':>7}{'errors':>8}{'rate/s':>9}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for event, s in report['events'].items():
+        print(f"{event:<14}{s['count']:>7}{s['errors']:>8}{s['throughput_per_s'] or 0:>9}"
+              f"{s['p50_ms'] or '-':>10}{s['p95_ms'] or '-':>10}{s['p99_ms'] or '-':>10}{s['max_ms'] or '-':>10}")
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"load-{report['commit'] or 'local'}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f'results saved to {output}')
+
+    if args.compare:
+        compare(report, args.compare)
+    failed = sum(s['errors'] for s in report['events'].values())
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
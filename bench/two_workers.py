@@ -0,0 +1,92 @@
+"""启动两个工作进程，验证emit能跨进程送达
+
+用法：python bench/two_workers.py
+
+通过内置IPC广播服务连接两个工作进程，同一用户的两台设备分别连到不同进程；
+设备A标记已读后，设备B应当收到另一个进程发出的unread_update。
+"""
+import os
+import sys
+import time
+import socket
+import tempfile
+import threading
+import subprocess
+
+import requests
+import socketio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ipc_manager import IPCBroker  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_worker(port, env):
+    code = 'from app import app, socketio; socketio.run(app, port=%d, allow_unsafe_werkzeug=True)' % port
+    proc = subprocess.Popen([sys.executable, '-c', code], cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            requests.get(f'http://127.0.0.1:{port}/login', timeout=1)
+            return proc
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError(f'worker on port {port} did not start')
+
+
+def check_cross_worker():
+    """启动广播服务和两个工作进程，返回设备B是否收到了另一个进程发出的事件"""
+    broker_port = IPCBroker(port=0).start()
+    db_file = os.path.join(tempfile.mkdtemp(), 'two_workers.db')
+    env = dict(os.environ,
+               DATABASE_URL=f'sqlite:///{db_file}',
+               SOCKETIO_MESSAGE_QUEUE=f'ipc://127.0.0.1:{broker_port}',
+               SECRET_KEY='two-workers-check')
+
+    port_a, port_b = free_port(), free_port()
+    workers = [start_worker(port_a, env)]
+    workers.append(start_worker(port_b, env))
+    try:
+        http = requests.Session()
+        http.post(f'http://127.0.0.1:{port_a}/register', data={
+            'username': 'fanout', 'email': 'fanout@example.com',
+            'password': 'secret', 'confirm_password': 'secret'
+        })
+        http.post(f'http://127.0.0.1:{port_a}/login', data={'username': 'fanout', 'password': 'secret'})
+        cookie = '; '.join(f'{k}={v}' for k, v in http.cookies.items())
+
+        received = threading.Event()
+        device_a, device_b = socketio.Client(), socketio.Client()
+        device_b.on('unread_update', lambda data: received.set())
+        device_a.connect(f'http://127.0.0.1:{port_a}', headers={'Cookie': cookie}, transports=['websocket'])
+        device_b.connect(f'http://127.0.0.1:{port_b}', headers={'Cookie': cookie}, transports=['websocket'])
+        time.sleep(0.5)
+
+        device_a.emit('mark_read', {'sender_id': 1})
+        ok = received.wait(5)
+        device_a.disconnect()
+        device_b.disconnect()
+    finally:
+        for proc in workers:
+            proc.terminate()
+            proc.wait()
+    return ok
+
+
+def main():
+    ok = check_cross_worker()
+    print('cross-worker emit: ' + ('OK' if ok else 'FAILED'))
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
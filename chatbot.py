@@ -1,36 +1,150 @@
 import os
+import time
 import logging
-from openai import OpenAI, OpenAIError
+from openai import OpenAIError
 from flask import session, current_app
-from datetime import datetime
+from history_store import get_history_store
+from context_builder import ContextBuilder, message_tokens
+from response_cache import ResponseCache
+from llm_scheduler import LLMScheduler, SchedulerBusy
+from llm_client import get_llm_client, request_timeout
+from logging_config import redact
+from metrics import STAGE_SECONDS, LLM_FIRST_TOKEN_SECONDS, LLM_TOKENS, LLM_INFLIGHT, record_error
 
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger(__name__)
 
+SYSTEM_PROMPT = "你是一个友好、专业的AI助手。请用简洁、准确的方式回答问题。始终使用中文回复。"
+
 class AIChat:
-    def __init__(self):
-        # 从环境变量获取API密钥，如果没有则使用默认值
-        self.api_key = os.getenv('DEEPSEEK_API_KEY', "sk-4c0e05f2a6ac46ed80426276b1c255eb")
-        try:
-            self.client = OpenAI(
-                api_key=self.api_key,
-                base_url="https://api.deepseek.com"
-            )
-            logger.info("AI Chat initialized successfully")
-        except Exception as e:
-            logger.error(f"Failed to initialize AI Chat: {str(e)}")
-            raise
-        self.conversation_history = {}
+    def __init__(self, history_store=None):
+        self.model = "deepseek-chat"
+        # 每次请求都带上超时，上游卡住时不会一直占用工作线程
+        self.timeout = request_timeout()
+        # 采样参数，同时参与回复缓存的键
+        self.params = {
+            "max_tokens": 500,
+            "temperature": float(os.getenv('AI_TEMPERATURE', 0.7)),
+            "presence_penalty": 0.6,
+            "frequency_penalty": 0.6
+        }
+        # 限流、公平排队和失败重试
+        self.scheduler = LLMScheduler.from_env()
+        # 可选的回复缓存，用于大量重复的常见问题
+        self.cache = ResponseCache.from_env()
+        # 会话历史由共享存储管理，多个AIChat实例之间共用
+        self.history = history_store if history_store is not None else get_history_store()
+        # 按token预算组装上下文，可选把较早的对话折叠成摘要
+        self.context = ContextBuilder(
+            max_tokens=int(os.getenv('AI_CONTEXT_MAX_TOKENS', 2000)),
+            summarizer=self._summarize if os.getenv('AI_CONTEXT_SUMMARY', '0') == '1' else None,
+            summary_max_tokens=int(os.getenv('AI_CONTEXT_SUMMARY_TOKENS', 300)),
+            summary_min_turns=int(os.getenv('AI_CONTEXT_SUMMARY_EVERY', 6))
+        )
+
+    @property
+    def client(self):
+        """进程内共享的大模型客户端，第一次发起请求时才创建"""
+        return get_llm_client()
+
+    def _prepare_messages(self, user_id, message):
+        """记录用户消息并构造发送给AI的消息列表"""
+        # 添加用户消息到历史记录，存储会自动保留最近的若干条；
+        # 直接使用追加后的结果，其间其他设备写入新消息触发重新加载时也不会丢掉这条
+        history = self.history.append(user_id, "user", message)
+        
+        messages, stats = self.context.build(user_id, SYSTEM_PROMPT, history)
+        logger.debug("Context for user %s: %d tokens (%d kept, %d dropped)", user_id, stats['prompt_tokens'],
+                     stats['messages_included'], stats['messages_dropped'])
+        return messages
+
+    def _summarize(self, user_id, previous_summary, turns):
+        """把较早的对话压缩成摘要，计入该用户的排队和token用量"""
+        dialogue = "\n".join(
+            f"{'用户' if msg['role'] == 'user' else 'AI助手'}：{msg['content']}" for msg in turns
+        )
+        if previous_summary:
+            dialogue = f"已有摘要：{previous_summary}\n\n新的对话：\n{dialogue}"
+        response, estimated = self._create(
+            user_id,
+            [
+                {"role": "system", "content": "请把下面的对话压缩成简短的中文摘要，保留关键事实和用户偏好。"},
+                {"role": "user", "content": dialogue}
+            ],
+            max_tokens=self.context.summary_max_tokens,
+            temperature=0.3
+        )
+        self._record_usage(user_id, getattr(response, 'usage', None), estimated)
+        return response.choices[0].message.content
+
+    def _create(self, user_id, messages, stream=False, **params):
+        """经调度器发起一次对话补全请求
+
+        流式请求返回时进行中的调用数尚未减回，由调用方在流结束后处理。
+
+        Returns:
+            tuple: (响应或流, 预估的token数)
+        """
+        estimated = sum(message_tokens(msg) for msg in messages) + params.get('max_tokens', 0)
+        options = {'stream': True, 'stream_options': {"include_usage": True}} if stream else {}
+
+        def call():
+            LLM_INFLIGHT.inc()
+            try:
+                response = self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    timeout=self.timeout,
+                    **options,
+                    **params
+                )
+            except Exception:
+                LLM_INFLIGHT.dec()
+                raise
+            if not stream:
+                LLM_INFLIGHT.dec()
+            return response
+
+        return self.scheduler.run(user_id, call, estimated), estimated
+
+    def _record_usage(self, user_id, usage, estimated=0):
+        """记录API返回的实际token用量"""
+        if usage is None:
+            return
+        self.scheduler.settle(estimated, usage.total_tokens)
+        LLM_TOKENS.inc(usage.prompt_tokens, kind='prompt')
+        LLM_TOKENS.inc(usage.completion_tokens, kind='completion')
+        self.context.record(user_id, {
+            'api_prompt_tokens': usage.prompt_tokens,
+            'completion_tokens': usage.completion_tokens
+        })
+
+    def _cache_key(self, messages):
+        """计算缓存键，未启用缓存或需要多样性时返回None"""
+        if self.cache is None or not self.cache.should_cache(self.params):
+            return None
+        return self.cache.make_key(self.model, messages, self.params)
+
+    def get_context_stats(self, user_id):
+        """获取用户最近一次请求的上下文token统计"""
+        return self.context.stats(user_id)
 
-    def _clean_history(self, user_id):
-        """清理超过10条的历史记录"""
-        if len(self.conversation_history[user_id]) > 10:
-            self.conversation_history[user_id] = self.conversation_history[user_id][-10:]
-            logger.info(f"Cleaned history for user {user_id}, now has {len(self.conversation_history[user_id])} messages")
+    def _add_assistant_message(self, user_id, ai_message):
+        """添加AI响应到历史记录"""
+        self.history.append(user_id, "assistant", ai_message)
+
+    def format_error(self, e):
+        """将API异常转换为给用户看的提示"""
+        if isinstance(e, SchedulerBusy):
+            return "服务请求过于频繁，请稍后再试"
+        if isinstance(e, OpenAIError):
+            error_message = str(e)
+            if "rate_limit" in error_message.lower():
+                return "服务请求过于频繁，请稍后再试"
+            elif "connection" in error_message.lower():
+                return "网络连接出现问题，请检查网络连接"
+            else:
+                return f"AI服务出现错误：{error_message}"
+        return "AI服务暂时不可用，请稍后再试"
 
     def get_response(self, user_id, message):
         """获取AI响应"""
@@ -39,85 +153,124 @@ class AIChat:
             return "消息内容或用户ID不能为空"
 
         try:
-            logger.info(f"Processing message from user {user_id}: {message[:50]}...")
-            
-            # 初始化或获取会话历史
-            if user_id not in self.conversation_history:
-                self.conversation_history[user_id] = []
-                logger.info(f"Created new conversation history for user {user_id}")
-            
-            # 添加用户消息到历史记录
-            self.conversation_history[user_id].append({
-                "role": "user",
-                "content": message,
-                "timestamp": datetime.utcnow().isoformat()
-            })
+            logger.debug("Processing message from user %s: %s", user_id, redact(message))
             
-            # 清理历史记录
-            self._clean_history(user_id)
+            messages = self._prepare_messages(user_id, message)
             
-            # 准备消息列表
-            messages = [
-                {
-                    "role": "system", 
-                    "content": "你是一个友好、专业的AI助手。请用简洁、准确的方式回答问题。始终使用中文回复。"
-                }
-            ]
-            messages.extend([
-                {"role": msg["role"], "content": msg["content"]} 
-                for msg in self.conversation_history[user_id]
-            ])
+            # 优先使用缓存的回复
+            cache_key = self._cache_key(messages)
+            if cache_key:
+                cached = self.cache.get(cache_key)
+                if cached:
+                    logger.info(f"Response cache hit for user {user_id}")
+                    self._add_assistant_message(user_id, cached)
+                    return cached
             
             # 调用AI API
-            logger.info("Calling AI API...")
+            logger.debug("Calling AI API")
             try:
-                response = self.client.chat.completions.create(
-                    model="deepseek-chat",
-                    messages=messages,
-                    max_tokens=500,
-                    temperature=0.7,
-                    presence_penalty=0.6,
-                    frequency_penalty=0.6
-                )
+                with STAGE_SECONDS.time(stage='llm'):
+                    response, estimated = self._create(user_id, messages, **self.params)
                 
                 # 提取响应文本
                 ai_message = response.choices[0].message.content
+                self._record_usage(user_id, getattr(response, 'usage', None), estimated)
                 if not ai_message:
                     raise ValueError("Empty response from AI")
                     
-                logger.info(f"Got AI response: {ai_message[:50]}...")
+                logger.debug("Got AI response: %s", redact(ai_message))
                 
-                # 添加AI响应到历史记录
-                self.conversation_history[user_id].append({
-                    "role": "assistant",
-                    "content": ai_message,
-                    "timestamp": datetime.utcnow().isoformat()
-                })
+                self._add_assistant_message(user_id, ai_message)
+                if cache_key:
+                    self.cache.set(cache_key, ai_message)
                 
                 return ai_message
                 
             except OpenAIError as e:
                 logger.error(f"OpenAI API error: {str(e)}", exc_info=True)
-                error_message = str(e)
-                if "rate_limit" in error_message.lower():
-                    return "服务请求过于频繁，请稍后再试"
-                elif "connection" in error_message.lower():
-                    return "网络连接出现问题，请检查网络连接"
-                else:
-                    return f"AI服务出现错误：{error_message}"
+                record_error('llm', e)
+                return self.format_error(e)
             except Exception as e:
                 logger.error(f"Unexpected error in API call: {str(e)}", exc_info=True)
-                return "AI服务暂时不可用，请稍后再试"
+                record_error('llm', e)
+                return self.format_error(e)
             
         except Exception as e:
             logger.error(f"Error in get_response: {str(e)}", exc_info=True)
             return "系统处理出现错误，请稍后重试"
 
+    def stream_response(self, user_id, message, cancel_event=None):
+        """流式获取AI响应，逐段产出文本
+
+        Args:
+            user_id: 用户ID
+            message: 用户消息
+            cancel_event: threading.Event，被设置后立即停止接收并关闭上游连接
+
+        Yields:
+            str: AI响应的增量文本
+
+        API调用失败时抛出异常，由调用方负责提示用户。
+        """
+        if not message or not user_id:
+            raise ValueError("消息内容或用户ID不能为空")
+
+        logger.debug("Streaming message from user %s: %s", user_id, redact(message))
+        messages = self._prepare_messages(user_id, message)
+
+        cache_key = self._cache_key(messages)
+        if cache_key:
+            cached = self.cache.get(cache_key)
+            if cached:
+                logger.info(f"Response cache hit for user {user_id}")
+                self._add_assistant_message(user_id, cached)
+                yield cached
+                return
+
+        start = time.perf_counter()
+        try:
+            stream, estimated = self._create(user_id, messages, stream=True, **self.params)
+        except Exception:
+            STAGE_SECONDS.observe(time.perf_counter() - start, stage='llm')
+            raise
+
+        parts = []
+        completed = False
+        try:
+            for chunk in stream:
+                if cancel_event is not None and cancel_event.is_set():
+                    logger.info(f"Stream cancelled for user {user_id}")
+                    break
+                if getattr(chunk, 'usage', None):
+                    self._record_usage(user_id, chunk.usage, estimated)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if not parts:
+                        LLM_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - start)
+                    parts.append(delta)
+                    yield delta
+            else:
+                completed = True
+        finally:
+            # 关闭连接，取消后不再为没人读的token付费
+            stream.close()
+            LLM_INFLIGHT.dec()
+            STAGE_SECONDS.observe(time.perf_counter() - start, stage='llm')
+            ai_message = ''.join(parts)
+            if ai_message:
+                logger.debug("Got streamed AI response: %s", redact(ai_message))
+                self._add_assistant_message(user_id, ai_message)
+                # 只缓存完整的回复
+                if cache_key and completed:
+                    self.cache.set(cache_key, ai_message)
+
     def clear_history(self, user_id):
         """清除用户的对话历史"""
         try:
-            if user_id in self.conversation_history:
-                self.conversation_history.pop(user_id)
+            self.context.forget(user_id)
+            if self.history.clear(user_id):
                 logger.info(f"Cleared conversation history for user {user_id}")
                 return True
             logger.info(f"No history found for user {user_id}")
@@ -126,10 +279,5 @@ class AIChat:
             logger.error(f"Error clearing history for user {user_id}: {str(e)}", exc_info=True)
             return False
 
-# 创建全局实例
-try:
-    ai_chat = AIChat()
-    logger.info("Global AI Chat instance created successfully")
-except Exception as e:
-    logger.error(f"Failed to create global AI Chat instance: {str(e)}")
-    raise
+# 创建全局实例，不会访问网络，客户端在第一次请求时才创建
+ai_chat = AIChat()
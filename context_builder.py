@@ -0,0 +1,170 @@
+import hashlib
+import logging
+import math
+import threading
+from collections import OrderedDict
+
+try:
+    import tiktoken
+except ImportError:  # 未安装时使用长度估算
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# 每条消息在对话格式中的固定开销（角色标记、分隔符等）
+MESSAGE_OVERHEAD = 4
+
+_encoding = None
+
+
+def _is_cjk(ch):
+    code = ord(ch)
+    return (0x4E00 <= code <= 0x9FFF or 0x3400 <= code <= 0x4DBF or
+            0x3000 <= code <= 0x303F or 0xFF00 <= code <= 0xFFEF)
+
+
+def estimate_tokens(text):
+    """估算文本的token数
+
+    安装了tiktoken时使用本地分词器，否则按字符估算：
+    中文字符约0.6个token，其他字符约4个字符一个token。
+    """
+    if not text:
+        return 0
+    global _encoding
+    if tiktoken is not None:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding('cl100k_base')
+        return len(_encoding.encode(text))
+    cjk = sum(1 for ch in text if _is_cjk(ch))
+    return math.ceil(cjk * 0.6 + (len(text) - cjk) / 4)
+
+
+def message_tokens(message):
+    """单条消息的token数（含格式开销）"""
+    return estimate_tokens(message["content"]) + MESSAGE_OVERHEAD
+
+
+def _fingerprint(message):
+    raw = f'{message.get("timestamp")}|{message["role"]}|{message["content"]}'
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+class ContextBuilder:
+    """按token预算组装发送给AI的上下文
+
+    从最新的消息开始向前装入，直到用完预算；装不下的旧消息会被丢弃，
+    配置了summarizer时则折叠进按用户缓存的滚动摘要。摘要需要一次额外的大模型调用，
+    新挤出预算的消息攒够summary_min_turns条才重新生成，其间沿用上一次的摘要。
+    """
+
+    def __init__(self, max_tokens=2000, summarizer=None, summary_max_tokens=300, summary_min_turns=6,
+                 max_users=1000):
+        self.max_tokens = max_tokens
+        self.summarizer = summarizer
+        self.summary_max_tokens = summary_max_tokens
+        self.summary_min_turns = summary_min_turns
+        self.max_users = max_users
+        self._summaries = OrderedDict()  # user_id -> (已折叠消息指纹集合, 摘要文本)
+        self._stats = OrderedDict()  # user_id -> 最近一次请求的统计
+        self._totals = {'requests': 0, 'prompt_tokens': 0, 'history_tokens': 0}
+        self._lock = threading.Lock()
+
+    def build(self, user_id, system_prompt, history):
+        """组装上下文
+
+        Args:
+            user_id: 用户ID
+            system_prompt: 系统提示词
+            history: 按时间排列的历史消息，最后一条为当前用户消息
+
+        Returns:
+            tuple: (messages列表, 统计信息字典)
+        """
+        system = {"role": "system", "content": system_prompt}
+        budget = self.max_tokens - message_tokens(system)
+        history_tokens = sum(message_tokens(msg) for msg in history)
+
+        # 预留摘要的空间
+        if self.summarizer and history_tokens > budget:
+            budget -= self.summary_max_tokens
+
+        packed = []
+        used = 0
+        for msg in reversed(history):
+            tokens = message_tokens(msg)
+            # 当前消息即使超出预算也必须保留
+            if packed and used + tokens > budget:
+                break
+            packed.append(msg)
+            used += tokens
+        packed.reverse()
+        dropped = history[:len(history) - len(packed)]
+
+        messages = [system]
+        summary = None
+        if dropped and self.summarizer:
+            summary = self._rolling_summary(user_id, dropped)
+            if summary:
+                messages.append({"role": "system", "content": f"之前对话的摘要：{summary}"})
+        messages.extend({"role": msg["role"], "content": msg["content"]} for msg in packed)
+
+        prompt_tokens = sum(message_tokens(msg) for msg in messages)
+        stats = {
+            'prompt_tokens': prompt_tokens,
+            'history_tokens': history_tokens + message_tokens(system),
+            'messages_included': len(packed),
+            'messages_dropped': len(dropped),
+            'summarized': bool(summary)
+        }
+        self.record(user_id, stats)
+        return messages, stats
+
+    def _rolling_summary(self, user_id, dropped):
+        """把新被挤出预算的消息并入该用户的滚动摘要"""
+        with self._lock:
+            covered, summary = self._summaries.get(user_id, (frozenset(), None))
+        fresh = [msg for msg in dropped if _fingerprint(msg) not in covered]
+        if len(fresh) < self.summary_min_turns:
+            return summary
+
+        try:
+            summary = self.summarizer(user_id, summary, fresh)
+        except Exception as e:
+            logger.error(f"Failed to summarize history for user {user_id}: {str(e)}", exc_info=True)
+            return summary
+
+        with self._lock:
+            # 只保留仍在历史中的指纹，避免集合无限增长
+            self._summaries[user_id] = (frozenset(_fingerprint(msg) for msg in dropped), summary)
+            self._summaries.move_to_end(user_id)
+            while len(self._summaries) > self.max_users:
+                self._summaries.popitem(last=False)
+        return summary
+
+    def record(self, user_id, stats):
+        """记录统计信息，API返回的usage会合并进同一条记录"""
+        with self._lock:
+            self._stats[user_id] = dict(self._stats.get(user_id, {}), **stats)
+            self._stats.move_to_end(user_id)
+            while len(self._stats) > self.max_users:
+                self._stats.popitem(last=False)
+            if 'history_tokens' in stats:
+                self._totals['requests'] += 1
+                self._totals['prompt_tokens'] += stats['prompt_tokens']
+                self._totals['history_tokens'] += stats['history_tokens']
+
+    def forget(self, user_id):
+        """清除用户的摘要缓存"""
+        with self._lock:
+            self._summaries.pop(user_id, None)
+
+    def stats(self, user_id):
+        """用户最近一次请求的上下文统计"""
+        with self._lock:
+            return dict(self._stats.get(user_id, {}))
+
+    def totals(self):
+        """累计统计：请求数、实际发送的prompt token数、不裁剪时需要发送的token数"""
+        with self._lock:
+            return dict(self._totals)
@@ -0,0 +1,117 @@
+import os
+import logging
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+INSTANCE_DIR = os.path.join(BASE_DIR, 'instance')
+DEFAULT_DATABASE_URL = 'sqlite:///chat.db'
+
+# SQLite连接参数：WAL模式下读写互不阻塞，写事务只追加WAL日志
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'FULL',  # 每次提交都落盘，批量提交分摊fsync开销
+    'busy_timeout': 5000,  # 遇到写锁时等待的毫秒数，而不是立即报 database is locked
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -20000,  # 负数表示KB
+    'temp_store': 'MEMORY',
+}
+
+
+def get_database_uri():
+    """从DATABASE_URL读取数据库地址
+
+    SQLite的相对路径统一解析到instance目录下，保证应用和各个脚本打开的是同一个文件。
+    """
+    url = make_url(os.getenv('DATABASE_URL', DEFAULT_DATABASE_URL))
+    if url.get_backend_name() == 'sqlite' and url.database and url.database != ':memory:' \
+            and not os.path.isabs(url.database):
+        os.makedirs(INSTANCE_DIR, exist_ok=True)
+        url = url.set(database=os.path.join(INSTANCE_DIR, url.database))
+    return url.render_as_string(hide_password=False)
+
+
+def get_sqlite_pragmas():
+    """SQLite PRAGMA配置，可通过环境变量覆盖"""
+    return {
+        'journal_mode': os.getenv('SQLITE_JOURNAL_MODE', SQLITE_PRAGMAS['journal_mode']),
+        'synchronous': os.getenv('SQLITE_SYNCHRONOUS', SQLITE_PRAGMAS['synchronous']),
+        'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT', SQLITE_PRAGMAS['busy_timeout'])),
+        'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', SQLITE_PRAGMAS['mmap_size'])),
+        'cache_size': int(os.getenv('SQLITE_CACHE_SIZE', SQLITE_PRAGMAS['cache_size'])),
+        'temp_store': SQLITE_PRAGMAS['temp_store'],
+    }
+
+
+def get_engine_options(uri):
+    """连接池参数
+
+    内存SQLite使用单连接池，不接受连接池大小等参数；
+    文件SQLite和服务器数据库使用QueuePool。
+    """
+    url = make_url(uri)
+    if url.get_backend_name() == 'sqlite':
+        if not url.database or url.database == ':memory:':
+            return {}
+        options = {
+            # 连接可能被批量写入线程等其他线程复用
+            'connect_args': {'check_same_thread': False},
+        }
+    else:
+        options = {
+            'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', '1') == '1',
+        }
+    options.update({
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 20)),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+        'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', 30)),
+    })
+    return options
+
+
+def apply_sqlite_pragmas(engine, pragmas=None):
+    """为SQLite引擎的每个新连接设置PRAGMA，其他数据库不做处理"""
+    if engine.dialect.name != 'sqlite':
+        return
+    pragmas = dict(get_sqlite_pragmas(), **(pragmas or {}))
+
+    @event.listens_for(engine, 'connect')
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f'PRAGMA {name}={value}')
+        finally:
+            cursor.close()
+
+    # 连接池中已有的连接不会再触发connect事件，直接丢弃
+    engine.dispose()
+    logger.info('SQLite pragmas applied: %s', pragmas)
+
+
+def init_database(app, db):
+    """配置并初始化数据库
+
+    Args:
+        app: Flask应用实例
+        db: Flask-SQLAlchemy实例
+    """
+    uri = get_database_uri()
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = get_engine_options(uri)
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    with app.app_context():
+        apply_sqlite_pragmas(db.engine)
+
+
+def create_standalone_engine():
+    """创建与应用配置一致的引擎，供迁移等不需要启动应用的脚本使用"""
+    uri = get_database_uri()
+    engine = create_engine(uri, **get_engine_options(uri))
+    apply_sqlite_pragmas(engine)
+    return engine
@@ -0,0 +1,105 @@
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class AIDispatcher:
+    """AI回复调度器
+
+    把耗时的AI调用交给有界线程池执行，避免阻塞Socket.IO事件处理。
+    同时限制全局排队深度和单个用户同时进行的请求数。
+    """
+
+    def __init__(self, max_workers=4, max_queue=64, per_user_limit=2):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.per_user_limit = per_user_limit
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='ai-dispatch')
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._per_user = {}
+        self._claims = set()  # 正在处理的 (user_id, 去重键)
+
+    @classmethod
+    def from_config(cls, config):
+        """根据Flask配置创建调度器"""
+        return cls(
+            max_workers=config.get('AI_DISPATCH_WORKERS', 4),
+            max_queue=config.get('AI_DISPATCH_QUEUE_SIZE', 64),
+            per_user_limit=config.get('AI_DISPATCH_PER_USER', 2)
+        )
+
+    @property
+    def pending(self):
+        """当前排队及执行中的任务数"""
+        return self._pending
+
+    def claim(self, user_id, key):
+        """登记一个请求，同一用户相同的请求仍在处理中时返回False
+
+        登记在对应任务结束时（或调用release_claim时）解除，用于过滤重复提交。
+        """
+        with self._lock:
+            if (user_id, key) in self._claims:
+                return False
+            self._claims.add((user_id, key))
+            return True
+
+    def release_claim(self, user_id, key):
+        with self._lock:
+            self._claims.discard((user_id, key))
+
+    def submit(self, user_id, fn, *args, dedup_key=None, **kwargs):
+        """提交任务
+
+        Args:
+            user_id: 发起请求的用户ID，用于单用户限流
+            fn: 在后台执行的函数
+            dedup_key: 通过claim登记的去重键，任务结束后自动解除
+
+        Returns:
+            bool: 任务被接受返回True，队列已满或超出单用户限制返回False
+        """
+        with self._lock:
+            if self._pending >= self.max_queue:
+                logger.warning('AI调度队列已满: %d', self._pending)
+                return False
+            if self._per_user.get(user_id, 0) >= self.per_user_limit:
+                logger.warning('用户 %s 的并发AI请求超出限制', user_id)
+                return False
+            self._pending += 1
+            self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+
+        try:
+            self._executor.submit(self._run, user_id, fn, args, kwargs, dedup_key)
+        except RuntimeError:
+            # 线程池已关闭
+            self._release(user_id)
+            return False
+        return True
+
+    def _run(self, user_id, fn, args, kwargs, dedup_key=None):
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            logger.error('后台AI任务执行失败: %s', str(e), exc_info=True)
+        finally:
+            self._release(user_id)
+            if dedup_key is not None:
+                self.release_claim(user_id, dedup_key)
+
+    def _release(self, user_id):
+        with self._lock:
+            self._pending -= 1
+            count = self._per_user.get(user_id, 0) - 1
+            if count > 0:
+                self._per_user[user_id] = count
+            else:
+                self._per_user.pop(user_id, None)
+
+    def shutdown(self, wait=True):
+        """关闭线程池"""
+        self._executor.shutdown(wait=wait)
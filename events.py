@@ -1,17 +1,30 @@
-from flask import session
-from flask_socketio import emit
-from models import User, Message, db, init_ai_assistant
+from flask import session, request
+from flask_socketio import emit, join_room, leave_room
+from models import Message, GroupMessage, UnreadCounter, db, init_ai_assistant
 from datetime import datetime
+from openai import OpenAIError
 import json
+import time
 import logging
+import threading
+import uuid
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# 创建AI聊天实例
-from chatbot import AIChat
-ai_chat = AIChat()
+# 共用chatbot中的AI聊天实例
+from chatbot import ai_chat
+from dispatch import AIDispatcher
+from message_writer import MessageWriter
+from message_history import load_conversation_page
+from sync import load_sync_batch
+from user_cache import user_cache
+from presence import init_presence
+from logging_config import log_context, redact
+from group_chat import (group_room, is_member, user_group_ids, mark_group_read,
+                        group_unread_counts)
+from unread import mark_conversation_read, get_unread_counts
+from metrics import (STAGE_SECONDS, SOCKET_CONNECTIONS, AI_DISPATCH_PENDING, MESSAGE_WRITER_BACKLOG,
+                     ERRORS, record_error)
 
 def init_socket_events(app, socketio):
     """初始化Socket.IO事件
@@ -26,111 +39,293 @@ def init_socket_events(app, socketio):
         logger.error("Failed to initialize AI assistant user")
         raise RuntimeError("Failed to initialize AI assistant user")
 
+    # AI回复在后台线程池中执行，不占用Socket.IO工作线程
+    dispatcher = AIDispatcher.from_config(app.config)
+    # 并发写入的消息合并到同一事务提交
+    writer = MessageWriter.from_config(app).start()
+    AI_DISPATCH_PENDING.set_function(lambda: dispatcher.pending)
+    MESSAGE_WRITER_BACKLOG.set_function(lambda: writer.backlog)
+    # 在线状态只保存在内存中，变化合并后批量广播
+    presence = init_presence(app, socketio)
+
+    # 正在进行的流式回复，user_id -> threading.Event
+    active_streams = {}
+    streams_lock = threading.Lock()
+
+    def cancel_stream(user_id):
+        """取消用户正在进行的流式回复"""
+        with streams_lock:
+            cancel_event = active_streams.pop(user_id, None)
+        if cancel_event:
+            cancel_event.set()
+            logger.info('已取消用户 %s 的流式回复', user_id)
+
+    def register_stream(user_id, cancel_event):
+        """登记已提交的流式回复，同时中断该用户尚未结束的上一个回复"""
+        with streams_lock:
+            previous = active_streams.get(user_id)
+            active_streams[user_id] = cancel_event
+        if previous:
+            previous.set()
+            logger.info('已取消用户 %s 的流式回复', user_id)
+        return cancel_event
+
+    def stream_ai_reply(user_id, content, cancel_event):
+        """流式获取AI响应，逐段推送message_chunk
+
+        Returns:
+            tuple: (完整响应文本, stream_id, 是否被取消)
+        """
+        stream_id = uuid.uuid4().hex
+        parts = []
+        try:
+            for index, delta in enumerate(ai_chat.stream_response(user_id, content, cancel_event)):
+                parts.append(delta)
+                socketio.emit('message_chunk', {
+                    'stream_id': stream_id,
+                    'index': index,
+                    'content': delta
+                }, room=user_id)
+        finally:
+            with streams_lock:
+                if active_streams.get(user_id) is cancel_event:
+                    active_streams.pop(user_id)
+        return ''.join(parts), stream_id, cancel_event.is_set()
+
+    def generate_ai_reply(user_id, bot_id, content, cancel_event=None):
+        """在后台获取AI响应并推送到用户房间"""
+        # 后台线程没有请求上下文，日志的用户ID由log_context提供
+        with app.app_context(), log_context(user_id=user_id):
+            try:
+                stream_id, cancelled = None, False
+                if cancel_event is not None:
+                    ai_response, stream_id, cancelled = stream_ai_reply(user_id, content, cancel_event)
+                else:
+                    ai_response = ai_chat.get_response(user_id, content)
+                if not ai_response:
+                    if cancelled:
+                        return
+                    raise ValueError("AI response is empty")
+
+                logger.debug('获取到AI响应: %s', redact(ai_response))
+
+                # 创建并保存AI响应消息，流式回复只在结束时保存一次
+                with STAGE_SECONDS.time(stage='persist_reply'):
+                    payload = writer.write(
+                        Message,
+                        content=ai_response,
+                        message_type='text',
+                        sender_id=bot_id,
+                        recipient_id=user_id,
+                        status='sent',
+                        timestamp=datetime.utcnow()
+                    )
+                logger.debug('AI响应消息已保存', extra={'message_id': payload['id']})
+                # 回复已追加到本进程的历史缓存，登记后缓存不会因为这条消息重新加载
+                ai_chat.history.mark_written(user_id, payload['id'])
+
+                # 发送AI响应给用户
+                if stream_id:
+                    payload['stream_id'] = stream_id
+                    payload['cancelled'] = cancelled
+                with STAGE_SECONDS.time(stage='emit'):
+                    socketio.emit('new_message', payload, room=user_id)
+                logger.debug('AI响应已发送给用户', extra={'message_id': payload['id']})
+
+            except OpenAIError as e:
+                logger.error('AI接口调用失败: %s', str(e), exc_info=True)
+                if cancel_event is not None:
+                    # 非流式调用的错误已在AIChat中计数
+                    record_error('llm', e)
+                db.session.rollback()
+                socketio.emit('error', {'message': ai_chat.format_error(e)}, room=user_id)
+            except Exception as e:
+                logger.error('处理AI响应失败: %s', str(e), exc_info=True)
+                record_error('ai_reply', e)
+                db.session.rollback()
+                socketio.emit('error', {'message': str(e) if str(e) else 'AI响应失败，请稍后重试'},
+                              room=user_id)
+
     @socketio.on('connect')
-    def handle_connect():
-        logger.info('用户尝试连接，session: %s', session)
+    def handle_connect(auth=None):
+        logger.debug('用户尝试连接')
         if 'user_id' in session:
-            socketio.server.enter_room(session['user_id'])
+            # 会话用户来自缓存，已删除的用户拿着旧cookie不能再连接
+            if user_cache.get(session['user_id']) is None:
+                emit('error', {'message': '用户不存在，请重新登录'})
+                return False
+            join_room(session['user_id'])
+            for group_id in user_group_ids(session['user_id']):
+                join_room(group_room(group_id))
+            SOCKET_CONNECTIONS.inc()
+            presence.connect(session['user_id'], request.sid)
             emit('connected', {'user_id': session['user_id']})
             logger.info('用户已连接: %s', session['user_id'])
+            # 客户端在auth中带上同步游标（或本地最大消息ID），补发断线期间错过的内容
+            auth = auth if isinstance(auth, dict) else {}
+            emit_sync(auth.get('sync_cursor'), auth.get('last_message_id'))
         else:
             logger.warning('未登录用户尝试连接')
             emit('error', {'message': '请先登录后再聊天'})
 
+    def emit_sync(cursor=None, last_message_id=None):
+        try:
+            batch = load_sync_batch(session['user_id'], cursor, last_message_id)
+        except ValueError as e:
+            emit('error', {'message': str(e)})
+            return
+        except Exception as e:
+            logger.error('同步失败: %s', str(e), exc_info=True)
+            record_error('sync', e)
+            emit('error', {'message': '同步失败'})
+            return
+        emit('sync', batch)
+
+    @socketio.on('sync')
+    def handle_sync(data=None):
+        """has_more为真时客户端用返回的游标继续同步"""
+        if 'user_id' not in session:
+            emit('error', {'message': '请先登录'})
+            return
+        data = data or {}
+        emit_sync(data.get('cursor'), data.get('last_message_id'))
+
     @socketio.on('disconnect')
     def handle_disconnect():
         if 'user_id' in session:
-            socketio.server.leave_room(session['user_id'])
+            leave_room(session['user_id'])
+            SOCKET_CONNECTIONS.dec()
+            presence.disconnect(session['user_id'], request.sid)
+            # 回复推送到用户的所有设备，只有最后一个连接断开时才取消
+            # （登记表只知道本进程的连接，连在其他进程上的设备不会阻止取消）
+            if not presence.is_online(session['user_id']):
+                cancel_stream(session['user_id'])
             logger.info('用户已断开连接: %s', session['user_id'])
 
+    @socketio.on('heartbeat')
+    def handle_heartbeat():
+        """客户端定期发送（间隔应小于PRESENCE_TTL），保持在线状态"""
+        if 'user_id' in session:
+            presence.heartbeat(session['user_id'], request.sid)
+
+    @socketio.on('presence')
+    def handle_presence(data):
+        """查询一组用户的在线状态，只读内存"""
+        if 'user_id' not in session:
+            emit('error', {'message': '请先登录'})
+            return
+        try:
+            user_ids = [int(user_id) for user_id in (data or {}).get('user_ids', [])][:500]
+        except (TypeError, ValueError):
+            emit('error', {'message': '无效的用户ID'})
+            return
+        emit('presence', presence.online(user_ids))
+
     @socketio.on('send_message')
     def handle_message(data):
-        logger.info('收到消息: %s', data)
+        start = time.perf_counter()
         
         # 验证用户登录状态
         if 'user_id' not in session:
             logger.warning('未登录用户尝试发送消息')
             emit('error', {'message': '请先登录'})
             return
+        # 发消息也算一次心跳
+        presence.heartbeat(session['user_id'], request.sid)
         
         # 验证消息数据
         try:
             content = data.get('content')
             message_type = data.get('type', 'text')
             recipient_id = data.get('recipient_id')
+            # 图片、语音消息引用已上传文件的 /media/<hash> 地址
+            media_url = data.get('media_url') if message_type in ('image', 'voice') else None
             
-            if not content or not recipient_id:
-                logger.warning('消息数据不完整: content=%s, recipient_id=%s', content, recipient_id)
+            if media_url and not media_url.startswith('/media/'):
+                emit('error', {'message': '媒体地址无效'})
+                return
+            if not (content or media_url) or not recipient_id:
+                logger.warning('消息数据不完整: content=%s, recipient_id=%s', redact(content), recipient_id)
                 emit('error', {'message': '消息数据不完整'})
                 return
             
-            logger.info('消息内容验证通过，准备处理')
+            logger.debug('消息内容验证通过: type=%s, recipient_id=%s', message_type, recipient_id)
             
-            # 获取AI助手用户
-            ai_assistant = User.query.filter_by(username='AI助手').first()
+            # 获取AI助手用户（进程内缓存，不查询数据库）
+            ai_assistant = user_cache.get_bot()
             if not ai_assistant:
                 logger.error('未找到AI助手用户')
                 emit('error', {'message': '系统错误：AI助手未配置'})
                 return
             
-            logger.info('找到AI助手用户: %s', ai_assistant.id)
+            STAGE_SECONDS.observe(time.perf_counter() - start, stage='validate')
+
+            # 客户端重发同一条消息（如超时重试）时带相同的client_msg_id，上一次还在处理时直接忽略；
+            # 不带ID的消息不去重，内容相同的正常消息（如连续发两次“好的”）不会被误判
+            dedup_key = data.get('client_msg_id')
+            if not isinstance(dedup_key, str) or not 0 < len(dedup_key) <= 64:
+                dedup_key = None
+            if dedup_key and not dispatcher.claim(session['user_id'], dedup_key):
+                logger.info('忽略用户 %s 重复提交的消息', session['user_id'])
+                emit('message_duplicate', {'client_msg_id': dedup_key})
+                return
             
-            # 创建并保存用户消息
+            # 创建并保存用户消息，与其他并发消息一起批量提交
             try:
-                user_message = Message(
-                    content=content,
-                    message_type=message_type,
-                    sender_id=session['user_id'],
-                    recipient_id=ai_assistant.id,
-                    status='sent',
-                    timestamp=datetime.utcnow()
-                )
-                db.session.add(user_message)
-                db.session.commit()
-                logger.info('用户消息已保存')
+                with STAGE_SECONDS.time(stage='persist_user'):
+                    user_message = writer.write(
+                        Message,
+                        content=content,
+                        message_type=message_type,
+                        media_url=media_url,
+                        sender_id=session['user_id'],
+                        recipient_id=ai_assistant.id,
+                        status='sent',
+                        timestamp=datetime.utcnow()
+                    )
+                logger.debug('用户消息已保存', extra={'message_id': user_message['id']})
                 
-                # 发送消息确认
-                emit('message_sent', user_message.to_dict())
+                # 批次提交后才发送消息确认
+                with STAGE_SECONDS.time(stage='emit'):
+                    emit('message_sent', user_message)
                 
             except Exception as e:
                 logger.error('保存用户消息失败: %s', str(e), exc_info=True)
-                db.session.rollback()
+                record_error('persist_user', e)
+                if dedup_key:
+                    dispatcher.release_claim(session['user_id'], dedup_key)
                 emit('error', {'message': '消息发送失败'})
                 return
             
-            # 获取AI响应
-            try:
-                ai_response = ai_chat.get_response(session['user_id'], content)
-                if not ai_response:
-                    raise ValueError("AI response is empty")
-                    
-                logger.info('获取到AI响应: %s', ai_response[:50])
-                
-                # 创建并保存AI响应消息
-                ai_message = Message(
-                    content=ai_response,
-                    message_type='text',
-                    sender_id=ai_assistant.id,
-                    recipient_id=session['user_id'],
-                    status='sent',
-                    timestamp=datetime.utcnow()
-                )
-                db.session.add(ai_message)
-                db.session.commit()
-                logger.info('AI响应消息已保存')
-                
-                # 发送AI响应给用户
-                emit('new_message', ai_message.to_dict(), room=session['user_id'])
-                logger.info('AI响应已发送给用户')
-                
-            except Exception as e:
-                logger.error('处理AI响应失败: %s', str(e), exc_info=True)
-                db.session.rollback()
-                emit('error', {'message': str(e) if str(e) else 'AI响应失败，请稍后重试'})
+            # AI助手只处理文字内容
+            if not content:
+                if dedup_key:
+                    dispatcher.release_claim(session['user_id'], dedup_key)
                 return
+
+            cancel_event = threading.Event() if app.config.get('AI_STREAMING') else None
+
+            # 这条消息由本进程的AI任务追加到历史缓存，在任务开始前登记；
+            # 提交被拒绝时它也不会出现在缓存中，与没有得到回复的消息不进入上下文一致
+            ai_chat.history.mark_written(session['user_id'], user_message['id'])
+
+            # 提交到后台获取AI响应，完成后通过new_message推送
+            if not dispatcher.submit(session['user_id'], generate_ai_reply,
+                                     session['user_id'], ai_assistant.id, content, cancel_event,
+                                     dedup_key=dedup_key):
+                # 提交被拒绝时不影响正在进行的上一个回复
+                dispatcher.release_claim(session['user_id'], dedup_key)
+                ERRORS.inc(stage='dispatch', type='Busy')
+                emit('error', {'message': 'AI助手繁忙，请稍后再试'})
+                return
+
+            # 提交成功后才登记，新消息会中断该用户尚未结束的流式回复
+            if cancel_event is not None:
+                register_stream(session['user_id'], cancel_event)
                 
         except Exception as e:
             logger.error('消息处理过程中发生错误: %s', str(e), exc_info=True)
+            record_error('send_message', e)
             emit('error', {'message': '消息处理失败'})
             return
 
@@ -146,24 +341,158 @@ def init_socket_events(app, socketio):
             return
             
         try:
-            # 标记消息为已读
-            messages = Message.query.filter_by(
-                sender_id=sender_id,
-                recipient_id=session['user_id'],
-                status='sent'
-            ).all()
-            
-            for message in messages:
-                message.status = 'read'
-                message.read_at = datetime.utcnow()
-            
+            # 一条UPDATE按水位批量标记已读，并同步未读计数
+            marked, watermark = mark_conversation_read(session['user_id'], sender_id, data.get('up_to_id'))
             db.session.commit()
-            logger.info('已将 %d 条消息标记为已读', len(messages))
+            logger.debug('已将 %d 条消息标记为已读', marked)
+
+            if marked:
+                # 已读回执发给对方，未读数清零同步到自己的其他设备
+                socketio.emit('messages_read', {
+                    'reader_id': session['user_id'],
+                    'up_to_id': watermark
+                }, room=int(sender_id))
+            counter = db.session.get(UnreadCounter, (session['user_id'], int(sender_id)))
+            socketio.emit('unread_update', {
+                'peer_id': int(sender_id),
+                'count': counter.count if counter else 0,
+                'last_read_id': watermark
+            }, room=session['user_id'])
             
         except Exception as e:
             logger.error('标记消息已读失败: %s', str(e), exc_info=True)
             db.session.rollback()
 
+    @socketio.on('unread_counts')
+    def handle_unread_counts():
+        if 'user_id' not in session:
+            emit('error', {'message': '请先登录'})
+            return
+
+        try:
+            emit('unread_counts', get_unread_counts(session['user_id']))
+        except Exception as e:
+            logger.error('获取未读数失败: %s', str(e), exc_info=True)
+            emit('error', {'message': '获取未读数失败'})
+
+    @socketio.on('load_history')
+    def handle_load_history(data):
+        if 'user_id' not in session:
+            emit('error', {'message': '请先登录'})
+            return
+
+        peer_id = data.get('peer_id')
+        if not peer_id:
+            emit('error', {'message': '未指定会话对象'})
+            return
+
+        try:
+            messages, next_cursor = load_conversation_page(
+                session['user_id'], peer_id,
+                before=data.get('before'),
+                limit=data.get('limit')
+            )
+            emit('history_page', {
+                'peer_id': peer_id,
+                'messages': [message.to_dict() for message in messages],
+                'next_cursor': next_cursor
+            })
+        except ValueError as e:
+            emit('error', {'message': str(e)})
+        except Exception as e:
+            logger.error('加载历史消息失败: %s', str(e), exc_info=True)
+            emit('error', {'message': '加载历史消息失败'})
+
+    @socketio.on('join_group')
+    def handle_join_group(data):
+        """连接期间被拉进群（收到group_joined）后加入群房间"""
+        if 'user_id' not in session:
+            emit('error', {'message': '请先登录'})
+            return
+        group_id = (data or {}).get('group_id')
+        if not group_id or not is_member(group_id, session['user_id']):
+            emit('error', {'message': '不是群成员'})
+            return
+        join_room(group_room(int(group_id)))
+
+    @socketio.on('send_group_message')
+    def handle_group_message(data):
+        if 'user_id' not in session:
+            emit('error', {'message': '请先登录'})
+            return
+
+        presence.heartbeat(session['user_id'], request.sid)
+
+        data = data or {}
+        content = data.get('content')
+        group_id = data.get('group_id')
+        message_type = data.get('type', 'text')
+        media_url = data.get('media_url') if message_type in ('image', 'voice') else None
+        if media_url and not media_url.startswith('/media/'):
+            emit('error', {'message': '媒体地址无效'})
+            return
+        if not (content or media_url) or not group_id:
+            emit('error', {'message': '消息数据不完整'})
+            return
+        if not is_member(group_id, session['user_id']):
+            emit('error', {'message': '不是群成员'})
+            return
+
+        try:
+            # 每条群消息只写一行，写入量与群人数无关
+            with STAGE_SECONDS.time(stage='persist_user'):
+                message = writer.write(
+                    GroupMessage,
+                    group_id=int(group_id),
+                    sender_id=session['user_id'],
+                    content=content,
+                    message_type=message_type,
+                    media_url=media_url,
+                    timestamp=datetime.utcnow()
+                )
+            # 在线成员都在群房间里，一次emit送达（包括发送者的其他设备）
+            with STAGE_SECONDS.time(stage='emit'):
+                socketio.emit('group_message', message, room=group_room(message['group_id']))
+        except Exception as e:
+            logger.error('发送群消息失败: %s', str(e), exc_info=True)
+            record_error('send_group_message', e)
+            emit('error', {'message': '消息发送失败'})
+
+    @socketio.on('mark_group_read')
+    def handle_mark_group_read(data):
+        if 'user_id' not in session:
+            return
+
+        group_id = (data or {}).get('group_id')
+        if not group_id:
+            return
+
+        try:
+            watermark = mark_group_read(int(group_id), session['user_id'], data.get('up_to_id'))
+            db.session.commit()
+            unread = group_unread_counts(session['user_id'], [int(group_id)])
+            # 未读数同步到自己的其他设备
+            socketio.emit('group_unread_update', {
+                'group_id': int(group_id),
+                'count': unread.get(int(group_id), 0),
+                'last_read_id': watermark
+            }, room=session['user_id'])
+        except Exception as e:
+            logger.error('标记群消息已读失败: %s', str(e), exc_info=True)
+            db.session.rollback()
+
+    @socketio.on('group_unread_counts')
+    def handle_group_unread_counts():
+        if 'user_id' not in session:
+            emit('error', {'message': '请先登录'})
+            return
+
+        try:
+            emit('group_unread_counts', group_unread_counts(session['user_id']))
+        except Exception as e:
+            logger.error('获取群未读数失败: %s', str(e), exc_info=True)
+            emit('error', {'message': '获取未读数失败'})
+
     @socketio.on('clear_history')
     def handle_clear_history():
         if 'user_id' not in session:
@@ -182,3 +511,16 @@ def init_socket_events(app, socketio):
         except Exception as e:
             logger.error('清除历史记录失败: %s', str(e), exc_info=True)
             emit('error', {'message': '清除历史记录失败'})
+
+    @socketio.on('get_context_stats')
+    def handle_get_context_stats():
+        if 'user_id' not in session:
+            emit('error', {'message': '请先登录'})
+            return
+
+        # 最近一次AI请求的上下文token统计，以及全局累计的节省情况
+        emit('context_stats', {
+            'last': ai_chat.get_context_stats(session['user_id']),
+            'totals': ai_chat.context.totals(),
+            'cache': ai_chat.cache.stats() if ai_chat.cache else None
+        })
@@ -0,0 +1,57 @@
+import base64
+
+from sqlalchemy import tuple_
+from sqlalchemy.orm import joinedload
+
+from models import FileShare
+from message_history import decode_cursor, clamp_limit, DEFAULT_PAGE_SIZE
+
+# 文件名前缀查询的上界：前缀后接最大码位，使 LIKE 'prefix%' 变成可以走索引的范围查询
+PREFIX_UPPER_BOUND = '\U0010ffff'
+
+
+def encode_cursor(file_share):
+    """把文件的 (upload_time, id) 编码为不透明的游标字符串"""
+    raw = f'{file_share.upload_time.isoformat()}|{file_share.id}'
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def load_file_page(file_type=None, owner_id=None, name_prefix=None, before=None, limit=DEFAULT_PAGE_SIZE):
+    """按游标加载一页共享文件，最新上传的在前
+
+    使用 (upload_time, id) 键集分页，按类型或上传者过滤时分别走对应的复合索引，
+    上传者信息随同一条查询一起加载。
+
+    Args:
+        file_type: 文件扩展名，如 pdf
+        owner_id: 上传者ID
+        name_prefix: 原始文件名前缀
+        before: 上一页返回的游标，为空时从最新文件开始
+        limit: 每页条数
+
+    Returns:
+        tuple: (文件列表, 下一页的游标或None)
+    """
+    limit = clamp_limit(limit)
+    query = FileShare.query.options(joinedload(FileShare.owner))
+    if file_type:
+        query = query.filter(FileShare.file_type == file_type.lower())
+    if owner_id:
+        query = query.filter(FileShare.user_id == owner_id)
+    if name_prefix:
+        query = query.filter(FileShare.original_filename >= name_prefix,
+                             FileShare.original_filename < name_prefix + PREFIX_UPPER_BOUND)
+    if before:
+        upload_time, file_id = decode_cursor(before)
+        query = query.filter(tuple_(FileShare.upload_time, FileShare.id) < (upload_time, file_id))
+
+    rows = query.order_by(FileShare.upload_time.desc(), FileShare.id.desc()).limit(limit + 1).all()
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def file_to_dict(file_share):
+    """文件列表中的一项，附带上传者用户名"""
+    data = file_share.to_dict()
+    data['owner'] = file_share.owner.username
+    return data
@@ -0,0 +1,459 @@
+import os
+import hmac
+import time
+import uuid
+import hashlib
+import logging
+import mimetypes
+import threading
+from datetime import datetime, timedelta
+from urllib.parse import quote
+
+from flask import request, session, jsonify, send_file, abort, redirect, url_for, flash, make_response
+from werkzeug.security import safe_join
+
+from models import db, FileShare, UploadSession
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 64 * 1024
+# 秒传时客户端需要证明持有文件：回答服务器选定的一段字节的哈希
+PROOF_LENGTH = 64 * 1024
+
+# 进程内缓存的增量哈希状态：upload_id -> (hashlib对象, 已哈希的字节数)
+_hashers = {}
+_upload_locks = {}
+_registry_lock = threading.Lock()
+
+
+def _upload_lock(upload_id):
+    with _registry_lock:
+        return _upload_locks.setdefault(upload_id, threading.Lock())
+
+
+def _forget(upload_id):
+    with _registry_lock:
+        _hashers.pop(upload_id, None)
+        _upload_locks.pop(upload_id, None)
+
+
+def blob_relpath(content_hash):
+    """内容寻址的存储路径，相对于UPLOAD_FOLDER"""
+    return os.path.join('blobs', content_hash[:2], content_hash)
+
+
+def expire_uploads(upload_folder, max_age):
+    """清理超过max_age秒没有收到新数据的上传会话及其临时文件
+
+    会话创建时间和临时文件的修改时间都早于期限才视为放弃，长时间断点续传的上传不受影响；
+    没有对应会话的临时文件（例如进程在完成上传时崩溃）同样按修改时间清理。
+
+    Returns:
+        int: 清理的上传会话数
+    """
+    part_folder = os.path.join(upload_folder, 'parts')
+    now = time.time()
+    cutoff = datetime.utcnow() - timedelta(seconds=max_age)
+
+    def idle(path):
+        try:
+            return now - os.path.getmtime(path) > max_age
+        except FileNotFoundError:
+            return True
+
+    expired = 0
+    for upload_id in [row.id for row in UploadSession.query.filter(UploadSession.created_at < cutoff)]:
+        path = os.path.join(part_folder, f'{upload_id}.part')
+        with _upload_lock(upload_id):
+            if not idle(path):
+                continue
+            # 按主键删除，会话已被并发完成的上传删掉时不会报错
+            if UploadSession.query.filter_by(id=upload_id).delete():
+                expired += 1
+            db.session.commit()
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        _forget(upload_id)
+
+    active = {row.id for row in db.session.query(UploadSession.id)}
+    for name in os.listdir(part_folder) if os.path.isdir(part_folder) else ():
+        upload_id, ext = os.path.splitext(name)
+        if ext == '.part' and upload_id not in active and idle(os.path.join(part_folder, name)):
+            try:
+                os.remove(os.path.join(part_folder, name))
+            except FileNotFoundError:
+                pass
+    return expired
+
+
+def start_upload_sweeper(app):
+    """启动后台线程，定期清理放弃的上传；由服务启动流程调用，导入模块或执行脚本时不会启动
+
+    多个工作进程同时清理也不会冲突。重复调用只启动一个线程。
+    """
+    if 'upload_sweeper' in app.extensions:
+        return app.extensions['upload_sweeper']
+    upload_folder = app.config['UPLOAD_FOLDER']
+
+    def sweep_uploads():
+        while True:
+            time.sleep(app.config['UPLOAD_SWEEP_INTERVAL'])
+            with app.app_context():
+                try:
+                    expired = expire_uploads(upload_folder, app.config['UPLOAD_SESSION_TTL'])
+                    if expired:
+                        logger.info('清理了 %d 个过期的上传会话', expired)
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error('清理过期上传失败: %s', str(e), exc_info=True)
+
+    thread = threading.Thread(target=sweep_uploads, name='upload-sweeper', daemon=True)
+    thread.start()
+    app.extensions['upload_sweeper'] = thread
+    return thread
+
+
+def proof_range(secret_key, upload_id, file_size):
+    """秒传校验的字节范围(offset, length)
+
+    由密钥和上传会话ID派生，客户端无法预先知道，服务器也不需要另外保存。
+    """
+    length = min(PROOF_LENGTH, file_size)
+    if file_size <= length:
+        return 0, length
+    digest = hmac.new(str(secret_key).encode('utf-8'), upload_id.encode('ascii'), hashlib.sha256).digest()
+    return int.from_bytes(digest[:8], 'big') % (file_size - length + 1), length
+
+
+def _range_hash(path, offset, length):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while length > 0:
+            block = f.read(min(READ_SIZE, length))
+            if not block:
+                break
+            hasher.update(block)
+            length -= len(block)
+    return hasher.hexdigest()
+
+
+def _file_type(filename):
+    return filename.rsplit('.', 1)[1].lower() if '.' in filename else None
+
+
+def _hasher_for(upload_id, part_path, offset):
+    """取得与临时文件当前长度一致的哈希状态
+
+    正常情况下直接复用内存中的状态；进程重启或换了工作进程时，重新读一遍已收到的部分。
+    """
+    state = _hashers.get(upload_id)
+    if state is not None and state[1] == offset:
+        return state[0]
+    hasher = hashlib.sha256()
+    if offset:
+        with open(part_path, 'rb') as f:
+            for block in iter(lambda: f.read(READ_SIZE), b''):
+                hasher.update(block)
+    return hasher
+
+
+def init_file_routes(app, allowed_file):
+    """初始化文件上传、下载相关的路由
+
+    Args:
+        app: Flask应用实例
+        allowed_file: 判断文件扩展名是否允许上传的函数
+    """
+    upload_folder = app.config['UPLOAD_FOLDER']
+    part_folder = os.path.join(upload_folder, 'parts')
+    os.makedirs(part_folder, exist_ok=True)
+
+    def part_path(upload_id):
+        return os.path.join(part_folder, f'{upload_id}.part')
+
+    def get_upload(upload_id):
+        upload = db.session.get(UploadSession, upload_id)
+        if upload is None or upload.user_id != session['user_id']:
+            return None
+        return upload
+
+    def received_bytes(upload_id):
+        try:
+            return os.path.getsize(part_path(upload_id))
+        except FileNotFoundError:
+            return 0
+
+    def process_media(file_share):
+        # 缩略图、语音转码交给媒体处理队列，不在请求中执行
+        pipeline = app.extensions.get('media_pipeline')
+        if pipeline is not None:
+            pipeline.enqueue(file_share.content_hash, file_share.file_type)
+
+    def create_file_share(upload, content_hash):
+        file_share = FileShare(
+            filename=blob_relpath(content_hash),
+            original_filename=upload.original_filename,
+            file_size=upload.file_size,
+            file_type=_file_type(upload.original_filename),
+            user_id=session['user_id'],
+            description=upload.description,
+            content_hash=content_hash
+        )
+        db.session.add(file_share)
+        return file_share
+
+    def existing_blob(content_hash, file_size):
+        if not content_hash or not FileShare.query.filter_by(content_hash=content_hash, file_size=file_size).first():
+            return None
+        path = os.path.join(upload_folder, blob_relpath(content_hash))
+        return path if os.path.exists(path) else None
+
+    @app.route('/api/uploads', methods=['POST'])
+    def create_upload():
+        """创建上传会话
+
+        声明的哈希已存在时，响应中附带proof范围：客户端用POST /api/uploads/<id>/proof
+        提交这段字节的sha256即可秒传，无法证明时照常分块上传。
+        """
+        if 'user_id' not in session:
+            return jsonify({'error': '请先登录'}), 401
+
+        data = request.get_json(silent=True) or {}
+        filename = data.get('filename')
+        file_size = data.get('size')
+        content_hash = (data.get('sha256') or '').lower() or None
+
+        if not filename or not allowed_file(filename):
+            return jsonify({'error': '不支持的文件类型'}), 400
+        if not isinstance(file_size, int) or file_size < 0:
+            return jsonify({'error': '文件大小无效'}), 400
+        if file_size > app.config['UPLOAD_MAX_FILE_SIZE']:
+            return jsonify({'error': '文件太大'}), 413
+
+        upload_session = UploadSession(
+            id=uuid.uuid4().hex,
+            user_id=session['user_id'],
+            original_filename=filename,
+            file_size=file_size,
+            expected_hash=content_hash,
+            description=data.get('description')
+        )
+        try:
+            db.session.add(upload_session)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error('创建上传会话失败: %s', str(e), exc_info=True)
+            return jsonify({'error': '上传失败，请稍后重试'}), 500
+
+        result = {
+            'status': 'created',
+            'upload_id': upload_session.id,
+            'offset': 0,
+            'chunk_size': app.config['UPLOAD_CHUNK_SIZE']
+        }
+        # 相同内容已经存在，证明持有文件后不需要再上传
+        if existing_blob(content_hash, file_size):
+            offset, length = proof_range(app.secret_key, upload_session.id, file_size)
+            result['proof'] = {'offset': offset, 'length': length}
+        return jsonify(result), 201
+
+    @app.route('/api/uploads/<upload_id>/proof', methods=['POST'])
+    def prove_upload(upload_id):
+        """秒传：校验客户端提交的proof范围哈希，与已有文件一致时直接完成上传"""
+        if 'user_id' not in session:
+            return jsonify({'error': '请先登录'}), 401
+        upload = get_upload(upload_id)
+        if upload is None:
+            return jsonify({'error': '上传会话不存在'}), 404
+
+        data = request.get_json(silent=True) or {}
+        blob_path = existing_blob(upload.expected_hash, upload.file_size)
+        if blob_path is None:
+            return jsonify({'error': '无法秒传，请上传文件', 'offset': received_bytes(upload_id)}), 409
+        offset, length = proof_range(app.secret_key, upload_id, upload.file_size)
+        if not hmac.compare_digest(str(data.get('sha256') or '').lower(), _range_hash(blob_path, offset, length)):
+            return jsonify({'error': '文件校验失败，请上传文件', 'offset': received_bytes(upload_id)}), 422
+
+        with _upload_lock(upload_id):
+            try:
+                file_share = create_file_share(upload, upload.expected_hash)
+                db.session.delete(upload)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.error('保存文件记录失败: %s', str(e), exc_info=True)
+                return jsonify({'error': '上传失败，请稍后重试'}), 500
+            try:
+                os.remove(part_path(upload_id))
+            except FileNotFoundError:
+                pass
+            _forget(upload_id)
+
+        logger.info('文件秒传: %s', upload.expected_hash)
+        process_media(file_share)
+        return jsonify({'status': 'complete', 'file': file_share.to_dict()}), 201
+
+    @app.route('/api/uploads/<upload_id>', methods=['GET'])
+    def upload_status(upload_id):
+        """查询已接收的字节数，断线后从这里继续上传"""
+        if 'user_id' not in session:
+            return jsonify({'error': '请先登录'}), 401
+        upload = get_upload(upload_id)
+        if upload is None:
+            return jsonify({'error': '上传会话不存在'}), 404
+        return jsonify({'upload_id': upload.id, 'offset': received_bytes(upload_id), 'size': upload.file_size})
+
+    @app.route('/api/uploads/<upload_id>', methods=['PUT'])
+    def upload_chunk(upload_id):
+        """追加一个分块
+
+        请求体为原始字节，Upload-Offset头必须等于服务器已接收的字节数。
+        数据边读边写入磁盘并更新哈希，内存占用与文件大小无关。
+        """
+        if 'user_id' not in session:
+            return jsonify({'error': '请先登录'}), 401
+        upload = get_upload(upload_id)
+        if upload is None:
+            return jsonify({'error': '上传会话不存在'}), 404
+
+        try:
+            offset = int(request.headers.get('Upload-Offset', request.args.get('offset', '')))
+        except ValueError:
+            return jsonify({'error': '缺少Upload-Offset'}), 400
+        length = request.content_length
+        if length is None or length > app.config['UPLOAD_CHUNK_SIZE']:
+            return jsonify({'error': '分块大小无效'}), 400
+
+        path = part_path(upload_id)
+        with _upload_lock(upload_id):
+            current = received_bytes(upload_id)
+            if offset != current:
+                return jsonify({'error': '偏移量不匹配', 'offset': current}), 409
+            if current + length > upload.file_size:
+                return jsonify({'error': '超出声明的文件大小', 'offset': current}), 400
+
+            hasher = _hasher_for(upload_id, path, current)
+            written = current
+            try:
+                with open(path, 'ab') as f:
+                    while True:
+                        block = request.stream.read(READ_SIZE)
+                        if not block:
+                            break
+                        f.write(block)
+                        hasher.update(block)
+                        written += len(block)
+            finally:
+                # 连接中断时已写入的部分同样有效，下次从实际长度继续
+                _hashers[upload_id] = (hasher, written)
+
+        return jsonify({'upload_id': upload_id, 'offset': written, 'size': upload.file_size})
+
+    @app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+    def complete_upload(upload_id):
+        """校验并落地文件：内容相同的文件只保存一份"""
+        if 'user_id' not in session:
+            return jsonify({'error': '请先登录'}), 401
+        upload = get_upload(upload_id)
+        if upload is None:
+            return jsonify({'error': '上传会话不存在'}), 404
+
+        path = part_path(upload_id)
+        with _upload_lock(upload_id):
+            received = received_bytes(upload_id)
+            if received != upload.file_size:
+                return jsonify({'error': '文件尚未上传完成', 'offset': received}), 409
+
+            content_hash = _hasher_for(upload_id, path, received).hexdigest()
+            if upload.expected_hash and upload.expected_hash != content_hash:
+                os.remove(path)
+                _forget(upload_id)
+                return jsonify({'error': '文件校验失败，请重新上传', 'offset': 0}), 422
+
+            blob_path = os.path.join(upload_folder, blob_relpath(content_hash))
+            if os.path.exists(blob_path):
+                os.remove(path)
+                logger.info('文件内容已存在，复用blob: %s', content_hash)
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.replace(path, blob_path)
+
+            try:
+                file_share = create_file_share(upload, content_hash)
+                db.session.delete(upload)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.error('保存文件记录失败: %s', str(e), exc_info=True)
+                return jsonify({'error': '上传失败，请稍后重试'}), 500
+            _forget(upload_id)
+
+        process_media(file_share)
+        return jsonify({'status': 'complete', 'file': file_share.to_dict()}), 201
+
+    @app.route('/files/<int:file_id>/download')
+    def download_file(file_id):
+        """下载文件
+
+        支持Range分段请求（语音拖动播放、大文件断点续传），以内容哈希作为强ETag，
+        配置了X_ACCEL_REDIRECT_PREFIX时交给nginx直接发送文件，不占用Python工作进程。
+        """
+        if 'user_id' not in session:
+            flash('请先登录', 'error')
+            return redirect(url_for('login'))
+
+        file_share = db.session.get(FileShare, file_id)
+        if file_share is None:
+            abort(404)
+        path = safe_join(upload_folder, file_share.filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+
+        as_attachment = request.args.get('inline') != '1'
+        mimetype = mimetypes.guess_type(file_share.original_filename)[0] or 'application/octet-stream'
+        accel_prefix = app.config.get('X_ACCEL_REDIRECT_PREFIX')
+
+        if accel_prefix:
+            # nginx内部location负责发送文件本身，包括Range请求
+            response = make_response('')
+            response.headers['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + quote(
+                file_share.filename.replace(os.sep, '/'))
+            response.headers['Content-Type'] = mimetype
+            response.headers['Content-Disposition'] = _content_disposition(
+                file_share.original_filename, as_attachment)
+            if file_share.content_hash:
+                response.set_etag(file_share.content_hash)
+            response.last_modified = file_share.upload_time
+            response.make_conditional(request)
+        else:
+            # USE_X_SENDFILE开启时由前端服务器发送；否则使用wsgi.file_wrapper（gunicorn下为sendfile）
+            response = send_file(
+                path,
+                mimetype=mimetype,
+                as_attachment=as_attachment,
+                download_name=file_share.original_filename,
+                conditional=True,
+                etag=file_share.content_hash or True,
+                last_modified=file_share.upload_time,
+                max_age=app.config['DOWNLOAD_MAX_AGE']
+            )
+
+        # 需要登录才能下载，只允许浏览器缓存
+        response.cache_control.public = False
+        response.cache_control.private = True
+        response.cache_control.max_age = app.config['DOWNLOAD_MAX_AGE']
+        return response
+
+
+def _content_disposition(filename, as_attachment):
+    """生成支持中文文件名的Content-Disposition"""
+    disposition = 'attachment' if as_attachment else 'inline'
+    try:
+        filename.encode('ascii')
+        return f'{disposition}; filename="{filename}"'
+    except UnicodeEncodeError:
+        return f"{disposition}; filename*=UTF-8''{quote(filename)}"
@@ -0,0 +1,256 @@
+import os
+import time
+import threading
+
+from flask import request, session, jsonify
+from sqlalchemy import event, select, update, func
+
+from models import db, User, ChatGroup, GroupMember, GroupMessage
+from message_history import clamp_limit, DEFAULT_PAGE_SIZE
+
+MAX_GROUP_MEMBERS = int(os.getenv('GROUP_MAX_MEMBERS', 500))
+
+
+def group_room(group_id):
+    """群的Socket.IO房间，在线成员连接时加入，群消息一次emit送达所有人"""
+    return f'group:{group_id}'
+
+
+class MembershipCache:
+    """群成员ID集合的进程内缓存，发送群消息时校验成员身份不必每次查询
+
+    本进程内成员变化时立即失效，其他进程的变化最多在TTL之后生效。
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._entries = {}  # group_id -> (frozenset(成员ID), 过期时间)
+        self._lock = threading.Lock()
+
+    def members(self, group_id):
+        with self._lock:
+            entry = self._entries.get(group_id)
+        if entry is not None and entry[1] > time.monotonic():
+            return entry[0]
+        members = frozenset(group_member_ids(group_id))
+        with self._lock:
+            self._entries[group_id] = (members, time.monotonic() + self.ttl)
+        return members
+
+    def invalidate(self, group_id):
+        with self._lock:
+            self._entries.pop(group_id, None)
+
+
+membership_cache = MembershipCache(ttl=int(os.getenv('GROUP_MEMBERSHIP_CACHE_TTL', 60)))
+
+
+@event.listens_for(GroupMember, 'after_insert')
+@event.listens_for(GroupMember, 'after_delete')
+def _invalidate_membership(mapper, connection, target):
+    membership_cache.invalidate(target.group_id)
+
+
+def is_member(group_id, user_id):
+    try:
+        return int(user_id) in membership_cache.members(int(group_id))
+    except (TypeError, ValueError):
+        return False
+
+
+def user_group_ids(user_id):
+    """用户加入的所有群ID"""
+    return list(db.session.execute(
+        select(GroupMember.group_id).where(GroupMember.user_id == user_id)
+    ).scalars())
+
+
+def group_member_ids(group_id):
+    """群的所有成员ID"""
+    return list(db.session.execute(
+        select(GroupMember.user_id).where(GroupMember.group_id == group_id).order_by(GroupMember.user_id)
+    ).scalars())
+
+
+def add_members(group, user_ids):
+    """把用户加入群，已是成员或不存在的用户会被跳过
+
+    新成员的水位从当前最新的群消息开始，加入前的历史不计入未读。调用方负责提交事务。
+
+    Returns:
+        list: 新加入的用户ID
+    """
+    try:
+        user_ids = {int(user_id) for user_id in user_ids}
+    except (TypeError, ValueError):
+        raise ValueError('无效的用户ID')
+    existing = set(db.session.execute(
+        select(GroupMember.user_id).where(GroupMember.group_id == group.id)
+    ).scalars())
+    candidates = set(db.session.execute(
+        select(User.id).where(User.id.in_(user_ids - existing), User.is_bot.isnot(True))
+    ).scalars())
+    if len(existing) + len(candidates) > MAX_GROUP_MEMBERS:
+        raise ValueError(f'群成员不能超过{MAX_GROUP_MEMBERS}人')
+
+    latest = db.session.query(func.max(GroupMessage.id)).filter(GroupMessage.group_id == group.id).scalar() or 0
+    db.session.add_all([GroupMember(group_id=group.id, user_id=user_id, last_read_id=latest)
+                        for user_id in candidates])
+    return sorted(candidates)
+
+
+def create_group(owner_id, name, member_ids=()):
+    """创建群，创建者自动成为成员；调用方负责提交事务"""
+    name = (name or '').strip()
+    if not name:
+        raise ValueError('群名称不能为空')
+    group = ChatGroup(name=name[:100], owner_id=owner_id)
+    db.session.add(group)
+    db.session.flush()
+    add_members(group, set(member_ids) | {owner_id})
+    return group
+
+
+def mark_group_read(group_id, user_id, up_to_id=None):
+    """把群消息标记为已读，只移动该成员的水位，一条UPDATE完成
+
+    Args:
+        up_to_id: 已读到的群消息ID，为空时表示全部已读
+
+    Returns:
+        int: 新的已读水位
+    """
+    if up_to_id is None:
+        up_to_id = db.session.query(func.max(GroupMessage.id)).filter(GroupMessage.group_id == group_id).scalar() or 0
+    up_to_id = int(up_to_id)
+    # 水位只前进不后退，多台设备乱序上报时不会把已读改回未读
+    db.session.execute(
+        update(GroupMember)
+        .where(GroupMember.group_id == group_id, GroupMember.user_id == user_id,
+               GroupMember.last_read_id < up_to_id)
+        .values(last_read_id=up_to_id)
+    )
+    return db.session.query(GroupMember.last_read_id).filter(
+        GroupMember.group_id == group_id, GroupMember.user_id == user_id
+    ).scalar() or 0
+
+
+def group_unread_counts(user_id, group_ids=None):
+    """按水位统计用户各群的未读数，自己发的消息不计入
+
+    一条查询完成，每个群只扫描 (group_id, id) 索引上水位之后的部分。
+
+    Returns:
+        dict: {group_id: 未读数}，没有未读的群不出现
+    """
+    query = (
+        select(GroupMember.group_id, func.count(GroupMessage.id))
+        .join(GroupMessage, (GroupMessage.group_id == GroupMember.group_id)
+              & (GroupMessage.id > GroupMember.last_read_id))
+        .where(GroupMember.user_id == user_id, GroupMessage.sender_id != user_id)
+        .group_by(GroupMember.group_id)
+    )
+    if group_ids is not None:
+        query = query.where(GroupMember.group_id.in_(group_ids))
+    return {group_id: count for group_id, count in db.session.execute(query)}
+
+
+def load_group_page(group_id, before=None, limit=DEFAULT_PAGE_SIZE):
+    """按消息ID分页加载群历史
+
+    Args:
+        before: 上一页返回的游标（该页最早一条消息的ID）
+
+    Returns:
+        tuple: (按时间正序排列的消息列表, 更早一页的游标或None)
+    """
+    limit = clamp_limit(limit)
+    query = GroupMessage.query.filter(GroupMessage.group_id == group_id)
+    if before:
+        try:
+            query = query.filter(GroupMessage.id < int(before))
+        except (TypeError, ValueError):
+            raise ValueError('无效的分页游标')
+    rows = query.order_by(GroupMessage.id.desc()).limit(limit + 1).all()
+    next_cursor = str(rows[limit - 1].id) if len(rows) > limit else None
+    rows = rows[:limit]
+    rows.reverse()
+    return rows, next_cursor
+
+
+def init_group_routes(app, socketio):
+    """注册群聊的HTTP接口，收发消息走Socket.IO事件（见events.py）
+
+    Args:
+        app: Flask应用实例
+        socketio: SocketIO实例，用于通知新成员加入房间
+    """
+
+    def notify_joined(group, user_ids):
+        # 新成员已在线的连接收到通知后发送join_group加入群房间
+        for user_id in user_ids:
+            socketio.emit('group_joined', group.to_dict(), room=user_id)
+
+    @app.route('/api/groups', methods=['GET'])
+    def list_groups():
+        if 'user_id' not in session:
+            return jsonify({'error': '请先登录'}), 401
+
+        user_id = session['user_id']
+        groups = ChatGroup.query.join(GroupMember).filter(GroupMember.user_id == user_id) \
+            .order_by(ChatGroup.id).all()
+        unread = group_unread_counts(user_id)
+        return jsonify({'groups': [dict(group.to_dict(), unread=unread.get(group.id, 0)) for group in groups]})
+
+    @app.route('/api/groups', methods=['POST'])
+    def create_group_route():
+        if 'user_id' not in session:
+            return jsonify({'error': '请先登录'}), 401
+
+        data = request.get_json(silent=True) or {}
+        try:
+            group = create_group(session['user_id'], data.get('name'), data.get('member_ids') or [])
+            db.session.commit()
+        except ValueError as e:
+            db.session.rollback()
+            return jsonify({'error': str(e)}), 400
+
+        members = group_member_ids(group.id)
+        notify_joined(group, members)
+        return jsonify(dict(group.to_dict(), member_ids=members)), 201
+
+    @app.route('/api/groups/<int:group_id>/members', methods=['POST'])
+    def add_group_members(group_id):
+        if 'user_id' not in session:
+            return jsonify({'error': '请先登录'}), 401
+
+        group = db.session.get(ChatGroup, group_id)
+        if group is None:
+            return jsonify({'error': '群不存在'}), 404
+        if group.owner_id != session['user_id']:
+            return jsonify({'error': '只有群主可以添加成员'}), 403
+
+        data = request.get_json(silent=True) or {}
+        try:
+            added = add_members(group, data.get('user_ids') or [])
+            db.session.commit()
+        except ValueError as e:
+            db.session.rollback()
+            return jsonify({'error': str(e)}), 400
+
+        notify_joined(group, added)
+        return jsonify({'added': added})
+
+    @app.route('/api/groups/<int:group_id>/messages')
+    def group_messages(group_id):
+        if 'user_id' not in session:
+            return jsonify({'error': '请先登录'}), 401
+        if not is_member(group_id, session['user_id']):
+            return jsonify({'error': '不是群成员'}), 403
+
+        try:
+            messages, next_cursor = load_group_page(group_id, request.args.get('before'), request.args.get('limit'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify({'messages': [m.to_dict() for m in messages], 'next_cursor': next_cursor})
+
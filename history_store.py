@@ -0,0 +1,273 @@
+import os
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy import select, literal, and_
+
+from models import db, Message, ChatContext, conversation_key
+from user_cache import user_cache
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryStore(ABC):
+    """AI会话历史存储接口
+
+    历史记录为 {"role", "content", "timestamp"} 字典组成的列表，按时间先后排列。
+    """
+
+    @abstractmethod
+    def get(self, user_id):
+        """获取用户的会话历史"""
+
+    @abstractmethod
+    def append(self, user_id, role, content):
+        """追加一条历史记录，返回追加后的会话历史"""
+
+    @abstractmethod
+    def clear(self, user_id):
+        """清除用户的会话历史，有历史被清除时返回True"""
+
+    def mark_written(self, user_id, message_id):
+        """登记本进程写入数据库、并已追加到历史中的消息ID，基于数据库核对缓存的实现使用"""
+
+
+class MemoryHistoryStore(HistoryStore):
+    """进程内LRU + TTL历史存储
+
+    最多缓存max_users个用户，空闲超过ttl秒的用户会被淘汰；
+    缓存未命中时通过loader从数据库懒加载最近的对话，因此重启或换进程后历史不丢失。
+
+    数据库是各工作进程共用的数据源：缓存条目记录加载时的清除时间和已同步到的消息ID，
+    每次命中时用changes取回之后新增的消息ID。新增的都是本进程写入（经mark_written登记、
+    已追加到缓存）的消息时继续使用缓存；出现其他进程写入的消息或历史被清除时重新加载。
+    """
+
+    # 每个用户最多保留的已写入但尚未核对的消息ID数
+    MAX_WRITTEN = 32
+
+    def __init__(self, max_users=1000, ttl=1800, max_messages=50, loader=None, on_clear=None, changes=None):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self.loader = loader
+        self.on_clear = on_clear
+        self.changes = changes
+        self._entries = OrderedDict()  # user_id -> [最后访问时间, 历史列表, 清除时间, 已同步的消息ID]
+        self._written = {}  # user_id -> 本进程写入、尚未核对的消息ID
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _lookup(self, user_id, now):
+        """查找缓存条目，过期条目视为未命中"""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        if self.ttl and now - entry[0] > self.ttl:
+            del self._entries[user_id]
+            return None
+        self._entries.move_to_end(user_id)
+        return entry
+
+    def _store(self, user_id, entry):
+        self._entries[user_id] = entry
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_users:
+            evicted, _ = self._entries.popitem(last=False)
+            self._written.pop(evicted, None)
+            logger.debug(f"Evicted conversation history for user {evicted}")
+
+    def _load(self, user_id):
+        if not self.loader:
+            return []
+        try:
+            return list(self.loader(user_id, self.max_messages))[-self.max_messages:]
+        except Exception as e:
+            logger.error(f"Failed to rehydrate history for user {user_id}: {str(e)}", exc_info=True)
+            return []
+
+    def _changes(self, user_id, after_id=None):
+        if not self.changes:
+            return None
+        try:
+            return self.changes(user_id, after_id)
+        except Exception as e:
+            logger.error(f"Failed to check history changes for user {user_id}: {str(e)}", exc_info=True)
+            return None
+
+    def mark_written(self, user_id, message_id):
+        with self._lock:
+            written = self._written.setdefault(user_id, set())
+            written.add(message_id)
+            if len(written) > self.MAX_WRITTEN:
+                written.discard(min(written))
+
+    def _validate(self, user_id, entry):
+        """核对缓存条目与数据库，仍然有效时推进已同步的消息ID并返回True"""
+        changes = self._changes(user_id, entry[3])
+        if changes is None:
+            return True
+        cleared_at, new_ids = changes
+        with self._lock:
+            written = self._written.get(user_id, set())
+            if cleared_at != entry[2] or not written.issuperset(new_ids):
+                return False
+            if new_ids:
+                entry[3] = max(new_ids)
+                written.difference_update(new_ids)
+        return True
+
+    def get(self, user_id):
+        return list(self._get(user_id)[1])
+
+    def _get(self, user_id):
+        """返回有效的缓存条目，未命中时从数据库加载"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._lookup(user_id, now)
+        if entry is not None:
+            if self._validate(user_id, entry):
+                with self._lock:
+                    entry[0] = now
+                    return entry
+            logger.debug(f"History for user {user_id} changed in another process, reloading")
+
+        # 先取版本再加载，加载期间有新写入时下次访问会发现并重新加载；在锁外访问数据库
+        changes = self._changes(user_id)
+        cleared_at, latest_ids = changes if changes is not None else (None, [])
+        synced_id = max(latest_ids, default=0)
+        history = self._load(user_id)
+        if history:
+            logger.info(f"Rehydrated {len(history)} messages for user {user_id}")
+        with self._lock:
+            written = self._written.get(user_id)
+            if written:
+                written.difference_update([message_id for message_id in written if message_id <= synced_id])
+            entry = [now, history, cleared_at, synced_id]
+            self._store(user_id, entry)
+            return entry
+
+    def append(self, user_id, role, content):
+        entry = self._get(user_id)
+        with self._lock:
+            history = entry[1]
+            history.append({
+                "role": role,
+                "content": content,
+                "timestamp": datetime.utcnow().isoformat()
+            })
+            if len(history) > self.max_messages:
+                del history[:-self.max_messages]
+            if self._entries.get(user_id) is not entry:
+                self._store(user_id, entry)
+            return list(history)
+
+    def clear(self, user_id):
+        with self._lock:
+            existed = self._entries.pop(user_id, None) is not None
+            self._written.pop(user_id, None)
+        if self.on_clear:
+            try:
+                existed = self.on_clear(user_id) or existed
+            except Exception as e:
+                logger.error(f"Failed to persist history reset for user {user_id}: {str(e)}", exc_info=True)
+        return existed
+
+
+def load_recent_turns(user_id, limit):
+    """从Message表加载用户与AI助手最近的对话
+
+    只加载最近一次清除历史之后的消息；末尾尚未得到回复的用户消息会被丢弃，
+    因为当前正在处理的那条消息已经先一步写入了数据库。
+    """
+    bot = user_cache.get_bot()
+    if not bot:
+        return []
+
+    query = Message.query.filter(
+        Message.conversation == conversation_key(user_id, bot.id),
+        Message.message_type == 'text'
+    )
+    context = db.session.get(ChatContext, user_id)
+    if context and context.cleared_at:
+        query = query.filter(Message.timestamp > context.cleared_at)
+
+    rows = query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit).all()
+    rows.reverse()
+    while rows and rows[-1].sender_id != bot.id:
+        rows.pop()
+
+    return [{
+        "role": "assistant" if row.sender_id == bot.id else "user",
+        "content": row.content,
+        "timestamp": row.timestamp.isoformat()
+    } for row in rows if row.content]
+
+
+def load_history_changes(user_id, after_id=None):
+    """用户与AI助手对话在数据库中的变化：(最近一次清除时间, 消息ID列表)
+
+    after_id为空时只返回最新一条消息的ID，用于加载缓存时记录同步位置；
+    否则返回ID大于after_id的消息，正常情况下只有本进程刚写入的一两条。一条语句完成。
+    """
+    bot = user_cache.get_bot()
+    if not bot:
+        return None
+
+    conversation = conversation_key(user_id, bot.id)
+    cleared_at = select(ChatContext.cleared_at).where(ChatContext.user_id == user_id).scalar_subquery()
+    if after_id is None:
+        latest_id = select(Message.id).where(Message.conversation == conversation) \
+            .order_by(Message.timestamp.desc(), Message.id.desc()).limit(1).scalar_subquery()
+        cleared, latest = db.session.execute(select(cleared_at, latest_id)).one()
+        return cleared, [latest] if latest is not None else []
+
+    # 以单行查询为左表外连接，没有新消息时也能取回清除时间
+    anchor = select(literal(1).label('one')).subquery()
+    rows = db.session.execute(
+        select(cleared_at, Message.id).select_from(anchor).outerjoin(
+            Message, and_(Message.conversation == conversation, Message.id > after_id)
+        )
+    ).all()
+    return rows[0][0], [message_id for _, message_id in rows if message_id is not None]
+
+
+def mark_history_cleared(user_id):
+    """记录清除时间，之后的懒加载不会再取回更早的消息"""
+    context = db.session.get(ChatContext, user_id)
+    if context is None:
+        context = ChatContext(user_id=user_id)
+        db.session.add(context)
+    context.cleared_at = datetime.utcnow()
+    try:
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return True
+
+
+_default_store = None
+_default_lock = threading.Lock()
+
+
+def get_history_store():
+    """获取进程内共享的历史存储，所有AIChat实例共用"""
+    global _default_store
+    with _default_lock:
+        if _default_store is None:
+            _default_store = MemoryHistoryStore(
+                max_users=int(os.getenv('HISTORY_MAX_USERS', 1000)),
+                ttl=int(os.getenv('HISTORY_TTL', 1800)),
+                max_messages=int(os.getenv('HISTORY_MAX_MESSAGES', 50)),
+                loader=load_recent_turns,
+                on_clear=mark_history_cleared,
+                changes=load_history_changes
+            )
+        return _default_store
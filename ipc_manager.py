@@ -0,0 +1,151 @@
+import socket
+import logging
+import argparse
+import threading
+import time
+from urllib.parse import urlparse
+
+import socketio
+
+from logging_config import setup_logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 6010
+SUBSCRIBE = b'SUBSCRIBE'
+
+
+def _parse_url(url):
+    """解析 ipc://host:port 形式的地址"""
+    parsed = urlparse(url)
+    return parsed.hostname or '127.0.0.1', parsed.port or DEFAULT_PORT
+
+
+class IPCManager(socketio.PubSubManager):
+    """基于本地TCP广播进程的Socket.IO客户端管理器
+
+    与RedisManager作用相同：把emit、进出房间等操作广播给所有工作进程。
+    不需要安装Redis，适合单机多进程部署和测试；多节点部署请使用Redis。
+    """
+    name = 'ipc'
+
+    def __init__(self, url='ipc://127.0.0.1:6010', channel='flask-socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.address = _parse_url(url)
+        self._publisher = None
+        self._publish_lock = threading.Lock()
+
+    def _connect(self):
+        return socket.create_connection(self.address, timeout=5)
+
+    def _publish(self, data):
+        line = (self.json.dumps({'channel': self.channel, 'data': data}) + '\n').encode('utf-8')
+        with self._publish_lock:
+            for retries_left in range(1, -1, -1):  # 2 attempts
+                try:
+                    if self._publisher is None:
+                        self._publisher = self._connect()
+                    self._publisher.sendall(line)
+                    return
+                except OSError as e:
+                    self._publisher = None
+                    if retries_left == 0:
+                        self._get_logger().error('Cannot publish to IPC broker: %s', e)
+
+    def _listen(self):
+        while True:
+            try:
+                conn = self._connect()
+                conn.settimeout(None)
+                conn.sendall(SUBSCRIBE + b'\n')
+                buffer = b''
+                while True:
+                    chunk = conn.recv(65536)
+                    if not chunk:
+                        break
+                    buffer += chunk
+                    *lines, buffer = buffer.split(b'\n')
+                    for line in lines:
+                        message = self.json.loads(line.decode('utf-8'))
+                        if message.get('channel') == self.channel:
+                            yield message['data']
+            except OSError as e:
+                self._get_logger().error('IPC broker connection lost: %s', e)
+            time.sleep(1)
+
+
+class IPCBroker:
+    """把收到的每一行消息转发给所有订阅了的工作进程
+
+    每个工作进程建立两条连接：订阅连接先发送一行SUBSCRIBE，之后只接收；
+    发布连接只发送，不会收到回传，避免其接收缓冲区被写满。
+    """
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT):
+        self.host = host
+        self.port = port
+        self._clients = set()
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()  # 防止多个发布者的数据在同一连接上交错
+        self._server = None
+
+    def start(self):
+        """在后台线程中启动，返回实际监听的端口"""
+        self._server = socket.create_server((self.host, self.port))
+        self.port = self._server.getsockname()[1]
+        threading.Thread(target=self._accept, name='ipc-broker', daemon=True).start()
+        return self.port
+
+    def serve_forever(self):
+        self.start()
+        logger.info('IPC broker listening on %s:%s', self.host, self.port)
+        while True:
+            time.sleep(3600)
+
+    def _accept(self):
+        while True:
+            conn, _ = self._server.accept()
+            threading.Thread(target=self._relay, args=(conn,), daemon=True).start()
+
+    def _relay(self, conn):
+        buffer = b''
+        try:
+            while True:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                buffer += chunk
+                if b'\n' not in buffer:
+                    continue
+                complete, _, buffer = buffer.rpartition(b'\n')
+                if complete == SUBSCRIBE:
+                    with self._lock:
+                        self._clients.add(conn)
+                    continue
+                self._broadcast(complete + b'\n')
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                self._clients.discard(conn)
+            conn.close()
+
+    def _broadcast(self, data):
+        with self._lock:
+            clients = list(self._clients)
+        with self._send_lock:
+            for client in clients:
+                try:
+                    client.sendall(data)
+                except OSError:
+                    with self._lock:
+                        self._clients.discard(client)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Socket.IO多进程广播服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    args = parser.parse_args()
+    setup_logging()
+    IPCBroker(args.host, args.port).serve_forever()
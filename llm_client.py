@@ -0,0 +1,66 @@
+import os
+import atexit
+import logging
+import threading
+
+import httpx
+from openai import OpenAI, DefaultHttpxClient
+
+try:
+    import h2
+except ImportError:
+    h2 = None
+
+logger = logging.getLogger(__name__)
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def request_timeout():
+    """单次请求的超时设置
+
+    read 是两次收到数据之间的最长间隔，流式回复中途卡住时也会按它超时。
+    """
+    return httpx.Timeout(
+        connect=float(os.getenv('AI_HTTP_CONNECT_TIMEOUT', 5)),
+        read=float(os.getenv('AI_HTTP_READ_TIMEOUT', 60)),
+        write=float(os.getenv('AI_HTTP_WRITE_TIMEOUT', 10)),
+        pool=float(os.getenv('AI_HTTP_POOL_TIMEOUT', 5))
+    )
+
+
+def _create_client():
+    limits = httpx.Limits(
+        max_connections=int(os.getenv('AI_HTTP_MAX_CONNECTIONS', 32)),
+        max_keepalive_connections=int(os.getenv('AI_HTTP_MAX_KEEPALIVE', 16)),
+        keepalive_expiry=float(os.getenv('AI_HTTP_KEEPALIVE_EXPIRY', 120))
+    )
+    # 装了h2时启用HTTP/2，多个请求可以复用同一条TLS连接
+    http2 = h2 is not None and os.getenv('AI_HTTP2', '1') == '1'
+    http_client = DefaultHttpxClient(limits=limits, timeout=request_timeout(), http2=http2)
+    client = OpenAI(
+        api_key=os.getenv('DEEPSEEK_API_KEY', "sk-4c0e05f2a6ac46ed80426276b1c255eb"),
+        # 压测时可指向本地的模拟服务，见 bench/fake_llm.py
+        base_url=os.getenv('DEEPSEEK_BASE_URL', "https://api.deepseek.com"),
+        # 重试由调度器统一处理，避免与客户端自带的重试叠加
+        max_retries=0,
+        http_client=http_client
+    )
+    atexit.register(client.close)
+    logger.info('LLM client created (http2=%s, max_connections=%d)', http2, limits.max_connections)
+    return client
+
+
+def get_llm_client():
+    """获取进程内共享的大模型客户端
+
+    第一次调用时才创建，所有AIChat实例共用同一个连接池，
+    连接保持存活，后续请求不用重新建立TLS连接。
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = _create_client()
+    return _client
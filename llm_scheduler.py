@@ -0,0 +1,189 @@
+import os
+import time
+import random
+import logging
+import threading
+from collections import deque, OrderedDict
+
+from openai import APIConnectionError, APIStatusError, APITimeoutError, RateLimitError
+
+from metrics import counter, histogram
+
+logger = logging.getLogger(__name__)
+
+LLM_QUEUE_WAIT_SECONDS = histogram('chat_llm_queue_wait_seconds', '大模型请求在调度器中等待限流配额的时间')
+LLM_RETRIES = counter('chat_llm_retries_total', '大模型请求的重试次数', ['reason'])
+
+
+class SchedulerBusy(Exception):
+    """等待限流配额超过上限"""
+
+
+class TokenBucket:
+    """令牌桶：容量为每分钟的配额，按秒匀速补充；rate为0表示不限制"""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """还需要等待多少秒才能取出amount个令牌"""
+        if not self.rate:
+            return 0.0
+        self._refill(now)
+        amount = min(amount, self.capacity)  # 超过容量的请求在桶满时放行
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def take(self, amount):
+        if self.rate:
+            self.tokens -= min(amount, self.capacity)
+
+    def refund(self, amount):
+        """按实际用量修正预估的令牌数，amount为负数时继续扣减"""
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+def _retry_reason(error):
+    """可以重试的错误返回原因，否则返回None"""
+    if isinstance(error, RateLimitError):
+        return 'rate_limit'
+    if isinstance(error, APITimeoutError):
+        return 'timeout'
+    if isinstance(error, APIConnectionError):
+        return 'connection'
+    if isinstance(error, APIStatusError) and error.status_code >= 500:
+        return 'server_error'
+    return None
+
+
+def _retry_after(error):
+    """读取服务端返回的Retry-After（秒）"""
+    response = getattr(error, 'response', None)
+    try:
+        return float(response.headers.get('retry-after'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class LLMScheduler:
+    """大模型请求调度器
+
+    - 每分钟请求数（rpm）和每分钟token数（tpm）两个令牌桶限流，超出时排队等待而不是直接失败；
+    - 排队的请求按用户轮转放行，一个用户连续发送的请求不会挤占其他用户；
+    - 429和5xx按指数退避加随机抖动重试，遇到429时所有请求一起暂停。
+    """
+
+    def __init__(self, rpm=0, tpm=0, max_retries=3, base_delay=0.5, max_delay=20.0, max_wait=60.0):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()  # user_id -> deque[ticket]，顺序即轮转顺序
+        self._paused_until = 0.0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            rpm=int(os.getenv('AI_RATE_RPM', 0)),
+            tpm=int(os.getenv('AI_RATE_TPM', 0)),
+            max_retries=int(os.getenv('AI_MAX_RETRIES', 3)),
+            base_delay=float(os.getenv('AI_RETRY_BASE_DELAY', 0.5)),
+            max_delay=float(os.getenv('AI_RETRY_MAX_DELAY', 20)),
+            max_wait=float(os.getenv('AI_SCHEDULER_MAX_WAIT', 60))
+        )
+
+    def _acquire(self, user_id, tokens):
+        """排队等待配额，轮到该用户且两个令牌桶都足够时放行"""
+        ticket = object()
+        start = time.monotonic()
+        deadline = start + self.max_wait
+        with self._cond:
+            self._queues.setdefault(user_id, deque()).append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    head_user = next(iter(self._queues))
+                    if head_user == user_id and self._queues[user_id][0] is ticket:
+                        wait = max(self._paused_until - now,
+                                   self.requests.wait_time(1, now),
+                                   self.tokens.wait_time(tokens, now))
+                        if wait <= 0:
+                            self.requests.take(1)
+                            self.tokens.take(tokens)
+                            break
+                    else:
+                        wait = None
+                    if now >= deadline:
+                        raise SchedulerBusy('AI请求排队超时')
+                    self._cond.wait(min(wait, deadline - now) if wait is not None else deadline - now)
+            finally:
+                queue = self._queues[user_id]
+                queue.remove(ticket)
+                # 放行后该用户排到队尾，让其他用户先走
+                self._queues.pop(user_id)
+                if queue:
+                    self._queues[user_id] = queue
+                self._cond.notify_all()
+        LLM_QUEUE_WAIT_SECONDS.observe(time.monotonic() - start)
+
+    def settle(self, estimated_tokens, actual_tokens):
+        """请求完成后按实际token用量修正tpm配额"""
+        with self._cond:
+            self.tokens.refund(estimated_tokens - actual_tokens)
+            self._cond.notify_all()
+
+    def _backoff(self, attempt, error):
+        delay = _retry_after(error)
+        if delay is None:
+            # 完全随机抖动，避免大量请求在同一时刻重试
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if isinstance(error, RateLimitError):
+            with self._cond:
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        return delay
+
+    def run(self, user_id, fn, estimated_tokens=0):
+        """按限流和公平排队执行一次大模型调用，失败时按需重试
+
+        Args:
+            user_id: 发起请求的用户，用于公平排队
+            fn: 实际发起请求的函数
+            estimated_tokens: 预估的token数（提示词加最大回复长度），用于tpm限流
+
+        Returns:
+            fn的返回值；重试用尽后抛出最后一次的异常
+        """
+        attempt = 0
+        while True:
+            self._acquire(user_id, estimated_tokens)
+            try:
+                return fn()
+            except Exception as e:
+                reason = _retry_reason(e)
+                if reason is None or attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt, e)
+                attempt += 1
+                LLM_RETRIES.inc(reason=reason)
+                logger.warning('AI请求失败（%s），%.2f秒后第%d次重试', reason, delay, attempt)
+                # 失败的请求没有消耗token
+                self.settle(estimated_tokens, 0)
+                time.sleep(delay)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'waiting': sum(len(queue) for queue in self._queues.values()),
+                'waiting_users': len(self._queues),
+                'paused_for': max(0.0, round(self._paused_until - time.monotonic(), 3))
+            }
@@ -0,0 +1,199 @@
+"""日志配置：所有模块只用 logging.getLogger(__name__)，由入口调用 setup_logging 统一配置
+
+- 各线程只把日志记录放入内存队列，格式化和写磁盘由后台监听线程完成，不占用请求和Socket.IO处理时间；
+  队列满时丢弃并计数，而不是阻塞调用方。
+- LOG_FORMAT=json 时每行输出一个JSON对象，附带 request_id、sid、user_id、message_id 等上下文字段。
+- DEBUG日志按 LOG_DEBUG_SAMPLE_RATE 采样；高频的INFO日志可以在调用时传 extra={'sample_rate': 0.1}。
+- LOG_REDACT_CONTENT=1（默认）时不记录聊天内容，只记录长度；openai、httpx的逐请求日志只保留WARNING以上。
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import atexit
+import random
+import logging
+import contextvars
+from contextlib import contextmanager
+from collections.abc import Mapping
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from flask import g, request, session, has_request_context
+
+from metrics import counter
+
+LOG_DROPPED = counter('chat_log_dropped_total', '日志队列已满而丢弃的日志条数')
+
+# 结构化日志附带的上下文字段
+CONTEXT_FIELDS = ('request_id', 'sid', 'user_id', 'message_id', 'group_id', 'stream_id')
+# 参数中这些键的值视为聊天内容或凭据，只记录长度
+SENSITIVE_KEYS = frozenset({'content', 'password', 'confirm_password', 'media_url', 'delta'})
+
+_context = contextvars.ContextVar('log_context', default={})
+_listener = None
+REDACT_CONTENT = os.getenv('LOG_REDACT_CONTENT', '1') == '1'
+
+
+def redact(text, preview=50):
+    """日志中引用聊天内容时使用：开启脱敏时只保留长度，否则截取前preview个字符"""
+    if text is None:
+        return None
+    if REDACT_CONTENT:
+        return f'<{len(text)} chars>'
+    return text[:preview]
+
+
+def _redact_value(value):
+    if type(value) in (str, int, float, bool):
+        return value
+    if isinstance(value, Mapping):
+        return {key: f'<{len(str(item))} chars>' if key in SENSITIVE_KEYS and item else _redact_value(item)
+                for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_redact_value(item) for item in value)
+    return value
+
+
+@contextmanager
+def log_context(**fields):
+    """在当前线程（或协程）内为之后的日志附加上下文字段，用于没有请求上下文的后台任务"""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """在调用方线程中补充上下文字段，并对参数中的聊天内容脱敏"""
+
+    def filter(self, record):
+        for key, value in _context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        if has_request_context():
+            if not hasattr(record, 'request_id'):
+                record.request_id = g.get('request_id')
+            if not hasattr(record, 'sid'):
+                record.sid = getattr(request, 'sid', None)
+            if not hasattr(record, 'user_id'):
+                record.user_id = session.get('user_id')
+        if REDACT_CONTENT and record.args:
+            record.args = _redact_value(record.args)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """按比例采样：DEBUG日志使用debug_rate，其他日志可通过extra中的sample_rate指定"""
+
+    def __init__(self, debug_rate=1.0):
+        super().__init__()
+        self.debug_rate = debug_rate
+
+    def filter(self, record):
+        rate = getattr(record, 'sample_rate', None)
+        if rate is None:
+            rate = self.debug_rate if record.levelno < logging.INFO else 1.0
+        return rate >= 1.0 or random.random() < rate
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """调用方线程只合并消息参数后入队，队列满时丢弃"""
+
+    def prepare(self, record):
+        # 在这里求值消息和异常堆栈，监听线程不再访问调用方的对象；
+        # 根日志器上只有这一个处理器，直接修改记录，省去标准实现中的复制
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc()
+
+
+class _Listener(QueueListener):
+    def enqueue_sentinel(self):
+        # 队列满时也要等到结束标记入队，退出前把已排队的日志写完
+        self.queue.put(self._sentinel, timeout=5)
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志一行JSON，时间为UTC"""
+    converter = time.gmtime
+
+    def format(self, record):
+        data = {
+            'ts': self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + '.%03dZ' % record.msecs,
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'thread': record.threadName,
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def _output_handler():
+    path = os.getenv('LOG_FILE')
+    if path:
+        return RotatingFileHandler(path, maxBytes=int(os.getenv('LOG_FILE_MAX_BYTES', 50 * 1024 * 1024)),
+                                   backupCount=int(os.getenv('LOG_FILE_BACKUPS', 5)), encoding='utf-8')
+    return logging.StreamHandler(sys.stderr)
+
+
+def setup_logging(app=None):
+    """配置根日志器，重复调用时只生效一次
+
+    Args:
+        app: Flask应用实例，传入时为每个HTTP请求分配request_id（优先使用X-Request-ID请求头）
+    """
+    global _listener
+    if _listener is None:
+        output = _output_handler()
+        if os.getenv('LOG_FORMAT', 'text') == 'json':
+            output.setFormatter(JsonFormatter())
+        else:
+            output.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+        handler = NonBlockingQueueHandler(queue.Queue(maxsize=int(os.getenv('LOG_QUEUE_SIZE', 10000))))
+        handler.addFilter(SamplingFilter(float(os.getenv('LOG_DEBUG_SAMPLE_RATE', 1.0))))
+        handler.addFilter(ContextFilter())
+
+        root = logging.getLogger()
+        for existing in list(root.handlers):
+            root.removeHandler(existing)
+        root.addHandler(handler)
+        root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+        # httpx每次请求都输出一行INFO，openai的DEBUG日志包含完整的请求内容
+        for name in ('httpx', 'httpcore', 'openai'):
+            logging.getLogger(name).setLevel(logging.WARNING)
+
+        _listener = _Listener(handler.queue, output, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+    if app is not None and not app.extensions.get('request_logging'):
+        app.extensions['request_logging'] = True
+
+        @app.before_request
+        def assign_request_id():
+            g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex[:16]
+
+        @app.after_request
+        def expose_request_id(response):
+            if g.get('request_id'):
+                response.headers['X-Request-ID'] = g.request_id
+            return response
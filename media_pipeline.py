@@ -0,0 +1,281 @@
+import os
+import re
+import shutil
+import logging
+import mimetypes
+import threading
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from flask import session, jsonify, send_file, abort, redirect, url_for
+
+from models import FileShare
+from metrics import MEDIA_PIPELINE_PENDING
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # 未安装Pillow时不生成缩略图，客户端使用原图
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# sha256的十六进制小写形式，来自URL的哈希必须先校验再拼接路径
+CONTENT_HASH_RE = re.compile(r'[0-9a-f]{64}')
+
+IMAGE_TYPES = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+VOICE_TYPES = {'mp3', 'wav', 'm4a', 'aac', 'ogg', 'webm', 'amr'}
+
+# 衍生文件：名称 -> (适用的消息类型, 扩展名, MIME类型)
+VARIANTS = {
+    'thumb': ('image', 'jpg', 'image/jpeg'),
+    'voice': ('voice', 'ogg', 'audio/ogg'),
+}
+
+
+def media_kind(file_type):
+    """根据扩展名判断媒体类型，非图片、语音返回None"""
+    file_type = (file_type or '').lower()
+    if file_type in IMAGE_TYPES:
+        return 'image'
+    if file_type in VOICE_TYPES:
+        return 'voice'
+    return None
+
+
+def is_content_hash(value):
+    return isinstance(value, str) and CONTENT_HASH_RE.fullmatch(value) is not None
+
+
+def variant_relpath(content_hash, variant):
+    """衍生文件的存储路径，相对于UPLOAD_FOLDER，同一内容只生成一次"""
+    if not is_content_hash(content_hash):
+        raise ValueError('无效的内容哈希')
+    return os.path.join('media', content_hash[:2], content_hash, f'{variant}.{VARIANTS[variant][1]}')
+
+
+def make_thumbnail(src, dest, size):
+    """生成JPEG缩略图（在工作进程中执行）"""
+    with Image.open(src) as image:
+        # JPEG可以在解码时直接缩小，大图省去大部分解码开销
+        image.draft('RGB', (size * 2, size * 2))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        tmp = dest + '.tmp'
+        image.save(tmp, 'JPEG', quality=80, optimize=True, progressive=True)
+    os.replace(tmp, dest)
+
+
+def transcode_voice(src, dest, bitrate):
+    """把语音转码为单声道Opus（在工作进程中执行）"""
+    tmp = dest + '.tmp'
+    subprocess.run(
+        ['ffmpeg', '-nostdin', '-loglevel', 'error', '-y', '-i', src,
+         '-vn', '-ac', '1', '-c:a', 'libopus', '-b:a', bitrate, '-f', 'ogg', tmp],
+        check=True, timeout=120, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+    os.replace(tmp, dest)
+
+
+class MediaPipeline:
+    """媒体处理队列
+
+    上传完成后为图片生成缩略图、为语音生成压缩版本。
+    编解码在独立的进程池中执行，不占用请求和Socket.IO处理线程；
+    失败的任务按指数退避重试，结果按内容哈希缓存在磁盘上。
+    """
+
+    def __init__(self, upload_folder, max_workers=2, max_retries=3, retry_delay=2.0,
+                 thumb_size=320, voice_bitrate='24k'):
+        self.upload_folder = upload_folder
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.thumb_size = thumb_size
+        self.voice_bitrate = voice_bitrate
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = {}  # (content_hash, variant) -> 当前尝试次数
+        self._failed = set()  # 重试耗尽的任务，本进程内不再提交
+        self._stats = {'submitted': 0, 'completed': 0, 'retried': 0, 'failed': 0}
+
+    @classmethod
+    def from_config(cls, config):
+        """根据Flask配置创建处理队列"""
+        return cls(
+            config['UPLOAD_FOLDER'],
+            max_workers=config.get('MEDIA_WORKERS', 2),
+            max_retries=config.get('MEDIA_MAX_RETRIES', 3),
+            thumb_size=config.get('MEDIA_THUMB_SIZE', 320),
+            voice_bitrate=config.get('MEDIA_VOICE_BITRATE', '24k')
+        )
+
+    def supports(self, variant):
+        """当前环境能否生成该衍生文件"""
+        if variant == 'thumb':
+            return Image is not None
+        if variant == 'voice':
+            return shutil.which('ffmpeg') is not None
+        return False
+
+    def path(self, content_hash, variant):
+        return os.path.join(self.upload_folder, variant_relpath(content_hash, variant))
+
+    def enqueue(self, content_hash, file_type):
+        """为新上传的文件安排处理任务，已生成或正在处理的不会重复提交
+
+        Returns:
+            list: 本次提交的衍生文件名称
+        """
+        kind = media_kind(file_type)
+        submitted = []
+        for variant, (variant_kind, _, _) in VARIANTS.items():
+            if variant_kind != kind or not self.supports(variant):
+                continue
+            key = (content_hash, variant)
+            with self._lock:
+                if key in self._pending or key in self._failed or os.path.exists(self.path(*key)):
+                    continue
+                self._pending[key] = 0
+                self._stats['submitted'] += 1
+            self._submit(key)
+            submitted.append(variant)
+        return submitted
+
+    def _submit(self, key):
+        content_hash, variant = key
+        src = os.path.join(self.upload_folder, 'blobs', content_hash[:2], content_hash)
+        dest = self.path(content_hash, variant)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if variant == 'thumb':
+            job = (make_thumbnail, src, dest, self.thumb_size)
+        else:
+            job = (transcode_voice, src, dest, self.voice_bitrate)
+
+        try:
+            future = self._get_executor().submit(*job)
+        except (BrokenProcessPool, RuntimeError) as e:
+            # 工作进程异常退出后进程池不可再用，重建后按失败处理
+            with self._lock:
+                self._executor = None
+            self._finish(key, e)
+            return
+        future.add_done_callback(lambda f: self._finish(key, f.exception()))
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            return self._executor
+
+    def _finish(self, key, error):
+        with self._lock:
+            if error is None:
+                self._pending.pop(key, None)
+                self._stats['completed'] += 1
+                return
+            attempt = self._pending.get(key, 0) + 1
+            if attempt > self.max_retries:
+                self._pending.pop(key, None)
+                self._failed.add(key)
+                self._stats['failed'] += 1
+            else:
+                self._pending[key] = attempt
+                self._stats['retried'] += 1
+
+        if attempt > self.max_retries:
+            logger.error('媒体处理失败 %s/%s: %s', key[0], key[1], error)
+            return
+        delay = self.retry_delay * 2 ** (attempt - 1)
+        logger.warning('媒体处理失败 %s/%s，%.1f秒后第%d次重试: %s', key[0], key[1], delay, attempt, error)
+        timer = threading.Timer(delay, self._submit, args=(key,))
+        timer.daemon = True
+        timer.start()
+
+    def backlog(self):
+        """队列状态：待处理数量及累计统计"""
+        with self._lock:
+            return dict(self._stats, pending=len(self._pending), workers=self.max_workers)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def init_media_pipeline(app):
+    """初始化媒体处理队列及媒体访问路由
+
+    Args:
+        app: Flask应用实例
+    """
+    pipeline = MediaPipeline.from_config(app.config)
+    app.extensions['media_pipeline'] = pipeline
+    MEDIA_PIPELINE_PENDING.set_function(lambda: pipeline.backlog()['pending'])
+    upload_folder = app.config['UPLOAD_FOLDER']
+
+    def find_file(content_hash):
+        return FileShare.query.filter_by(content_hash=content_hash).first()
+
+    @app.route('/media/<content_hash>')
+    def media_original(content_hash):
+        """按内容哈希访问媒体原文件"""
+        if 'user_id' not in session:
+            abort(401)
+        if not is_content_hash(content_hash):
+            abort(404)
+        file_share = find_file(content_hash)
+        if file_share is None:
+            abort(404)
+        path = os.path.join(upload_folder, file_share.filename)
+        if not os.path.isfile(path):
+            abort(404)
+        response = send_file(
+            path,
+            mimetype=mimetypes.guess_type(file_share.original_filename)[0] or 'application/octet-stream',
+            conditional=True,
+            etag=content_hash,
+            max_age=app.config['DOWNLOAD_MAX_AGE']
+        )
+        response.cache_control.public = False
+        response.cache_control.private = True
+        return response
+
+    @app.route('/media/<content_hash>/<variant>')
+    def media_variant(content_hash, variant):
+        """访问缩略图等衍生文件，尚未生成时先返回原文件"""
+        if 'user_id' not in session:
+            abort(401)
+        if variant not in VARIANTS or not is_content_hash(content_hash):
+            abort(404)
+        path = pipeline.path(content_hash, variant)
+        if not os.path.isfile(path):
+            file_share = find_file(content_hash)
+            if file_share is None:
+                abort(404)
+            # 补上遗漏的任务（例如进程重启时丢失的队列），本次请求不等待
+            pipeline.enqueue(content_hash, file_share.file_type)
+            return redirect(url_for('media_original', content_hash=content_hash))
+
+        response = send_file(
+            path,
+            mimetype=VARIANTS[variant][2],
+            conditional=True,
+            etag=f'{content_hash}-{variant}',
+            max_age=app.config['DOWNLOAD_MAX_AGE']
+        )
+        response.cache_control.public = False
+        response.cache_control.private = True
+        return response
+
+    @app.route('/api/media/backlog')
+    def media_backlog():
+        """查看媒体处理队列积压情况"""
+        if 'user_id' not in session:
+            return jsonify({'error': '请先登录'}), 401
+        return jsonify(pipeline.backlog())
+
+    return pipeline
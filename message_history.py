@@ -0,0 +1,68 @@
+import base64
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+from models import Message, conversation_key
+from archive import load_archived_page
+
+DEFAULT_PAGE_SIZE = 30
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(message):
+    """把消息的 (timestamp, id) 编码为不透明的游标字符串"""
+    raw = f'{message.timestamp.isoformat()}|{message.id}'
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """解析游标，格式不正确时抛出ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        timestamp, message_id = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(message_id)
+    except Exception:
+        raise ValueError('无效的分页游标')
+
+
+def clamp_limit(limit):
+    """限制每页条数"""
+    try:
+        limit = int(limit or DEFAULT_PAGE_SIZE)
+    except (TypeError, ValueError):
+        limit = DEFAULT_PAGE_SIZE
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def load_conversation_page(user_id, peer_id, before=None, limit=DEFAULT_PAGE_SIZE):
+    """按游标加载一页会话历史
+
+    使用 (timestamp, id) 键集分页，查询走会话复合索引，
+    无论翻到多早的历史，每页的代价都与页大小成正比。
+    翻过热表中最早的消息后透明地读取归档（见archive.py）。
+
+    Args:
+        user_id: 当前用户ID
+        peer_id: 对方用户ID
+        before: 上一页返回的游标，为空时从最新消息开始
+        limit: 每页条数
+
+    Returns:
+        tuple: (按时间正序排列的消息列表, 更早一页的游标或None)
+    """
+    limit = clamp_limit(limit)
+    query = Message.query.filter(Message.conversation == conversation_key(user_id, peer_id))
+    if before:
+        timestamp, message_id = decode_cursor(before)
+        query = query.filter(tuple_(Message.timestamp, Message.id) < (timestamp, message_id))
+
+    rows = query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit + 1).all()
+    if len(rows) <= limit:
+        # 热表中已经没有更早的消息，从归档中补齐这一页
+        oldest = (rows[-1].timestamp, rows[-1].id) if rows else (decode_cursor(before) if before else None)
+        rows += load_archived_page(conversation_key(user_id, peer_id), oldest, limit + 1 - len(rows))
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    rows = rows[:limit]
+    rows.reverse()
+    return rows, next_cursor
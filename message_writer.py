@@ -0,0 +1,133 @@
+import queue
+import logging
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+from models import db
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter:
+    """消息批量写入器（group commit）
+
+    各事件处理线程提交待写入的记录，后台线程在很短的时间窗口内把它们攒成一批，
+    用一个事务一次提交。SQLite每次提交都要fsync，合并提交能显著提高吞吐；
+    提交者在事务落盘之后才拿到结果，确认语义保持不变。
+    """
+
+    def __init__(self, app, max_batch=100, max_delay=0.005):
+        self.app = app
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    @classmethod
+    def from_config(cls, app):
+        """根据Flask配置创建写入器"""
+        return cls(
+            app,
+            max_batch=app.config.get('MESSAGE_BATCH_SIZE', 100),
+            max_delay=app.config.get('MESSAGE_BATCH_DELAY_MS', 5) / 1000.0
+        )
+
+    def start(self):
+        """启动后台写入线程"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        """写完已提交的记录后停止"""
+        self._stopped.set()
+        self._queue.put(None)
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def submit(self, model_cls, **fields):
+        """提交一条待写入的记录
+
+        Returns:
+            Future: 所在批次提交成功后返回记录的to_dict()
+        """
+        future = Future()
+        if self._stopped.is_set():
+            future.set_exception(RuntimeError('消息写入器已停止'))
+            return future
+        self._queue.put((model_cls, fields, future))
+        return future
+
+    def write(self, model_cls, timeout=10, **fields):
+        """提交记录并等待所在批次提交
+
+        超时时撤回仍在排队的记录，保证调用方看到失败时这条记录不会在之后的批次中写入；
+        记录已经进入正在提交的批次时不能撤回，继续等待结果。
+        """
+        future = self.submit(model_cls, **fields)
+        try:
+            return future.result(timeout)
+        except FutureTimeout:
+            if future.cancel():
+                raise
+            return future.result()
+
+    @property
+    def backlog(self):
+        """等待写入的记录数"""
+        return self._queue.qsize()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._stopped.set()
+                    break
+                batch.append(item)
+
+            # 跳过调用方已超时撤回的记录；之后的记录不能再撤回
+            batch = [entry for entry in batch if entry[2].set_running_or_notify_cancel()]
+            if batch:
+                self._flush(batch)
+            if self._stopped.is_set() and self._queue.empty():
+                break
+
+    def _flush(self, batch):
+        with self.app.app_context():
+            try:
+                records = [model_cls(**fields) for model_cls, fields, _ in batch]
+                db.session.add_all(records)
+                db.session.flush()
+                # 提交前序列化，避免提交后过期的对象逐条重新查询
+                results = [record.to_dict() for record in records]
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                if len(batch) == 1:
+                    logger.error('写入消息失败: %s', str(e), exc_info=True)
+                    batch[0][2].set_exception(e)
+                    return
+                # 批量失败时逐条重试，避免一条坏数据拖累整批
+                logger.warning('批量写入%d条消息失败，改为逐条写入: %s', len(batch), str(e))
+                for entry in batch:
+                    self._flush([entry])
+                return
+
+            logger.debug('批量写入%d条消息', len(batch))
+            for result, (_, _, future) in zip(results, batch):
+                future.set_result(result)
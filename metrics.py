@@ -0,0 +1,224 @@
+import os
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+
+from flask import request, Response
+
+logger = logging.getLogger(__name__)
+
+# 延迟直方图的默认分桶（秒），覆盖数据库提交到大模型长回复
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """指标基类，按标签值保存各个序列，记录时只持有一把锁做一次字典更新"""
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f'{self.name} 需要标签 {self.labelnames}')
+        return tuple(labels[name] for name in self.labelnames)
+
+    def _samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for name, key, value in self._samples():
+            lines.append(f'{name}{_format_labels(self.labelnames, key)} {_format_value(value)}')
+        return lines
+
+
+class Counter(_Metric):
+    """只增不减的计数"""
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """可增可减的当前值；也可以在采集时调用函数取值"""
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function):
+        """采集时调用function取值，用于队列积压等已有的状态"""
+        self._function = function
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def _samples(self):
+        if self._function is None:
+            return super()._samples()
+        try:
+            return [(self.name, (), self._function())]
+        except Exception as e:
+            logger.warning('采集指标 %s 失败: %s', self.name, e)
+            return []
+
+
+class Histogram(_Metric):
+    """分桶统计的分布，例如各阶段耗时"""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # [各桶计数（非累计）, 总和, 次数]
+                series = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            series = [(key, list(counts), total, count) for key, (counts, total, count) in self._values.items()]
+        for key, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % _format_value(bound)
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Prometheus文本格式"""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+# 聊天链路的指标
+STAGE_SECONDS = histogram(
+    'chat_stage_seconds', '聊天消息各处理阶段耗时：validate、persist_user、llm、persist_reply、emit', ['stage'])
+LLM_FIRST_TOKEN_SECONDS = histogram('chat_llm_first_token_seconds', '流式回复从发出请求到收到第一段文本的耗时')
+LLM_TOKENS = counter('chat_llm_tokens_total', '大模型接口返回的token用量', ['kind'])
+LLM_INFLIGHT = gauge('chat_llm_inflight', '正在进行的大模型调用数')
+ERRORS = counter('chat_errors_total', '按阶段和异常类型统计的错误数', ['stage', 'type'])
+SOCKET_CONNECTIONS = gauge('chat_socket_connections', '当前工作进程上已登录的Socket.IO连接数')
+AI_DISPATCH_PENDING = gauge('chat_ai_dispatch_pending', 'AI回复调度器中排队及执行中的任务数')
+MESSAGE_WRITER_BACKLOG = gauge('chat_message_writer_backlog', '等待批量提交的消息数')
+MEDIA_PIPELINE_PENDING = gauge('chat_media_pipeline_pending', '媒体处理队列中未完成的任务数')
+
+
+def record_error(stage, error):
+    ERRORS.inc(stage=stage, type=type(error).__name__)
+
+
+def init_metrics(app):
+    """注册 /metrics 接口
+
+    每个工作进程只暴露自己的指标，多进程部署时由Prometheus逐个采集。
+    设置METRICS_TOKEN后需要携带 Authorization: Bearer <token>。
+
+    Args:
+        app: Flask应用实例
+    """
+    token = os.getenv('METRICS_TOKEN')
+
+    @app.route('/metrics')
+    def metrics():
+        if token and request.headers.get('Authorization') != f'Bearer {token}':
+            return Response('Unauthorized\n', status=401, mimetype='text/plain')
+        return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
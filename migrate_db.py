@@ -1,20 +1,88 @@
-import sqlite3
+from sqlalchemy import inspect, text, DateTime
 
-def add_is_bot_column():
-    conn = sqlite3.connect('instance/database.db')
-    cursor = conn.cursor()
-    
-    try:
+from database import create_standalone_engine
+
+def _has_column(conn, table, column):
+    return column in {col['name'] for col in inspect(conn).get_columns(table)}
+
+def add_is_bot_column(engine):
+    with engine.begin() as conn:
         # Check if is_bot column exists
-        cursor.execute("SELECT is_bot FROM user LIMIT 1")
-    except sqlite3.OperationalError:
-        # Add is_bot column if it doesn't exist
-        print("Adding is_bot column to user table...")
-        cursor.execute("ALTER TABLE user ADD COLUMN is_bot BOOLEAN DEFAULT FALSE")
-        conn.commit()
-        print("Column added successfully!")
-    
-    conn.close()
+        if not _has_column(conn, 'user', 'is_bot'):
+            # Add is_bot column if it doesn't exist
+            print("Adding is_bot column to user table...")
+            conn.execute(text('ALTER TABLE "user" ADD COLUMN is_bot BOOLEAN DEFAULT FALSE'))
+            print("Column added successfully!")
+
+def add_conversation_column(engine):
+    with engine.begin() as conn:
+        # Check if conversation column exists
+        if not _has_column(conn, 'message', 'conversation'):
+            # Add conversation column and backfill it from sender/recipient
+            print("Adding conversation column to message table...")
+            conn.execute(text("ALTER TABLE message ADD COLUMN conversation VARCHAR(64)"))
+            conn.execute(text(
+                "UPDATE message SET conversation = CASE WHEN sender_id < recipient_id "
+                "THEN CAST(sender_id AS VARCHAR(20)) || ':' || CAST(recipient_id AS VARCHAR(20)) "
+                "ELSE CAST(recipient_id AS VARCHAR(20)) || ':' || CAST(sender_id AS VARCHAR(20)) END"
+            ))
+            print("Column added successfully!")
+
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_message_conversation_timestamp "
+            "ON message (conversation, timestamp, id)"
+        ))
+
+def add_content_hash_column(engine):
+    with engine.begin() as conn:
+        # Check if content_hash column exists
+        if not _has_column(conn, 'file_share', 'content_hash'):
+            print("Adding content_hash column to file_share table...")
+            conn.execute(text("ALTER TABLE file_share ADD COLUMN content_hash VARCHAR(64)"))
+            print("Column added successfully!")
+
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_file_share_content_hash ON file_share (content_hash)"
+        ))
+
+def add_file_share_indexes(engine):
+    with engine.begin() as conn:
+        # Composite indexes for the paginated file listing
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_file_share_type_time ON file_share (file_type, upload_time, id)"
+        ))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_file_share_owner_time ON file_share (user_id, upload_time, id)"
+        ))
+
+def add_post_updated_at_column(engine):
+    with engine.begin() as conn:
+        # Check if updated_at column exists
+        if not _has_column(conn, 'post', 'updated_at'):
+            print("Adding updated_at column to post table...")
+            # 按当前数据库方言生成列类型（SQLite/MySQL为DATETIME，PostgreSQL为TIMESTAMP）
+            column_type = DateTime().compile(dialect=conn.dialect)
+            conn.execute(text(f"ALTER TABLE post ADD COLUMN updated_at {column_type}"))
+            conn.execute(text("UPDATE post SET updated_at = created_at WHERE updated_at IS NULL"))
+            print("Column added successfully!")
+
+def add_unread_counter_sync_index(engine):
+    with engine.begin() as conn:
+        # unread_counter is created by db.create_all() on app start, together with this index
+        if not inspect(conn).has_table('unread_counter'):
+            print("unread_counter table does not exist yet, skipping sync index")
+            return
+        # Index for replaying read receipts on reconnect
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_unread_counter_peer_updated ON unread_counter (peer_id, updated_at)"
+        ))
 
 if __name__ == "__main__":
-    add_is_bot_column()
+    # 与应用共用同一套数据库配置（DATABASE_URL等）
+    engine = create_standalone_engine()
+    add_is_bot_column(engine)
+    add_conversation_column(engine)
+    add_content_hash_column(engine)
+    add_file_share_indexes(engine)
+    add_post_updated_at_column(engine)
+    add_unread_counter_sync_index(engine)
@@ -1,11 +1,35 @@
+import os
+import shutil
+
 from app import app, db
 from models import FileShare
 
+# 旧版本把上传文件保存在Flask公开的static目录下
+LEGACY_UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'uploads')
+
 def migrate():
     with app.app_context():
         # 创建 file_share 表
         db.create_all()
         print("FileShare table created successfully!")
 
+def move_legacy_uploads():
+    """把static/uploads下的文件移到UPLOAD_FOLDER，相对路径不变，FileShare记录无需修改"""
+    upload_folder = app.config['UPLOAD_FOLDER']
+    if not os.path.isdir(LEGACY_UPLOAD_FOLDER) or os.path.abspath(upload_folder) == LEGACY_UPLOAD_FOLDER:
+        return
+    moved = 0
+    for root, _, names in os.walk(LEGACY_UPLOAD_FOLDER):
+        for name in names:
+            src = os.path.join(root, name)
+            dest = os.path.join(upload_folder, os.path.relpath(src, LEGACY_UPLOAD_FOLDER))
+            if os.path.exists(dest):
+                continue
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            shutil.move(src, dest)
+            moved += 1
+    print(f"Moved {moved} files from {LEGACY_UPLOAD_FOLDER} to {upload_folder}")
+
 if __name__ == '__main__':
     migrate()
+    move_legacy_uploads()
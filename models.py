@@ -1,4 +1,5 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
 from datetime import datetime
 from werkzeug.security import generate_password_hash
 
@@ -29,12 +30,35 @@ class Post(db.Model):
     title = db.Column(db.String(100), nullable=False)
     content = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)  # 渲染缓存的版本
     user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
 
     def __repr__(self):
         return f'<Post {self.title}>'
 
+def conversation_key(user_a, user_b):
+    """单聊会话键，由参与双方的ID按大小排序组成"""
+    low, high = sorted((int(user_a), int(user_b)))
+    return f'{low}:{high}'
+
+# 媒体消息附带的衍生文件：消息类型 -> {字段名: 衍生文件名称}，由media_pipeline生成
+MEDIA_VARIANTS = {
+    'image': {'thumbnail_url': 'thumb'},
+    'voice': {'compressed_url': 'voice'},
+}
+
+def media_variant_urls(message_type, media_url):
+    """媒体消息的衍生文件地址，按内容寻址的媒体（/media/<hash>）才有衍生文件"""
+    if not media_url or not media_url.startswith('/media/'):
+        return {}
+    return {field: f'{media_url}/{variant}' for field, variant in MEDIA_VARIANTS.get(message_type, {}).items()}
+
 class Message(db.Model):
+    __table_args__ = (
+        # 按会话分页加载历史：WHERE conversation = ? ORDER BY timestamp, id
+        db.Index('ix_message_conversation_timestamp', 'conversation', 'timestamp', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text)  # 文本内容
     message_type = db.Column(db.String(20), nullable=False)  # text, image, voice
@@ -44,12 +68,13 @@ class Message(db.Model):
     recipient_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
     status = db.Column(db.String(20), default='sending')  # sending, sent, read
     read_at = db.Column(db.DateTime)  # 消息已读时间
+    conversation = db.Column(db.String(64))  # 会话键，见conversation_key
 
     def __repr__(self):
         return f'<Message {self.content[:20]}...>'
 
     def to_dict(self):
-        return {
+        data = {
             'id': self.id,
             'content': self.content,
             'message_type': self.message_type,
@@ -60,8 +85,131 @@ class Message(db.Model):
             'status': self.status,
             'read_at': self.read_at.strftime('%Y-%m-%d %H:%M:%S') if self.read_at else None
         }
+        data.update(media_variant_urls(self.message_type, self.media_url))
+        return data
+
+@event.listens_for(Message, 'before_insert')
+def _set_conversation(mapper, connection, target):
+    if not target.conversation:
+        target.conversation = conversation_key(target.sender_id, target.recipient_id)
+
+class ChatGroup(db.Model):
+    """群聊"""
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    members = db.relationship('GroupMember', backref='group', lazy=True, cascade='all, delete-orphan')
+
+    def __repr__(self):
+        return f'<ChatGroup {self.name}>'
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'owner_id': self.owner_id,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S')
+        }
+
+class GroupMember(db.Model):
+    """群成员及其已读水位，未读数由水位之后的群消息数得出"""
+    __table_args__ = (
+        # 查询用户加入的所有群
+        db.Index('ix_group_member_user', 'user_id', 'group_id'),
+    )
+
+    group_id = db.Column(db.Integer, db.ForeignKey('chat_group.id', ondelete='CASCADE'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    joined_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_read_id = db.Column(db.Integer, nullable=False, default=0)  # 已读到的最大群消息ID
+
+    def __repr__(self):
+        return f'<GroupMember {self.group_id}:{self.user_id}>'
+
+class GroupMessage(db.Model):
+    """群消息，每条只存一份，与群成员数无关"""
+    __table_args__ = (
+        # 按群分页加载历史、按水位统计未读：WHERE group_id = ? AND id > ?
+        db.Index('ix_group_message_group_id', 'group_id', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    group_id = db.Column(db.Integer, db.ForeignKey('chat_group.id', ondelete='CASCADE'), nullable=False)
+    sender_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    content = db.Column(db.Text)
+    message_type = db.Column(db.String(20), nullable=False, default='text')  # text, image, voice
+    media_url = db.Column(db.String(500))
+    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<GroupMessage {self.group_id}:{self.id}>'
+
+    def to_dict(self):
+        data = {
+            'id': self.id,
+            'group_id': self.group_id,
+            'sender_id': self.sender_id,
+            'content': self.content,
+            'message_type': self.message_type,
+            'media_url': self.media_url,
+            'timestamp': self.timestamp.strftime('%Y-%m-%d %H:%M:%S')
+        }
+        data.update(media_variant_urls(self.message_type, self.media_url))
+        return data
+
+class ArchiveSegment(db.Model):
+    """归档清单：一个会话在一个月份内被移出消息表的一段消息，存放在一个gzip压缩的JSONL文件中"""
+    __table_args__ = (
+        # 历史翻页越过热数据后按会话、时间查找归档文件
+        db.Index('ix_archive_segment_conversation_time', 'conversation', 'last_timestamp'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    conversation = db.Column(db.String(64), nullable=False)
+    period = db.Column(db.String(7), nullable=False)  # 月份分区，如 2024-05
+    path = db.Column(db.String(500), nullable=False)  # 相对于归档目录的路径
+    first_id = db.Column(db.Integer, nullable=False)
+    last_id = db.Column(db.Integer, nullable=False)
+    first_timestamp = db.Column(db.DateTime, nullable=False)
+    last_timestamp = db.Column(db.DateTime, nullable=False)
+    message_count = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<ArchiveSegment {self.conversation} {self.period}>'
+
+class UnreadCounter(db.Model):
+    """每个 (用户, 会话对象) 的未读消息数及已读水位"""
+    __table_args__ = (
+        # 重连同步时按时间查询对方的已读回执：WHERE peer_id = ? AND updated_at > ?
+        db.Index('ix_unread_counter_peer_updated', 'peer_id', 'updated_at'),
+    )
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    peer_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    last_read_id = db.Column(db.Integer, nullable=False, default=0)  # 已读到的最大消息ID
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<UnreadCounter {self.user_id}:{self.peer_id}={self.count}>'
+
+class ChatContext(db.Model):
+    """AI对话上下文状态"""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    cleared_at = db.Column(db.DateTime)  # 最近一次清除AI对话历史的时间
+
+    def __repr__(self):
+        return f'<ChatContext {self.user_id}>'
 
 class FileShare(db.Model):
+    __table_args__ = (
+        # 文件列表按类型、上传者过滤后以 (upload_time, id) 分页
+        db.Index('ix_file_share_type_time', 'file_type', 'upload_time', 'id'),
+        db.Index('ix_file_share_owner_time', 'user_id', 'upload_time', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(255), nullable=False)
     original_filename = db.Column(db.String(255), nullable=False, index=True)
@@ -70,10 +218,38 @@ class FileShare(db.Model):
     upload_time = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
     description = db.Column(db.String(500))  # 文件描述
+    content_hash = db.Column(db.String(64), index=True)  # 文件内容的SHA-256，相同内容共用一个blob
 
     def __repr__(self):
         return f'<FileShare {self.original_filename}>'
 
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'original_filename': self.original_filename,
+            'file_size': self.file_size,
+            'file_type': self.file_type,
+            'upload_time': self.upload_time.strftime('%Y-%m-%d %H:%M:%S') if self.upload_time else None,
+            'user_id': self.user_id,
+            'description': self.description,
+            'content_hash': self.content_hash,
+            'download_url': f'/files/{self.id}/download',
+            'media_url': f'/media/{self.content_hash}' if self.content_hash else None
+        }
+
+class UploadSession(db.Model):
+    """分块上传会话，已接收的字节数以磁盘上临时文件的大小为准"""
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    original_filename = db.Column(db.String(255), nullable=False)
+    file_size = db.Column(db.Integer, nullable=False)  # 声明的文件总大小
+    expected_hash = db.Column(db.String(64))  # 客户端声明的SHA-256，完成时校验
+    description = db.Column(db.String(500))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<UploadSession {self.id}>'
+
 def init_ai_assistant(app):
     """初始化AI助手用户"""
     with app.app_context():
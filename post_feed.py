@@ -0,0 +1,143 @@
+import os
+import base64
+import threading
+from collections import OrderedDict
+
+from flask import render_template
+from markupsafe import Markup
+from sqlalchemy import event, tuple_
+from sqlalchemy.orm import joinedload
+
+from models import db, Post
+from message_history import decode_cursor, clamp_limit, DEFAULT_PAGE_SIZE
+
+
+class FragmentCache:
+    """帖子渲染结果缓存
+
+    以 (片段类型, 帖子ID, 更新时间) 为键缓存渲染好的HTML，按LRU淘汰并限制总字节数。
+    帖子修改后更新时间变化，旧的缓存自然不会再命中；
+    本进程内的修改、删除还会立即清掉该帖子的所有片段。
+    """
+
+    def __init__(self, max_bytes=4 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> html
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(max_bytes=int(os.getenv('POST_RENDER_CACHE_BYTES', 4 * 1024 * 1024)))
+
+    def get(self, key):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is None:
+                self._counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return html
+
+    def set(self, key, html):
+        size = len(html.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old.encode('utf-8'))
+            self._entries[key] = html
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.encode('utf-8'))
+                self._counters['evictions'] += 1
+
+    def invalidate(self, post_id):
+        """清除某个帖子的所有片段"""
+        with self._lock:
+            for key in [key for key in self._entries if key[1] == post_id]:
+                self._bytes -= len(self._entries.pop(key).encode('utf-8'))
+                self._counters['invalidations'] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, entries=len(self._entries), bytes=self._bytes)
+
+
+render_cache = FragmentCache.from_env()
+
+
+@event.listens_for(Post, 'after_update')
+@event.listens_for(Post, 'after_delete')
+def _invalidate_post(mapper, connection, target):
+    render_cache.invalidate(target.id)
+
+
+def _render(fragment, post):
+    """渲染帖子片段并写入缓存
+
+    Args:
+        fragment: 片段类型，post 为详情页正文，feed_item 为信息流中的一项
+        post: Post实例，作者应已随查询一起加载
+    """
+    html = render_template(f'partials/{fragment}.html', post=post)
+    render_cache.set((fragment, post.id, post.updated_at), html)
+    return Markup(html)
+
+
+def render_post(post_id):
+    """渲染帖子详情正文
+
+    先按主键只查 (id, title, user_id, updated_at)，用 (帖子ID, 更新时间) 查缓存；
+    命中时不加载帖子正文和作者，也不渲染正文模板。更新时间必须查库才能知道缓存是否过期，
+    这条窄查询与信息流的第一次查询相同；未命中时再连同作者加载完整的帖子并渲染。
+
+    Returns:
+        tuple: (包含 id、title、user_id、updated_at 的行, 渲染好的HTML)；帖子不存在时返回 (None, None)
+    """
+    row = db.session.query(Post.id, Post.title, Post.user_id, Post.updated_at).filter(Post.id == post_id).first()
+    if row is None:
+        return None, None
+    html = render_cache.get(('post', row.id, row.updated_at))
+    if html is not None:
+        return row, Markup(html)
+    post = Post.query.options(joinedload(Post.author)).filter(Post.id == post_id).first()
+    if post is None:
+        return None, None
+    return post, _render('post', post)
+
+
+def encode_cursor(post):
+    """把帖子的 (created_at, id) 编码为不透明的游标字符串"""
+    raw = f'{post.created_at.isoformat()}|{post.id}'
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def load_feed_page(before=None, limit=DEFAULT_PAGE_SIZE):
+    """按游标加载一页帖子信息流，最新的在前
+
+    第一次查询只取 (id, created_at, updated_at)；缓存中没有的帖子
+    再用一条查询连同作者一起批量加载，然后渲染。
+
+    Returns:
+        tuple: ([(帖子ID, 渲染好的HTML)], 下一页的游标或None)
+    """
+    limit = clamp_limit(limit)
+    query = db.session.query(Post.id, Post.created_at, Post.updated_at)
+    if before:
+        created_at, post_id = decode_cursor(before)
+        query = query.filter(tuple_(Post.created_at, Post.id) < (created_at, post_id))
+    rows = query.order_by(Post.created_at.desc(), Post.id.desc()).limit(limit + 1).all()
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    rows = rows[:limit]
+
+    html = {row.id: render_cache.get(('feed_item', row.id, row.updated_at)) for row in rows}
+    missing = [post_id for post_id, value in html.items() if value is None]
+    if missing:
+        for post in Post.query.options(joinedload(Post.author)).filter(Post.id.in_(missing)):
+            html[post.id] = _render('feed_item', post)
+    return [(row.id, Markup(html[row.id])) for row in rows if html.get(row.id) is not None], next_cursor
@@ -0,0 +1,133 @@
+import time
+import logging
+import threading
+
+from flask import request, session, jsonify
+
+from metrics import gauge
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_ONLINE = gauge('chat_presence_online_users', '当前工作进程上在线的用户数')
+
+
+class PresenceRegistry:
+    """在线状态登记表
+
+    按连接（sid）记录每个用户的最近心跳：用户的第一条连接建立时上线，
+    最后一条连接断开或心跳超过TTL未更新时下线。状态变化先在内存中合并，
+    由后台任务定期批量广播一次 presence_update，短时间内断开又重连的用户不会产生广播。
+    查询在线状态只读内存，不访问数据库。
+
+    每个工作进程只登记连到自己的连接；广播经消息队列送达所有客户端。
+    """
+
+    def __init__(self, ttl=90, flush_interval=1.0):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self._connections = {}  # user_id -> {sid: 最近心跳时间}
+        self._reported = set()  # 上次广播时在线的用户
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            ttl=config.get('PRESENCE_TTL', 90),
+            flush_interval=config.get('PRESENCE_FLUSH_INTERVAL', 1.0)
+        )
+
+    def connect(self, user_id, sid):
+        with self._lock:
+            self._connections.setdefault(user_id, {})[sid] = time.monotonic()
+
+    def heartbeat(self, user_id, sid):
+        """客户端定期发送心跳，连接异常中断时由TTL兜底下线"""
+        self.connect(user_id, sid)
+
+    def disconnect(self, user_id, sid):
+        with self._lock:
+            sids = self._connections.get(user_id)
+            if sids is not None:
+                sids.pop(sid, None)
+                if not sids:
+                    del self._connections[user_id]
+
+    def _expire(self, now):
+        deadline = now - self.ttl
+        for user_id in list(self._connections):
+            sids = self._connections[user_id]
+            for sid in [sid for sid, seen in sids.items() if seen < deadline]:
+                del sids[sid]
+            if not sids:
+                del self._connections[user_id]
+
+    def is_online(self, user_id):
+        with self._lock:
+            return user_id in self._connections
+
+    def online(self, user_ids):
+        """批量查询在线状态
+
+        Returns:
+            dict: {user_id: 是否在线}
+        """
+        with self._lock:
+            return {user_id: user_id in self._connections for user_id in user_ids}
+
+    def online_count(self):
+        with self._lock:
+            return len(self._connections)
+
+    def collect_changes(self):
+        """清理超时的连接，返回自上次调用以来净变化的 (上线用户, 下线用户)"""
+        with self._lock:
+            self._expire(time.monotonic())
+            current = set(self._connections)
+            went_online = sorted(current - self._reported)
+            went_offline = sorted(self._reported - current)
+            self._reported = current
+        return went_online, went_offline
+
+    def run(self, socketio):
+        """后台任务：定期合并状态变化并广播"""
+        while not self._stopped.is_set():
+            socketio.sleep(self.flush_interval)
+            try:
+                went_online, went_offline = self.collect_changes()
+                if went_online or went_offline:
+                    socketio.emit('presence_update', {'online': went_online, 'offline': went_offline})
+            except Exception as e:
+                logger.error('广播在线状态失败: %s', str(e), exc_info=True)
+
+    def stop(self):
+        self._stopped.set()
+
+
+def init_presence(app, socketio):
+    """创建在线状态登记表，启动批量广播任务并注册 /api/presence 接口
+
+    Args:
+        app: Flask应用实例
+        socketio: SocketIO实例
+
+    Returns:
+        PresenceRegistry
+    """
+    registry = PresenceRegistry.from_config(app.config)
+    app.extensions['presence'] = registry
+    PRESENCE_ONLINE.set_function(registry.online_count)
+    socketio.start_background_task(registry.run, socketio)
+
+    @app.route('/api/presence')
+    def presence_status():
+        """好友列表的在线标记：/api/presence?ids=1,2,3"""
+        if 'user_id' not in session:
+            return jsonify({'error': '请先登录'}), 401
+        try:
+            user_ids = [int(value) for value in request.args.get('ids', '').split(',') if value.strip()][:500]
+        except ValueError:
+            return jsonify({'error': '无效的用户ID'}), 400
+        return jsonify({'online': registry.online(user_ids)})
+
+    return registry
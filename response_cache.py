@@ -0,0 +1,178 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+_whitespace = re.compile(r'\s+')
+
+
+class ResponseCache:
+    """AI回复缓存
+
+    以 (模型, 系统提示词, 组装后的消息, 采样参数) 的规范化哈希为键，
+    内存层按LRU + TTL淘汰并限制总字节数，可选SQLite磁盘层在重启后继续命中，
+    磁盘层最多保留max_rows条，写入时定期删除过期和最早写入的记录。
+    temperature高于max_temperature的请求需要多样性，不走缓存；默认阈值低于AI_TEMPERATURE的默认值，
+    只有调低了采样温度的部署才会缓存回复。
+    """
+
+    def __init__(self, max_bytes=8 * 1024 * 1024, ttl=3600, sqlite_path=None, max_temperature=0.3,
+                 max_rows=10000):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_temperature = max_temperature
+        self.max_rows = max_rows
+        # 每写入这么多条清理一次磁盘层，超出上限的部分不会超过这个数
+        self._trim_every = max(1, max_rows // 10)
+        self._disk_writes = 0
+        self._entries = OrderedDict()  # key -> (过期时间, 回复文本, 字节数)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'skipped': 0}
+        self._db = None
+        if sqlite_path:
+            self._db = sqlite3.connect(sqlite_path, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS response_cache '
+                '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+            self._db.commit()
+
+    @classmethod
+    def from_env(cls):
+        """根据环境变量创建缓存，未开启时返回None"""
+        if os.getenv('AI_RESPONSE_CACHE', '0') != '1':
+            return None
+        return cls(
+            max_bytes=int(os.getenv('AI_RESPONSE_CACHE_BYTES', 8 * 1024 * 1024)),
+            ttl=int(os.getenv('AI_RESPONSE_CACHE_TTL', 3600)),
+            sqlite_path=os.getenv('AI_RESPONSE_CACHE_DB') or None,
+            max_temperature=float(os.getenv('AI_RESPONSE_CACHE_MAX_TEMPERATURE', 0.3)),
+            max_rows=int(os.getenv('AI_RESPONSE_CACHE_MAX_ROWS', 10000))
+        )
+
+    def should_cache(self, params):
+        """判断本次请求是否可以使用缓存"""
+        if params.get('temperature', 1.0) > self.max_temperature:
+            with self._lock:
+                self._counters['skipped'] += 1
+            return False
+        return True
+
+    @staticmethod
+    def make_key(model, messages, params):
+        """计算规范化的缓存键，忽略内容首尾及重复空白的差异"""
+        normalized = {
+            'model': model,
+            'messages': [
+                {'role': msg['role'], 'content': _whitespace.sub(' ', msg['content']).strip()}
+                for msg in messages
+            ],
+            'params': params
+        }
+        raw = json.dumps(normalized, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """读取缓存，未命中返回None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self._counters['hits'] += 1
+                    return entry[1]
+                self._remove(key)
+
+        value = self._disk_get(key, now)
+        with self._lock:
+            if value is None:
+                self._counters['misses'] += 1
+                return None
+            self._counters['disk_hits'] += 1
+        self._memory_set(key, value, now + self.ttl)
+        return value
+
+    def set(self, key, value):
+        """写入缓存"""
+        expires_at = time.time() + self.ttl
+        self._memory_set(key, value, expires_at)
+        if self._db is not None:
+            try:
+                with self._lock:
+                    self._db.execute(
+                        'INSERT OR REPLACE INTO response_cache (key, value, expires_at) VALUES (?, ?, ?)',
+                        (key, value, expires_at)
+                    )
+                    self._disk_writes += 1
+                    if self._disk_writes % self._trim_every == 0:
+                        self._trim_disk()
+                    self._db.commit()
+            except sqlite3.Error as e:
+                logger.error(f"Failed to write response cache: {str(e)}")
+
+    def _trim_disk(self):
+        """删除过期记录，并按写入先后淘汰超出max_rows的部分（调用方持有锁）"""
+        self._db.execute('DELETE FROM response_cache WHERE expires_at <= ?', (time.time(),))
+        excess = self._db.execute('SELECT COUNT(*) FROM response_cache').fetchone()[0] - self.max_rows
+        if excess > 0:
+            # 所有记录的TTL相同，过期时间最早的就是最早写入的
+            self._db.execute(
+                'DELETE FROM response_cache WHERE key IN '
+                '(SELECT key FROM response_cache ORDER BY expires_at LIMIT ?)', (excess,)
+            )
+            self._counters['evictions'] += excess
+
+    def _memory_set(self, key, value, expires_at):
+        size = len(value.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (expires_at, value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                evicted = next(iter(self._entries))
+                self._remove(evicted)
+                self._counters['evictions'] += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def _disk_get(self, key, now):
+        if self._db is None:
+            return None
+        try:
+            with self._lock:
+                row = self._db.execute(
+                    'SELECT value FROM response_cache WHERE key = ? AND expires_at > ?', (key, now)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"Failed to read response cache: {str(e)}")
+            return None
+        return row[0] if row else None
+
+    def purge_expired(self):
+        """删除磁盘层中过期的记录"""
+        if self._db is None:
+            return 0
+        with self._lock:
+            cursor = self._db.execute('DELETE FROM response_cache WHERE expires_at <= ?', (time.time(),))
+            self._db.commit()
+            return cursor.rowcount
+
+    def stats(self):
+        """命中/未命中等计数及内存占用"""
+        with self._lock:
+            return dict(self._counters, entries=len(self._entries), bytes=self._bytes)
@@ -0,0 +1,338 @@
+import re
+import html
+import base64
+import logging
+
+from flask import request, session, jsonify
+from sqlalchemy import event, text
+
+from models import db, Message, GroupMessage, Post, FileShare
+from message_history import clamp_limit
+
+logger = logging.getLogger(__name__)
+
+# FTS5全文索引：title、body参与检索，其余列只用于过滤和关联原记录
+# user_a、user_b 为私聊消息的双方，公开内容（帖子、共享文件）为0；群消息为发送者和群ID，按群成员身份过滤
+CREATE_INDEX_SQL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+    "kind UNINDEXED, ref_id UNINDEXED, user_a UNINDEXED, user_b UNINDEXED, title, body, "
+    "tokenize = 'unicode61 remove_diacritics 2')"
+)
+
+KINDS = ('message', 'group', 'post', 'file')
+# 索引行的rowid由原记录ID和类型编号组成，更新、删除时按rowid直接定位
+KIND_CODES = {'group': 0, 'message': 1, 'post': 2, 'file': 3}
+# bm25列权重，顺序与建表时的列一致；标题命中比正文更相关
+BM25_WEIGHTS = '0, 0, 0, 0, 4.0, 1.0'
+# snippet高亮标记，先用私用区字符占位，转义HTML后再替换
+MARK_OPEN, MARK_CLOSE = '\ue000', '\ue001'
+
+# 中日文汉字、假名及韩文音节
+_CJK_CHARS = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'
+_CJK_RE = re.compile(f'([{_CJK_CHARS}])')
+# 切分时插入的分隔符：不可见，unicode61视为分隔符，生成摘要后原样去掉
+SEPARATOR = '\u2063'
+_TERM_RE = re.compile(r'\w+')
+
+
+def segment(value):
+    """把中日韩文字切成单字，交给unicode61分词器
+
+    unicode61会把一整段连续的中文当成一个词，只能整句匹配；
+    逐字切分后配合短语查询，效果等同于子串匹配。
+    """
+    if not value:
+        return ''
+    return _CJK_RE.sub(SEPARATOR + r'\1' + SEPARATOR, value)
+
+
+def _desegment(value):
+    """去掉切分时插入的分隔符，还原原文"""
+    return value.replace(SEPARATOR, '')
+
+
+def build_match_query(query):
+    """把用户输入转换为FTS5查询：各个词之间为AND，中文词按短语匹配，最后一个词允许前缀匹配
+
+    Returns:
+        str: FTS5 MATCH表达式，没有可检索的词时返回None
+    """
+    terms = []
+    for word in query.split():
+        tokens = _TERM_RE.findall(segment(word))
+        if tokens:
+            terms.append('"' + ' '.join(tokens) + '"')
+    if not terms:
+        return None
+    if not _CJK_RE.search(terms[-1]):
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def encode_cursor(score, rowid):
+    raw = f'{score!r}|{rowid}'
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """解析游标，格式不正确时抛出ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        score, rowid = raw.split('|')
+        return float(score), int(rowid)
+    except Exception:
+        raise ValueError('无效的分页游标')
+
+
+def _is_enabled(connection):
+    return connection.dialect.name == 'sqlite'
+
+
+def _document(target):
+    """原记录对应的索引内容：(kind, user_a, user_b, title, body)"""
+    if isinstance(target, Message):
+        return 'message', target.sender_id, target.recipient_id, '', target.content
+    if isinstance(target, GroupMessage):
+        return 'group', target.sender_id, target.group_id, '', target.content
+    if isinstance(target, Post):
+        return 'post', 0, 0, target.title, target.content
+    return 'file', 0, 0, target.original_filename, target.description
+
+
+def _rowid(kind, ref_id):
+    return ref_id * 4 + KIND_CODES[kind]
+
+
+def _delete_document(connection, kind, ref_id):
+    connection.execute(text("DELETE FROM search_index WHERE rowid = :rowid"), {'rowid': _rowid(kind, ref_id)})
+
+
+def remove_messages(connection, message_ids):
+    """从索引中移除一批消息，用于归档等批量删除（不会触发ORM事件）"""
+    if _is_enabled(connection) and message_ids:
+        connection.execute(text("DELETE FROM search_index WHERE rowid = :rowid"),
+                           [{'rowid': _rowid('message', message_id)} for message_id in message_ids])
+
+
+def _insert_document(connection, target):
+    kind, user_a, user_b, title, body = _document(target)
+    if not (title or body):
+        return
+    connection.execute(
+        text("INSERT INTO search_index (rowid, kind, ref_id, user_a, user_b, title, body) "
+             "VALUES (:rowid, :kind, :ref_id, :user_a, :user_b, :title, :body)"),
+        {'rowid': _rowid(kind, target.id), 'kind': kind, 'ref_id': target.id, 'user_a': user_a, 'user_b': user_b,
+         'title': segment(title), 'body': segment(body)}
+    )
+
+
+def _index_inserted(mapper, connection, target):
+    """新记录在同一事务内写入索引"""
+    if _is_enabled(connection):
+        _insert_document(connection, target)
+
+
+def _index_updated(mapper, connection, target):
+    if _is_enabled(connection):
+        _delete_document(connection, _document(target)[0], target.id)
+        _insert_document(connection, target)
+
+
+def _index_deleted(mapper, connection, target):
+    if _is_enabled(connection):
+        _delete_document(connection, _document(target)[0], target.id)
+
+
+for _model in (Message, GroupMessage, Post, FileShare):
+    event.listen(_model, 'after_insert', _index_inserted)
+    event.listen(_model, 'after_delete', _index_deleted)
+# 消息只会修改状态，不需要重建索引
+event.listen(Post, 'after_update', _index_updated)
+event.listen(FileShare, 'after_update', _index_updated)
+
+
+def rebuild_search_index():
+    """根据现有数据重建全文索引，用于首次上线或数据修复"""
+    connection = db.session.connection()
+    connection.execute(text("DELETE FROM search_index"))
+    total = 0
+    for model in (Message, GroupMessage, Post, FileShare):
+        for target in db.session.execute(db.select(model).execution_options(yield_per=1000)).scalars():
+            _insert_document(connection, target)
+            total += 1
+    connection.execute(text("INSERT INTO search_index (search_index) VALUES ('optimize')"))
+    db.session.commit()
+    return total
+
+
+def backfill_group_messages():
+    """为加入全文检索之前的群消息补建索引；最新一条带内容的群消息已在索引中时不做任何事"""
+    connection = db.session.connection()
+    latest = db.session.execute(
+        db.select(GroupMessage.id).where(GroupMessage.content != '').order_by(GroupMessage.id.desc()).limit(1)
+    ).scalar()
+    if latest is None or connection.execute(
+            text("SELECT 1 FROM search_index WHERE rowid = :rowid"), {'rowid': _rowid('group', latest)}).first():
+        return 0
+    total = 0
+    for target in db.session.execute(db.select(GroupMessage).execution_options(yield_per=1000)).scalars():
+        _delete_document(connection, 'group', target.id)
+        _insert_document(connection, target)
+        total += 1
+    db.session.commit()
+    return total
+
+
+def search(user_id, query, kind=None, after=None, limit=20):
+    """全文检索当前用户可见的内容
+
+    私聊消息只对会话双方可见，群消息只对当前群成员可见，帖子和共享文件对所有登录用户可见。
+    按bm25相关度排序，使用 (score, rowid) 键集分页。
+
+    Args:
+        user_id: 当前用户ID
+        query: 检索词
+        kind: 只检索某一类内容（message、group、post、file），为空时检索全部
+        after: 上一页返回的游标
+        limit: 每页条数
+
+    Returns:
+        tuple: (结果列表, 下一页的游标或None)
+    """
+    match = build_match_query(query)
+    if match is None:
+        return [], None
+
+    params = {'match': match, 'user_id': user_id, 'limit': limit + 1}
+    conditions = [
+        "search_index MATCH :match",
+        "(CASE WHEN kind = 'group' "
+        "THEN user_b IN (SELECT group_id FROM group_member WHERE user_id = :user_id) "
+        "ELSE user_a = 0 OR user_a = :user_id OR user_b = :user_id END)"
+    ]
+    if kind:
+        conditions.append("kind = :kind")
+        params['kind'] = kind
+    page_condition = ''
+    if after:
+        params['score'], params['rowid'] = decode_cursor(after)
+        page_condition = "WHERE (score, rowid) > (:score, :rowid)"
+
+    rows = db.session.execute(text(
+        f"SELECT rowid, kind, ref_id, score FROM ("
+        f"SELECT rowid, kind, ref_id, bm25(search_index, {BM25_WEIGHTS}) AS score "
+        f"FROM search_index WHERE {' AND '.join(conditions)}) "
+        f"{page_condition} ORDER BY score, rowid LIMIT :limit"
+    ), params).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].score, rows[-1].rowid)
+    if not rows:
+        return [], None
+
+    # 只为当前页生成摘要
+    rowids = ', '.join(str(row.rowid) for row in rows)
+    snippets = dict(db.session.execute(text(
+        f"SELECT rowid, snippet(search_index, -1, '{MARK_OPEN}', '{MARK_CLOSE}', '…', 24) "
+        f"FROM search_index WHERE search_index MATCH :match AND rowid IN ({rowids})"
+    ), {'match': match}).all())
+
+    items = _load_items(rows)
+    results = []
+    for row in rows:
+        item = items.get((row.kind, int(row.ref_id)))
+        if item is None:
+            continue
+        snippet = html.escape(_desegment(snippets.get(row.rowid, '')))
+        results.append({
+            'kind': row.kind,
+            'id': int(row.ref_id),
+            'score': row.score,
+            'snippet': snippet.replace(MARK_OPEN, '<mark>').replace(MARK_CLOSE, '</mark>'),
+            'item': item
+        })
+    return results, next_cursor
+
+
+def _load_items(rows):
+    """按类型批量加载当前页对应的原记录"""
+    ids = {kind: [] for kind in KINDS}
+    for row in rows:
+        ids[row.kind].append(int(row.ref_id))
+
+    items = {}
+    if ids['message']:
+        for message in Message.query.filter(Message.id.in_(ids['message'])):
+            items[('message', message.id)] = message.to_dict()
+    if ids['group']:
+        for message in GroupMessage.query.filter(GroupMessage.id.in_(ids['group'])):
+            items[('group', message.id)] = message.to_dict()
+    if ids['post']:
+        for post in Post.query.filter(Post.id.in_(ids['post'])):
+            items[('post', post.id)] = {
+                'id': post.id,
+                'title': post.title,
+                'user_id': post.user_id,
+                'created_at': post.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+                'url': f'/post/{post.id}'
+            }
+    if ids['file']:
+        for file_share in FileShare.query.filter(FileShare.id.in_(ids['file'])):
+            items[('file', file_share.id)] = file_share.to_dict()
+    return items
+
+
+def init_search(app):
+    """创建全文索引并注册检索接口
+
+    Args:
+        app: Flask应用实例
+    """
+    with app.app_context():
+        connection = db.session.connection()
+        if not _is_enabled(connection):
+            logger.warning('全文检索需要SQLite FTS5，当前数据库为 %s', connection.dialect.name)
+            db.session.rollback()
+            return
+        exists = connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'search_index'"
+        )).first()
+        connection.execute(text(CREATE_INDEX_SQL))
+        db.session.commit()
+        if not exists:
+            logger.info('已为 %d 条记录建立全文索引', rebuild_search_index())
+        else:
+            backfilled = backfill_group_messages()
+            if backfilled:
+                logger.info('已为 %d 条群消息补建全文索引', backfilled)
+
+    @app.route('/api/search')
+    def search_api():
+        """检索私聊消息、群消息、帖子和共享文件
+
+        参数：q 检索词，type 内容类型，cursor 上一页返回的游标，limit 每页条数
+        """
+        if 'user_id' not in session:
+            return jsonify({'error': '请先登录'}), 401
+        query = (request.args.get('q') or '').strip()
+        kind = request.args.get('type') or None
+        if not query:
+            return jsonify({'error': '请输入检索内容'}), 400
+        if kind and kind not in KINDS:
+            return jsonify({'error': '不支持的内容类型'}), 400
+
+        try:
+            results, next_cursor = search(session['user_id'], query, kind,
+                                          request.args.get('cursor'), clamp_limit(request.args.get('limit')))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify({'results': results, 'next_cursor': next_cursor})
+
+
+if __name__ == '__main__':
+    from app import app
+
+    with app.app_context():
+        print(f"Indexed {rebuild_search_index()} records")
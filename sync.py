@@ -0,0 +1,130 @@
+import base64
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select
+
+from models import db, Message, GroupMember, GroupMessage, UnreadCounter
+from group_chat import group_unread_counts
+
+SYNC_BATCH_SIZE = 200
+# 时间水位往前多取一段，避免各进程时钟不一致或事务提交较晚时漏掉状态变化；回执重复下发是幂等的
+SYNC_OVERLAP = timedelta(seconds=5)
+
+
+def encode_sync_cursor(last_message_id, since, last_group_message_id):
+    """把 (已收到的最大私聊消息ID, 状态变化的时间水位, 已收到的最大群消息ID) 编码为不透明的同步游标
+
+    群消息ID全局递增，一个水位即可覆盖用户所在的所有群。
+    """
+    raw = f'{last_message_id}|{since.isoformat()}|{last_group_message_id}'
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_sync_cursor(cursor):
+    """解析同步游标，格式不正确时抛出ValueError
+
+    Returns:
+        tuple: (私聊消息ID, 时间水位, 群消息ID)；旧版本的游标没有群消息ID，返回None
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        parts = raw.split('|')
+        if len(parts) not in (2, 3):
+            raise ValueError
+        group_message_id = int(parts[2]) if len(parts) == 3 else None
+        return int(parts[0]), datetime.fromisoformat(parts[1]), group_message_id
+    except Exception:
+        raise ValueError('无效的同步游标')
+
+
+def _missed_messages(user_id, after_id, limit):
+    """收到和发出的消息中ID大于after_id的部分
+
+    分别走 recipient_id、sender_id 索引做范围扫描（索引隐含id列），再按ID合并。
+    """
+    received = Message.query.filter(Message.recipient_id == user_id, Message.id > after_id) \
+        .order_by(Message.id).limit(limit + 1).all()
+    sent = Message.query.filter(Message.sender_id == user_id, Message.id > after_id) \
+        .order_by(Message.id).limit(limit + 1).all()
+    rows = sorted({m.id: m for m in received + sent}.values(), key=lambda m: m.id)
+    return rows[:limit], len(rows) > limit
+
+
+def _missed_group_messages(user_id, after_id, limit):
+    """用户当前所在各群中ID大于after_id的群消息，每个群走 (group_id, id) 索引"""
+    rows = GroupMessage.query.filter(
+        GroupMessage.group_id.in_(select(GroupMember.group_id).where(GroupMember.user_id == user_id)),
+        GroupMessage.id > after_id
+    ).order_by(GroupMessage.id).limit(limit + 1).all()
+    return rows[:limit], len(rows) > limit
+
+
+def _group_message_id_at(since):
+    """时间水位之前的最大群消息ID，用于没有群消息水位的旧游标
+
+    按ID倒序扫描到第一条早于水位的消息即停止，只读取水位之后的少量消息。
+    """
+    return db.session.query(GroupMessage.id).filter(GroupMessage.timestamp <= since) \
+        .order_by(GroupMessage.id.desc()).limit(1).scalar() or 0
+
+
+def load_sync_batch(user_id, cursor=None, last_message_id=None, limit=SYNC_BATCH_SIZE):
+    """加载客户端离线期间错过的消息和状态变化
+
+    Args:
+        user_id: 当前用户ID
+        cursor: 上次同步返回的游标
+        last_message_id: 没有游标时客户端本地已有的最大消息ID，用该消息的时间作为状态变化的起点
+        limit: 本批最多返回的消息数
+
+    Returns:
+        dict: messages 按ID正序的消息；group_messages 用户所在群中按ID正序的群消息；
+              receipts 对方的已读回执；unread 自己各会话的未读数（在其他设备上已读的也会更新）；
+              group_unread 本批有新消息的群的未读数；
+              cursor 下次同步用的游标；has_more 为真时应立即用新游标继续同步
+
+    群的已读水位没有更新时间，在其他设备上读过的群只能在收到新群消息时随 group_unread 更新。
+    """
+    now = datetime.utcnow()
+    group_after_id = None
+    if cursor:
+        after_id, since, group_after_id = decode_sync_cursor(cursor)
+    elif last_message_id:
+        after_id = int(last_message_id)
+        since = db.session.query(Message.timestamp).filter(Message.id == after_id).scalar() or now
+    else:
+        # 首次连接没有本地数据，客户端会整页加载历史，这里只返回起始游标
+        after_id = db.session.query(func.max(Message.id)).scalar() or 0
+        group_after_id = db.session.query(func.max(GroupMessage.id)).scalar() or 0
+        return {'messages': [], 'group_messages': [], 'receipts': [], 'unread': {}, 'group_unread': {},
+                'has_more': False, 'cursor': encode_sync_cursor(after_id, now - SYNC_OVERLAP, group_after_id)}
+    if group_after_id is None:
+        group_after_id = _group_message_id_at(since)
+
+    messages, has_more = _missed_messages(user_id, after_id, limit)
+    group_messages, has_more_groups = _missed_group_messages(user_id, group_after_id, limit)
+    group_unread = group_unread_counts(user_id, {m.group_id for m in group_messages}) if group_messages else {}
+
+    # 对方读了自己发出的消息：其他用户以自己为peer的计数行，走 (peer_id, updated_at) 索引
+    receipts = db.session.execute(
+        select(UnreadCounter.user_id, UnreadCounter.last_read_id)
+        .where(UnreadCounter.peer_id == user_id, UnreadCounter.updated_at > since,
+               UnreadCounter.last_read_id > 0)
+    ).all()
+    # 自己各会话的未读数，主键前缀扫描
+    unread = db.session.execute(
+        select(UnreadCounter.peer_id, UnreadCounter.count, UnreadCounter.last_read_id)
+        .where(UnreadCounter.user_id == user_id, UnreadCounter.updated_at > since)
+    ).all()
+
+    return {
+        'messages': [m.to_dict() for m in messages],
+        'group_messages': [m.to_dict() for m in group_messages],
+        'receipts': [{'reader_id': reader_id, 'up_to_id': up_to_id} for reader_id, up_to_id in receipts],
+        'unread': {peer_id: {'count': count, 'last_read_id': last_read_id}
+                   for peer_id, count, last_read_id in unread},
+        'group_unread': group_unread,
+        'has_more': has_more or has_more_groups,
+        'cursor': encode_sync_cursor(messages[-1].id if messages else after_id, now - SYNC_OVERLAP,
+                                     group_messages[-1].id if group_messages else group_after_id)
+    }
@@ -0,0 +1,17 @@
+"""跨工作进程的emit送达测试，缺少Socket.IO客户端依赖时跳过"""
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('requests')
+pytest.importorskip('socketio')
+pytest.importorskip('websocket', reason='websocket-client is required for the websocket transport')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench'))
+
+from two_workers import check_cross_worker  # noqa: E402
+
+
+def test_emit_reaches_device_on_other_worker():
+    assert check_cross_worker()
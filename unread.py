@@ -0,0 +1,166 @@
+import os
+import time
+import logging
+from datetime import datetime
+
+from sqlalchemy import event, select, update, func, case
+from sqlalchemy.dialects import sqlite, postgresql
+
+from models import db, User, Message, UnreadCounter
+
+logger = logging.getLogger(__name__)
+
+_upsert_dialects = {
+    'sqlite': sqlite.insert,
+    'postgresql': postgresql.insert
+}
+
+# (机器人用户ID集合, 过期时间)；本进程内增删用户时立即失效，其他进程的变化在TTL之后生效
+_bot_ids = None
+BOT_IDS_TTL = int(os.getenv('USER_CACHE_TTL', 300))
+
+
+def _get_bot_ids(connection):
+    """机器人用户不会阅读消息，不为其维护未读数"""
+    global _bot_ids
+    cached = _bot_ids
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+    bot_ids = frozenset(connection.execute(select(User.id).where(User.is_bot.is_(True))).scalars())
+    _bot_ids = (bot_ids, time.monotonic() + BOT_IDS_TTL)
+    return bot_ids
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _invalidate_bot_ids(mapper, connection, target):
+    global _bot_ids
+    _bot_ids = None
+
+
+def _upsert_counter(connection, user_id, peer_id, values, on_conflict):
+    """插入或更新计数行
+
+    Args:
+        values: 行不存在时插入的列值
+        on_conflict: 行已存在时更新的列值
+    """
+    table = UnreadCounter.__table__
+    key = {'user_id': user_id, 'peer_id': peer_id}
+    insert = _upsert_dialects.get(connection.dialect.name)
+    if insert is not None:
+        stmt = insert(table).values(**key, **values)
+        connection.execute(stmt.on_conflict_do_update(index_elements=['user_id', 'peer_id'], set_=on_conflict))
+        return
+
+    # 其他数据库：先更新，没有命中再插入
+    result = connection.execute(
+        update(table).where(table.c.user_id == user_id, table.c.peer_id == peer_id).values(**on_conflict)
+    )
+    if result.rowcount == 0:
+        connection.execute(table.insert().values(**key, **values))
+
+
+@event.listens_for(Message, 'after_insert')
+def _increment_unread(mapper, connection, target):
+    """新消息写入时在同一事务内累加接收方的未读数"""
+    if target.recipient_id in _get_bot_ids(connection):
+        return
+    table = UnreadCounter.__table__
+    now = datetime.utcnow()
+    _upsert_counter(
+        connection, target.recipient_id, target.sender_id,
+        values={'count': 1, 'last_read_id': 0, 'updated_at': now},
+        on_conflict={'count': table.c.count + 1, 'updated_at': now}
+    )
+
+
+def mark_conversation_read(user_id, peer_id, up_to_id=None):
+    """把peer发给user的消息批量标记为已读
+
+    只更新上次水位之后的消息，一条UPDATE完成，不加载任何ORM对象。
+    调用方负责提交事务。
+
+    Args:
+        user_id: 阅读消息的用户
+        peer_id: 消息发送方
+        up_to_id: 已读到的消息ID，为空时表示全部已读
+
+    Returns:
+        tuple: (本次标记的消息数, 新的已读水位)
+    """
+    counter = db.session.get(UnreadCounter, (user_id, peer_id))
+    watermark = counter.last_read_id if counter else 0
+    if up_to_id is None:
+        # 只取这个会话中对方发来的消息，水位和回执不能带上其他会话的消息ID
+        up_to_id = db.session.query(func.max(Message.id)).filter(
+            Message.recipient_id == user_id,
+            Message.sender_id == peer_id,
+            Message.id > watermark
+        ).scalar() or watermark
+    up_to_id = int(up_to_id)
+    if up_to_id <= watermark:
+        return 0, watermark
+
+    now = datetime.utcnow()
+    # recipient_id索引隐含了id列，(recipient_id, id)范围扫描只会触及水位之后的消息
+    result = db.session.execute(
+        update(Message)
+        .where(
+            Message.recipient_id == user_id,
+            Message.id > watermark,
+            Message.id <= up_to_id,
+            Message.sender_id == peer_id,
+            Message.status == 'sent'
+        )
+        .values(status='read', read_at=now)
+        .execution_options(synchronize_session=False)
+    )
+    marked = result.rowcount
+
+    table = UnreadCounter.__table__
+    _upsert_counter(
+        db.session.connection(), user_id, peer_id,
+        values={'count': 0, 'last_read_id': up_to_id, 'updated_at': now},
+        on_conflict={
+            'count': case((table.c.count > marked, table.c.count - marked), else_=0),
+            'last_read_id': up_to_id,
+            'updated_at': now
+        }
+    )
+    return marked, up_to_id
+
+
+def get_unread_counts(user_id):
+    """一次主键范围读取用户所有会话的未读数"""
+    rows = db.session.execute(
+        select(UnreadCounter.peer_id, UnreadCounter.count)
+        .where(UnreadCounter.user_id == user_id, UnreadCounter.count > 0)
+    )
+    return {peer_id: count for peer_id, count in rows}
+
+
+def rebuild_unread_counters():
+    """根据Message表重建全部未读计数，用于首次上线或数据修复"""
+    now = datetime.utcnow()
+    db.session.execute(UnreadCounter.__table__.delete())
+    rows = db.session.execute(
+        select(Message.recipient_id, Message.sender_id, func.count(Message.id))
+        .join(User, User.id == Message.recipient_id)
+        .where(Message.status == 'sent', User.is_bot.isnot(True))
+        .group_by(Message.recipient_id, Message.sender_id)
+    ).all()
+    for recipient_id, sender_id, count in rows:
+        db.session.add(UnreadCounter(
+            user_id=recipient_id, peer_id=sender_id, count=count, last_read_id=0, updated_at=now
+        ))
+    db.session.commit()
+    return len(rows)
+
+
+if __name__ == '__main__':
+    from app import app
+
+    with app.app_context():
+        print(f"Rebuilt {rebuild_unread_counters()} unread counters")
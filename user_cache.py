@@ -0,0 +1,112 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import event
+
+from models import db, User
+
+BOT_USERNAME = 'AI助手'
+
+
+class CachedUser:
+    """User行的只读快照，脱离数据库会话，可以在线程和请求之间共用"""
+    __slots__ = ('id', 'username', 'email', 'is_bot', 'created_at')
+
+    def __init__(self, user):
+        self.id = user.id
+        self.username = user.username
+        self.email = user.email
+        self.is_bot = bool(user.is_bot)
+        self.created_at = user.created_at
+
+    def __repr__(self):
+        return f'<CachedUser {self.username}>'
+
+
+class UserCache:
+    """热点User行的进程内缓存（AI助手、已登录的会话用户）
+
+    按LRU淘汰，条目在TTL后过期；本进程内修改、删除用户时立即失效，
+    其他进程的修改最多在TTL之后生效。
+    """
+
+    def __init__(self, max_entries=10000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # user_id -> (CachedUser, 过期时间)
+        self._bot_id = None
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_entries=int(os.getenv('USER_CACHE_MAX_ENTRIES', 10000)),
+            ttl=int(os.getenv('USER_CACHE_TTL', 300))
+        )
+
+    def _put(self, user):
+        cached = CachedUser(user)
+        with self._lock:
+            self._entries[cached.id] = (cached, time.monotonic() + self.ttl)
+            self._entries.move_to_end(cached.id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return cached
+
+    def get(self, user_id):
+        """按ID获取用户，缓存未命中时查询数据库；用户不存在时返回None"""
+        if user_id is None:
+            return None
+        user_id = int(user_id)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(user_id)
+                self._counters['hits'] += 1
+                return entry[0]
+            self._counters['misses'] += 1
+        user = db.session.get(User, user_id)
+        return self._put(user) if user is not None else None
+
+    def get_bot(self):
+        """获取AI助手用户，不存在时返回None"""
+        bot_id = self._bot_id
+        if bot_id is not None:
+            bot = self.get(bot_id)
+            if bot is not None:
+                return bot
+        with self._lock:
+            self._counters['misses'] += 1
+        user = User.query.filter_by(username=BOT_USERNAME).first()
+        if user is None:
+            return None
+        self._bot_id = user.id
+        return self._put(user)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            if self._entries.pop(user_id, None) is not None:
+                self._counters['invalidations'] += 1
+            if user_id == self._bot_id:
+                self._bot_id = None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bot_id = None
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, entries=len(self._entries))
+
+
+user_cache = UserCache.from_env()
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _invalidate_user(mapper, connection, target):
+    user_cache.invalidate(target.id)